@@ -0,0 +1,312 @@
+import asyncio
+import logging
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+GRANULARITIES = ("all", "day", "hour", "minute")
+BUCKET_SIZES = {"minute": timedelta(minutes=1), "hour": timedelta(hours=1), "day": timedelta(days=1)}
+BUCKET_FORMATS = {"minute": "%Y-%m-%dT%H:%M", "hour": "%Y-%m-%dT%H", "day": "%Y-%m-%d"}
+
+# Minute buckets are only for live dashboards; a TTL index drops them after this
+MINUTE_RETENTION = timedelta(hours=48)
+MAX_SERIES_POINTS = 1440
+
+# Only one worker rebuilds at a time; the lock expires if that worker dies
+REBUILD_LEASE_ID = "analytics_rebuild"
+REBUILD_LEASE = timedelta(minutes=10)
+
+# Counters kept in every rollup document. Each is bucketed by the time of the
+# event that produced it: orders by creation, delivered/revenue/delivery time
+# by delivery, cancelled by cancellation.
+COUNTERS = ("orders", "delivered", "cancelled", "revenue_cents", "delivery_seconds")
+
+
+def naive_utc(when: datetime) -> datetime:
+    """``when`` as a naive UTC datetime, the form rollups are bucketed in."""
+    if when.tzinfo is None:
+        return when
+    return when.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def bucket_start(when: datetime, granularity: str) -> Optional[datetime]:
+    if granularity == "minute":
+        return when.replace(second=0, microsecond=0)
+    if granularity == "hour":
+        return when.replace(minute=0, second=0, microsecond=0)
+    if granularity == "day":
+        return when.replace(hour=0, minute=0, second=0, microsecond=0)
+    return None
+
+
+def rollup_id(granularity: str, bucket: Optional[datetime], restaurant_id: Optional[str]) -> str:
+    parts = [granularity]
+    if bucket is not None:
+        parts.append(bucket.strftime(BUCKET_FORMATS[granularity]))
+    parts.append(restaurant_id or "*")
+    return ":".join(parts)
+
+
+def rollup_meta(granularity: str, bucket: Optional[datetime], restaurant_id: Optional[str]) -> Dict[str, Any]:
+    meta = {"granularity": granularity, "bucket": bucket, "restaurant_id": restaurant_id}
+    if granularity == "minute":
+        meta["expires_at"] = bucket + MINUTE_RETENTION
+    return meta
+
+
+def status_name(status) -> str:
+    # Accept OrderStatus members as well as the raw stored strings
+    return getattr(status, "value", status)
+
+
+def to_cents(amount: float) -> int:
+    return int(round(amount * 100))
+
+
+class AnalyticsRollups:
+    """Order counters and revenue kept up to date as orders change.
+
+    Rollup documents exist per granularity (all-time, day, hour) for the whole
+    platform and per restaurant. Events only add increments to an in-memory
+    buffer; a background task merges them and applies them with one
+    ``bulk_write`` of ``$inc`` upserts per ``flush_interval``. The all-time
+    documents also track how many orders currently sit in each status.
+    ``rebuild`` recomputes everything from ``orders`` with an aggregation.
+    """
+
+    def __init__(self, db, collection: str = "analytics_rollups", flush_interval: float = 1.0):
+        self.db = db
+        self.collection_name = collection
+        self.flush_interval = flush_interval
+        self.pending: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+        self.meta: Dict[str, Dict[str, Any]] = {}
+        self._flusher: Optional[asyncio.Task] = None
+        self._rebuilding = False
+
+    @property
+    def collection(self):
+        return self.db[self.collection_name]
+
+    def start(self):
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+
+    # Events
+
+    def order_created(self, order: Dict[str, Any]):
+        when = order.get("created_at") or datetime.utcnow()
+        self._add(when, order["restaurant_id"], {"orders": 1}, status_delta={status_name(order.get("status", "pending")): 1})
+
+    def order_status_changed(self, order: Dict[str, Any], old_status: str, new_status: str, when: Optional[datetime] = None):
+        when = when or datetime.utcnow()
+        old_status, new_status = status_name(old_status), status_name(new_status)
+        increments: Dict[str, float] = {}
+        if new_status == "delivered":
+            increments["delivered"] = 1
+            increments["revenue_cents"] = to_cents(order.get("total", 0))
+            created_at = order.get("created_at")
+            if created_at:
+                increments["delivery_seconds"] = max(0, int((when - created_at).total_seconds()))
+        elif new_status == "cancelled":
+            increments["cancelled"] = 1
+        # An unchanged status leaves the per-status counts alone
+        status_delta = {old_status: -1, new_status: 1} if old_status != new_status else {}
+        self._add(when, order["restaurant_id"], increments, status_delta=status_delta)
+
+    def _add(self, when: datetime, restaurant_id: str, increments: Dict[str, float], status_delta: Dict[str, int]):
+        for granularity in GRANULARITIES:
+            bucket = bucket_start(when, granularity)
+            for scope in (None, restaurant_id):
+                key = rollup_id(granularity, bucket, scope)
+                fields = self.pending[key]
+                for name, value in increments.items():
+                    fields[name] += value
+                if granularity == "all":
+                    for status, value in status_delta.items():
+                        fields[f"status.{status}"] += value
+                if key not in self.meta:
+                    self.meta[key] = rollup_meta(granularity, bucket, scope)
+
+    # Persistence
+
+    async def flush(self):
+        if not self.pending or self._rebuilding:
+            return
+        pending, meta = self.pending, self.meta
+        self.pending, self.meta = defaultdict(lambda: defaultdict(float)), {}
+        requests = [
+            UpdateOne(
+                {"_id": key},
+                {"$inc": {name: value for name, value in fields.items() if value}, "$setOnInsert": meta[key]},
+                upsert=True,
+            )
+            for key, fields in pending.items()
+            if any(fields.values())
+        ]
+        if not requests:
+            return
+        try:
+            await self.collection.bulk_write(requests, ordered=False)
+        except Exception:
+            # Put the increments back so the next flush retries them
+            for key, fields in pending.items():
+                for name, value in fields.items():
+                    self.pending[key][name] += value
+                self.meta.setdefault(key, meta[key])
+            raise
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Flushing analytics rollups failed")
+
+    # Reads
+
+    async def totals(self, restaurant_id: Optional[str] = None) -> Dict[str, float]:
+        """All-time counters, including increments not flushed yet."""
+        key = rollup_id("all", None, restaurant_id)
+        document = await self.collection.find_one({"_id": key}) or {}
+        totals = {name: document.get(name, 0) for name in COUNTERS}
+        totals["status"] = dict(document.get("status", {}))
+        for name, value in self.pending.get(key, {}).items():
+            if name.startswith("status."):
+                status = name[len("status."):]
+                totals["status"][status] = totals["status"].get(status, 0) + value
+            else:
+                totals[name] += value
+        return totals
+
+    async def series(
+        self, granularity: str, start: datetime, end: datetime, restaurant_id: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """Per-bucket metrics for ``[start, end)``, with empty buckets filled in."""
+        step = BUCKET_SIZES[granularity]
+        first = bucket_start(start, granularity)
+        documents = await self.collection.find(
+            {"granularity": granularity, "restaurant_id": restaurant_id, "bucket": {"$gte": first, "$lt": end}},
+            {"_id": 0, "bucket": 1, **{name: 1 for name in COUNTERS}},
+        ).sort("bucket", 1).to_list(MAX_SERIES_POINTS)
+        by_bucket = {document["bucket"]: document for document in documents}
+
+        points = []
+        bucket = first
+        while bucket < end and len(points) < MAX_SERIES_POINTS:
+            document = by_bucket.get(bucket, {})
+            orders = document.get("orders", 0)
+            delivered = document.get("delivered", 0)
+            points.append({
+                "bucket": bucket,
+                "orders": int(orders),
+                "revenue": document.get("revenue_cents", 0) / 100,
+                "avg_delivery_minutes": round(document.get("delivery_seconds", 0) / delivered / 60, 2) if delivered else None,
+                "cancellation_rate": round(document.get("cancelled", 0) / orders, 4) if orders else 0.0,
+            })
+            bucket += step
+        return points
+
+    # Backfill
+
+    async def rebuild(self, only_if_missing: bool = False) -> bool:
+        """Recompute every rollup from the orders collection.
+
+        Flushing is paused while it runs and buffered increments are applied
+        on top afterwards. Orders that change while the aggregation scans
+        may be counted twice, so run it at startup or when traffic is quiet.
+        A lock document in ``leases`` keeps workers from rebuilding at the
+        same time; returns False when another worker holds it, or when
+        ``only_if_missing`` and the rollups already exist.
+        """
+        holder = uuid.uuid4().hex
+        if not await self._take_rebuild_lock(holder):
+            return False
+        self._rebuilding = True
+        try:
+            if only_if_missing and await self.collection.find_one({"_id": rollup_id("all", None, None)}, {"_id": 1}):
+                return False
+            totals: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+            meta: Dict[str, Dict[str, Any]] = {}
+            orders = self.db.orders
+
+            def add(granularity: str, bucket: Optional[datetime], restaurant_id: Optional[str], fields: Dict[str, float]):
+                for scope in (None, restaurant_id):
+                    key = rollup_id(granularity, bucket, scope)
+                    for name, value in fields.items():
+                        totals[key][name] += value
+                    meta[key] = rollup_meta(granularity, bucket, scope)
+
+            async for row in orders.aggregate(_status_pipeline()):
+                add("all", None, row["_id"]["restaurant_id"], {f"status.{row['_id']['status']}": row["count"]})
+
+            minute_cutoff = datetime.utcnow() - MINUTE_RETENTION
+            for granularity in GRANULARITIES:
+                since = minute_cutoff if granularity == "minute" else None
+                for pipeline in _bucket_pipelines(granularity, since):
+                    async for row in orders.aggregate(pipeline):
+                        fields = {name: row[name] for name in COUNTERS if row.get(name)}
+                        if fields:
+                            add(granularity, row["_id"]["bucket"], row["_id"]["restaurant_id"], fields)
+
+            await self.collection.delete_many({})
+            if totals:
+                await self.collection.bulk_write([
+                    UpdateOne({"_id": key}, {"$set": {**meta[key], **fields}}, upsert=True)
+                    for key, fields in totals.items()
+                ], ordered=False)
+            return True
+        finally:
+            self._rebuilding = False
+            await self.db.leases.delete_one({"_id": REBUILD_LEASE_ID, "holder": holder})
+
+    async def _take_rebuild_lock(self, holder: str) -> bool:
+        now = datetime.utcnow()
+        try:
+            await self.db.leases.find_one_and_update(
+                {"_id": REBUILD_LEASE_ID, "expires_at": {"$lte": now}},
+                {"$set": {"holder": holder, "expires_at": now + REBUILD_LEASE}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # Another worker is rebuilding
+            return False
+        return True
+
+def _status_pipeline():
+    return [{"$group": {
+        "_id": {"restaurant_id": "$restaurant_id", "status": "$status"},
+        "count": {"$sum": 1},
+    }}]
+
+
+def _bucket_pipelines(granularity: str, since: Optional[datetime] = None) -> Iterable[list]:
+    """Aggregations producing the time-bucketed counters, one per event time."""
+    def group(time_field: str, match: Dict[str, Any], accumulators: Dict[str, Any]):
+        bucket = None if granularity == "all" else {"$dateTrunc": {"date": f"${time_field}", "unit": granularity}}
+        time_match = {"$ne": None} if since is None else {"$gte": since}
+        return [
+            {"$match": {**match, time_field: time_match}},
+            {"$group": {"_id": {"restaurant_id": "$restaurant_id", "bucket": bucket}, **accumulators}},
+        ]
+
+    yield group("created_at", {}, {"orders": {"$sum": 1}})
+    yield group("actual_delivery_time", {"status": "delivered"}, {
+        "delivered": {"$sum": 1},
+        "revenue_cents": {"$sum": {"$round": [{"$multiply": ["$total", 100]}, 0]}},
+        "delivery_seconds": {"$sum": {"$divide": [{"$subtract": ["$actual_delivery_time", "$created_at"]}, 1000]}},
+    })
+    yield group("updated_at", {"status": "cancelled"}, {"cancelled": {"$sum": 1}})
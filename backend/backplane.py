@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from bson import ObjectId
+from pymongo import CursorType
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+Envelope = Dict[str, Any]
+Handler = Callable[[Envelope], Awaitable[None]]
+
+# Seconds between reopening a dead tail cursor, doubling while it keeps dying empty
+MIN_REOPEN_DELAY = 0.05
+MAX_REOPEN_DELAY = 5.0
+
+# A reopened tail cursor rereads this far back and skips envelopes it has
+# already handled. Workers stamp created_at with their own clocks and batches
+# land out of order, so it must cover clock skew plus write latency.
+RESUME_OVERLAP = timedelta(seconds=10)
+
+# Envelopes kept while Mongo is unreachable; the oldest are dropped past this
+MAX_BUFFERED = 100_000
+DUPLICATE_KEY = 11000
+
+
+class Backplane:
+    """Pub/sub channel shared by every process that holds WebSockets.
+
+    ``publish`` must never block the caller: implementations buffer and ship
+    envelopes in the background. Envelopes published by this node are not
+    handed back to its own handler.
+    """
+
+    def __init__(self):
+        self.node_id = uuid.uuid4().hex
+        self.handler: Optional[Handler] = None
+
+    async def start(self, handler: Handler):
+        self.handler = handler
+
+    def publish(self, envelope: Envelope):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    async def _dispatch(self, envelope: Envelope):
+        if envelope.get("origin") == self.node_id or self.handler is None:
+            return
+        try:
+            await self.handler(envelope)
+        except Exception:
+            logger.exception("Backplane handler failed for %s envelope", envelope.get("kind"))
+
+
+class InMemoryBroker:
+    """Process-local stand-in for a message broker, shared by several backplanes."""
+
+    def __init__(self):
+        self.subscribers: List["InMemoryBackplane"] = []
+
+    def publish(self, envelope: Envelope):
+        for subscriber in list(self.subscribers):
+            asyncio.get_running_loop().create_task(subscriber._dispatch(envelope))
+
+
+class InMemoryBackplane(Backplane):
+    def __init__(self, broker: Optional[InMemoryBroker] = None):
+        super().__init__()
+        self.broker = broker or InMemoryBroker()
+
+    async def start(self, handler: Handler):
+        await super().start(handler)
+        self.broker.subscribers.append(self)
+
+    def publish(self, envelope: Envelope):
+        self.broker.publish({**envelope, "origin": self.node_id})
+
+    async def close(self):
+        if self in self.broker.subscribers:
+            self.broker.subscribers.remove(self)
+
+
+class MongoBackplane(Backplane):
+    """Backplane over a capped collection tailed by every worker.
+
+    Works against a standalone mongod (no replica set needed, unlike change
+    streams). Published envelopes are buffered and written with
+    ``insert_many`` by a background task so senders never wait on Mongo.
+    Documents get their ``_id`` when published, so a batch that failed can be
+    retried without delivering twice.
+    """
+
+    def __init__(self, db, collection: str = "ws_backplane", size_bytes: int = 64 * 1024 * 1024, max_batch: int = 500):
+        super().__init__()
+        self.db = db
+        self.collection_name = collection
+        self.size_bytes = size_bytes
+        self.max_batch = max_batch
+        self.buffer: List[Dict[str, Any]] = []
+        self.pending = asyncio.Event()
+        self.tasks: List[asyncio.Task] = []
+
+    async def start(self, handler: Handler):
+        await super().start(handler)
+        if self.collection_name not in await self.db.list_collection_names():
+            try:
+                await self.db.create_collection(self.collection_name, capped=True, size=self.size_bytes)
+            except Exception:
+                # Another worker created it first
+                pass
+        self.collection = self.db[self.collection_name]
+        started_at = datetime.utcnow()
+        self.tasks = [
+            asyncio.create_task(self._write_loop()),
+            asyncio.create_task(self._tail_loop(started_at)),
+        ]
+
+    def publish(self, envelope: Envelope):
+        self.buffer.append({"_id": ObjectId(), "envelope": {**envelope, "origin": self.node_id}})
+        if len(self.buffer) > MAX_BUFFERED:
+            del self.buffer[:len(self.buffer) - MAX_BUFFERED]
+            logger.warning("Backplane buffer full, dropped the oldest envelopes")
+        self.pending.set()
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        while self.buffer:
+            try:
+                await self._flush()
+            except Exception:
+                logger.exception("Backplane publish failed on close, %d envelopes lost", len(self.buffer))
+                break
+
+    async def _flush(self):
+        batch, self.buffer = self.buffer[:self.max_batch], self.buffer[self.max_batch:]
+        now = datetime.utcnow()
+        try:
+            await self.collection.insert_many([{**document, "created_at": now} for document in batch], ordered=False)
+        except BulkWriteError as error:
+            # Requeue what failed; duplicates were written by an earlier attempt
+            failed = {e["index"] for e in error.details.get("writeErrors", ()) if e.get("code") != DUPLICATE_KEY}
+            self.buffer[:0] = [document for index, document in enumerate(batch) if index in failed]
+            if failed:
+                raise
+        except BaseException:
+            self.buffer[:0] = batch
+            raise
+
+    async def _write_loop(self):
+        while True:
+            await self.pending.wait()
+            self.pending.clear()
+            while self.buffer:
+                try:
+                    await self._flush()
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception("Backplane publish failed")
+                    await asyncio.sleep(1)
+
+    async def _tail_loop(self, started_at: datetime):
+        # Until the first envelope arrives, tail from startup; after that,
+        # reopen RESUME_OVERLAP before the newest one handled. _ids are not
+        # ordered across writers, so remember the ones inside the window.
+        latest: Optional[datetime] = None
+        seen: Dict[ObjectId, datetime] = {}  # roughly oldest first
+        delay = MIN_REOPEN_DELAY
+        while True:
+            try:
+                since = started_at if latest is None else latest - RESUME_OVERLAP
+                cursor = self.collection.find({"created_at": {"$gte": since}}, cursor_type=CursorType.TAILABLE_AWAIT)
+                received = False
+                while cursor.alive:
+                    async for document in cursor:
+                        if document["_id"] in seen:
+                            continue
+                        received = True
+                        created_at = document["created_at"]
+                        latest = created_at if latest is None else max(latest, created_at)
+                        seen[document["_id"]] = created_at
+                        while seen:
+                            oldest = next(iter(seen))
+                            if seen[oldest] >= latest - RESUME_OVERLAP:
+                                break
+                            del seen[oldest]
+                        await self._dispatch(document["envelope"])
+                    await asyncio.sleep(0.05)
+                # A cursor on an empty capped collection dies at once; back
+                # off instead of reopening it in a tight loop
+                delay = MIN_REOPEN_DELAY if received else min(delay * 2, MAX_REOPEN_DELAY)
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Backplane tail cursor failed, reopening")
+                await asyncio.sleep(1)
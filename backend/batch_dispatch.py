@@ -0,0 +1,319 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from eta import ROAD_FACTOR
+from geo import GeoGridIndex, haversine_km_array
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+solve_seconds = REGISTRY.histogram("batch_dispatch_solve_seconds", "Time to match one tick's orders to drivers")
+batch_offers = REGISTRY.counter("batch_dispatch_offers_total", "Orders offered to a driver by the batch dispatcher")
+
+
+def nearest_drivers(
+    order_lat: np.ndarray,
+    order_lng: np.ndarray,
+    driver_lat: np.ndarray,
+    driver_lng: np.ndarray,
+    k: int,
+    max_km: float,
+    chunk_size: int = 1024,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """The ``k`` closest drivers to each order within ``max_km``.
+
+    Returns ``(drivers, km)``, both ``(orders, k)``: driver indices padded
+    with -1 and their distances padded with inf. Candidates are picked from
+    a float32 distance matrix over a local flat projection, computed
+    ``chunk_size`` orders at a time to bound memory; the distances returned
+    are haversine.
+    """
+    n, m = len(order_lat), len(driver_lat)
+    k = min(k, m)
+    drivers = np.full((n, k), -1, dtype=np.int64)
+    km = np.full((n, k), np.inf)
+    if not n or not k:
+        return drivers, km
+
+    d_lat = np.asarray(driver_lat, dtype=np.float32)
+    d_lng = np.asarray(driver_lng, dtype=np.float32)
+    for start in range(0, n, chunk_size):
+        lat = np.asarray(order_lat[start:start + chunk_size], dtype=np.float32)[:, None]
+        lng = np.asarray(order_lng[start:start + chunk_size], dtype=np.float32)[:, None]
+        dy = d_lat - lat
+        dx = (d_lng - lng) * np.cos(np.radians(lat))
+        squared = dy * dy + dx * dx
+        if k < m:
+            nearest = np.argpartition(squared, k - 1, axis=1)[:, :k]
+        else:
+            nearest = np.broadcast_to(np.arange(m), squared.shape)
+        distance = haversine_km_array(lat, lng, d_lat[nearest], d_lng[nearest])
+        within = distance <= max_km
+        drivers[start:start + chunk_size] = np.where(within, nearest, -1)
+        km[start:start + chunk_size] = np.where(within, distance, np.inf)
+    return drivers, km
+
+
+def auction(
+    benefit: np.ndarray,
+    candidates: np.ndarray,
+    reserve: np.ndarray,
+    epsilon: float = 0.1,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Match rows to at most one candidate column each, maximizing total benefit.
+
+    ``benefit`` and ``candidates`` are ``(rows, k)``: the benefit of giving
+    each row each of its candidate columns (column -1 means no candidate).
+    ``reserve`` is what each row gets from staying unmatched. Bertsekas'
+    auction, Jacobi style: every unmatched row bids for its best column at
+    once, raising its price by the margin over the second best plus
+    ``epsilon``, and the highest bid takes it. Prices start at zero and only
+    rise when bid, so a column left unmatched still costs nothing, which
+    keeps the result within ``rows * epsilon`` of the optimum. (Epsilon
+    scaling would leave stale prices on unmatched columns and lose that.)
+
+    Returns the column of each row (-1 when unmatched) and the final column
+    prices, which ``dual_bound`` uses to certify the result.
+    """
+    n, k = benefit.shape
+    assigned = np.full(n, -1, dtype=np.int64)
+    valid = candidates >= 0
+    if not n or not valid.any():
+        return assigned, np.zeros(0)
+    columns = np.where(valid, candidates, 0)
+    prices = np.zeros(int(candidates.max()) + 1)
+
+    owner = np.full(len(prices), -1, dtype=np.int64)
+    bidding = np.arange(n)
+    while bidding.size:
+        value = np.where(valid[bidding], benefit[bidding] - prices[columns[bidding]], -np.inf)
+        best = np.argmax(value, axis=1)
+        local = np.arange(bidding.size)
+        first = value[local, best]
+        value[local, best] = -np.inf
+        second = np.maximum(value.max(axis=1), reserve[bidding])
+        # Rows better off unmatched stop bidding for good: prices only rise
+        bids = first > reserve[bidding]
+        bidding, best, first, second = bidding[bids], best[bids], first[bids], second[bids]
+        if not bidding.size:
+            break
+
+        target = columns[bidding, best]
+        price = prices[target] + (first - second) + epsilon
+        # Highest bid per column wins it
+        order = np.lexsort((-price, target))
+        won_columns, first_bid = np.unique(target[order], return_index=True)
+        winners = bidding[order][first_bid]
+        displaced = owner[won_columns]
+        displaced = displaced[displaced >= 0]
+        assigned[displaced] = -1
+        owner[won_columns] = winners
+        assigned[winners] = won_columns
+        prices[won_columns] = price[order][first_bid]
+
+        lost = np.ones(bidding.size, dtype=bool)
+        lost[order[first_bid]] = False
+        bidding = np.concatenate([bidding[lost], displaced])
+    return assigned, prices
+
+
+def assignment_value(benefit: np.ndarray, candidates: np.ndarray, reserve: np.ndarray, assigned: np.ndarray) -> float:
+    """Total benefit of ``assigned`` (columns per row, -1 unmatched)."""
+    matched = assigned >= 0
+    slot = np.argmax(candidates == assigned[:, None], axis=1)
+    return float(benefit[matched, slot[matched]].sum() + reserve[~matched].sum())
+
+
+def dual_bound(benefit: np.ndarray, candidates: np.ndarray, reserve: np.ndarray, prices: np.ndarray) -> float:
+    """An upper bound on the best total benefit, from the auction's prices."""
+    if not len(prices):
+        return float(reserve.sum())
+    value = np.where(candidates >= 0, benefit - prices[np.maximum(candidates, 0)], -np.inf)
+    return float(np.maximum(value.max(axis=1), reserve).sum() + prices.sum())
+
+
+class BatchDispatcher:
+    """Matches waiting orders to idle drivers in batches instead of first-come.
+
+    A drop-in for ``OrderDispatcher``: ``dispatch`` adds an order to the
+    pool and ``accept`` takes it out once a driver wins it. Every
+    ``interval`` seconds the pool is matched against the located, connected
+    drivers that have no active order and no open offer. Each order may go
+    to one of its ``k`` nearest drivers within ``max_radius_km``, at a cost
+    of the driver's minutes to the restaurant; leaving an order unmatched
+    costs ``max_pickup_minutes`` plus ``age_weight`` for every minute it has
+    waited, so the oldest orders are served first when drivers are short.
+    The assignment minimizing the total cost is solved with ``auction``
+    (in a thread) and each match is offered to its driver alone for
+    ``offer_timeout`` seconds; a driver who lets it lapse is not offered
+    that order again. An order nobody could be offered for ``broadcast_after``
+    seconds is broadcast to every driver, as the ring dispatcher does, and
+    an order still in the pool after ``forget_after`` seconds is dropped.
+
+    With several workers each one matches the orders its outbox dispatched,
+    so a driver may get offers from two workers in the same tick; accepting
+    is a compare-and-set, so only one of them can win.
+    """
+
+    def __init__(
+        self,
+        index: GeoGridIndex,
+        send: Callable[[str, Dict[str, Any]], Awaitable[None]],
+        broadcast: Callable[[Dict[str, Any]], Awaitable[None]],
+        is_available: Optional[Callable[[str], bool]] = None,
+        load_busy: Optional[Callable[[], Awaitable[Set[str]]]] = None,
+        speed_kmh: Callable[[datetime], float] = lambda now: 20.0,
+        interval: float = 5.0,
+        k: int = 12,
+        max_radius_km: float = 24.0,
+        max_pickup_minutes: float = 45.0,
+        age_weight: float = 0.5,
+        offer_timeout: float = 20.0,
+        broadcast_after: float = 60.0,
+        max_location_age: float = 300.0,
+        forget_after: float = 1800.0,
+    ):
+        self.index = index
+        self.send = send
+        self.broadcast = broadcast
+        self.is_available = is_available
+        self.load_busy = load_busy
+        self.speed_kmh = speed_kmh
+        self.interval = interval
+        self.k = k
+        self.max_radius_km = max_radius_km
+        self.max_pickup_minutes = max_pickup_minutes
+        self.age_weight = age_weight
+        self.offer_timeout = offer_timeout
+        self.broadcast_after = broadcast_after
+        self.max_location_age = max_location_age
+        self.forget_after = forget_after
+        # order id -> (lat, lng, message, added_at); drivers each order was offered to
+        self.pool: Dict[str, Tuple[float, float, Dict[str, Any], float]] = {}
+        self.offers: Dict[str, Set[str]] = {}
+        # order id -> (driver id, expires_at) for offers still open
+        self.open_offers: Dict[str, Tuple[str, float]] = {}
+        self._broadcast: Set[str] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def dispatch(self, order_id: str, location: Dict[str, float], message: Dict[str, Any]):
+        """Add ``order_id`` to the pool matched on the next tick."""
+        self.pool[order_id] = (location["lat"], location["lng"], message, time.monotonic())
+        self.offers.setdefault(order_id, set())
+
+    def accept(self, order_id: str) -> Set[str]:
+        """Stop dispatching ``order_id`` and return the drivers it was offered to."""
+        self.pool.pop(order_id, None)
+        self.open_offers.pop(order_id, None)
+        self._broadcast.discard(order_id)
+        return self.offers.pop(order_id, set())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.tick()
+            except Exception:
+                logger.exception("Batch dispatch failed")
+
+    def _idle_drivers(self, busy: Set[str]) -> List[Tuple[str, float, float]]:
+        oldest = time.monotonic() - self.max_location_age
+        offered = {driver_id for driver_id, _ in self.open_offers.values()}
+        return [
+            (driver_id, lat, lng)
+            for driver_id, (lat, lng, updated_at) in self.index.points.items()
+            if updated_at >= oldest and driver_id not in busy and driver_id not in offered
+            and (self.is_available is None or self.is_available(driver_id))
+        ]
+
+    def match(
+        self,
+        orders: List[Tuple[str, float, float, float]],
+        drivers: List[Tuple[str, float, float]],
+        now: datetime,
+        lapsed: Optional[Dict[str, List[str]]] = None,
+    ) -> List[Tuple[str, str]]:
+        """Cost-minimizing ``(order id, driver id)`` pairs.
+
+        ``orders`` are ``(id, lat, lng, minutes waited)`` and ``drivers``
+        ``(id, lat, lng)``; ``lapsed`` lists drivers not to pair with an order.
+        """
+        if not orders or not drivers:
+            return []
+        started = time.perf_counter()
+        order_ids = [order[0] for order in orders]
+        order_lat, order_lng, waited = (np.array(column, dtype=float) for column in list(zip(*orders))[1:])
+        driver_ids = [driver[0] for driver in drivers]
+        position = {driver_id: i for i, driver_id in enumerate(driver_ids)}
+        driver_lat, driver_lng = (np.array(column, dtype=float) for column in list(zip(*drivers))[1:])
+
+        candidates, km = nearest_drivers(order_lat, order_lng, driver_lat, driver_lng, self.k, self.max_radius_km)
+        for row, order_id in enumerate(order_ids):
+            for driver_id in (lapsed or {}).get(order_id, ()):
+                column = position.get(driver_id)
+                if column is not None:
+                    candidates[row, candidates[row] == column] = -1
+        pickup_minutes = km * ROAD_FACTOR * 60.0 / self.speed_kmh(now)
+        # The auction maximizes benefit: the cost saved over leaving the order unmatched
+        reserve = np.zeros(len(orders))
+        unmatched_cost = self.max_pickup_minutes + self.age_weight * waited
+        benefit = np.where(candidates >= 0, unmatched_cost[:, None] - pickup_minutes, -np.inf)
+        candidates[benefit <= 0] = -1
+        assigned, _ = auction(benefit, candidates, reserve)
+        solve_seconds.observe(time.perf_counter() - started)
+        return [(order_ids[row], driver_ids[assigned[row]]) for row in np.flatnonzero(assigned >= 0)]
+
+    async def tick(self, now: Optional[datetime] = None):
+        """Offer this tick's best matches and broadcast orders that waited too long."""
+        now = now or datetime.utcnow()
+        clock = time.monotonic()
+        for order_id, (_, expires_at) in list(self.open_offers.items()):
+            if expires_at <= clock:
+                del self.open_offers[order_id]
+        for order_id, (_, _, _, added_at) in list(self.pool.items()):
+            if clock - added_at >= self.forget_after:
+                logger.info("Nobody took order %s, dropping it from the pool", order_id)
+                self.accept(order_id)
+
+        waiting = [
+            (order_id, lat, lng, (clock - added_at) / 60)
+            for order_id, (lat, lng, _, added_at) in self.pool.items()
+            if order_id not in self.open_offers
+        ]
+        if not waiting:
+            return
+        busy = await self.load_busy() if self.load_busy is not None else set()
+        drivers = self._idle_drivers(busy)
+        lapsed = {order_id: list(self.offers.get(order_id, ())) for order_id, *_ in waiting}
+        # Thousands by thousands take most of a second; solve off the event loop
+        matches = await asyncio.to_thread(self.match, waiting, drivers, now, lapsed)
+        for order_id, driver_id in matches:
+            if order_id not in self.pool:
+                # Taken or cancelled while matching
+                continue
+            self.offers[order_id].add(driver_id)
+            self.open_offers[order_id] = (driver_id, clock + self.offer_timeout)
+            batch_offers.inc()
+            await self.send(driver_id, self.pool[order_id][2])
+
+        for order_id, (_, _, message, added_at) in list(self.pool.items()):
+            if (order_id not in self._broadcast and not self.offers.get(order_id)
+                    and clock - added_at >= self.broadcast_after):
+                logger.info("No driver matched order %s, broadcasting", order_id)
+                self._broadcast.add(order_id)
+                await self.broadcast(message)
@@ -0,0 +1,147 @@
+"""Batch dispatch solve time at peak.
+
+Run from the backend directory::
+
+    python -m benchmarks.bench_dispatch
+
+Scatters ``--orders`` waiting orders and ``--drivers`` idle drivers over a
+40 km wide city and times one batch dispatcher tick: the nearest-driver
+search and the auction. The matching is compared with first-tap dispatch
+(each order, oldest first, goes to the nearest driver still free) on
+orders served, pickup minutes and total cost (pickup minutes plus the
+dispatcher's penalty for each order left unserved), and its gap to the
+optimum is bounded with the auction's prices. Small instances are first checked against an
+exhaustive search over every assignment.
+"""
+import argparse
+import itertools
+import random
+import time
+from datetime import datetime
+
+import numpy as np
+
+from batch_dispatch import BatchDispatcher, assignment_value, auction, dual_bound, nearest_drivers
+from eta import ROAD_FACTOR
+from geo import GeoGridIndex
+
+CENTER = (48.8566, 2.3522)
+SPAN_DEG = 0.18  # about 40 km across
+SPEED_KMH = 20.0
+
+
+def build_city(orders: int, drivers: int, rng: random.Random):
+    def point():
+        return (CENTER[0] + rng.uniform(-SPAN_DEG / 2, SPAN_DEG / 2),
+                CENTER[1] + rng.uniform(-SPAN_DEG / 2, SPAN_DEG / 2) * 1.5)
+
+    waiting = [(f"order-{i}", *point(), rng.uniform(0, 10)) for i in range(orders)]
+    idle = [(f"driver-{i}", *point()) for i in range(drivers)]
+    return waiting, idle
+
+
+def exhaustive(benefit, candidates, reserve):
+    """The best total benefit over every assignment of a small instance."""
+    options = [[-1] + [int(c) for c in row if c >= 0] for row in candidates]
+    best = -np.inf
+    for choice in itertools.product(*options):
+        taken = [c for c in choice if c >= 0]
+        if len(taken) != len(set(taken)):
+            continue
+        total = sum(
+            reserve[row] if column < 0 else benefit[row, list(candidates[row]).index(column)]
+            for row, column in enumerate(choice)
+        )
+        best = max(best, total)
+    return best
+
+
+def first_tap(dispatcher, waiting, idle):
+    """Oldest order first, each to the nearest driver still free."""
+    order_lat, order_lng = (np.array(column) for column in list(zip(*waiting))[1:3])
+    driver_lat, driver_lng = (np.array(column) for column in list(zip(*idle))[1:])
+    candidates, km = nearest_drivers(order_lat, order_lng, driver_lat, driver_lng, len(idle), dispatcher.max_radius_km)
+    taken = set()
+    pairs = []
+    for row in sorted(range(len(waiting)), key=lambda row: -waiting[row][3]):
+        for column, distance in zip(candidates[row], km[row]):
+            if column >= 0 and column not in taken:
+                taken.add(column)
+                pairs.append((row, int(column), distance))
+                break
+    return pairs
+
+
+def main(orders: int, drivers: int, k: int, epsilon: float, checks: int, seed: int):
+    rng = random.Random(seed)
+    np_rng = np.random.default_rng(seed)
+
+    for _ in range(checks):
+        n, m = rng.randint(1, 6), rng.randint(1, 6)
+        candidates = np.array([np_rng.permutation(m)[:min(m, 3)] for _ in range(n)])
+        candidates[np_rng.random(candidates.shape) < 0.2] = -1
+        benefit = np.where(candidates >= 0, np_rng.uniform(-5, 30, candidates.shape), -np.inf)
+        reserve = np.where(np_rng.random(n) < 0.3, np_rng.uniform(0, 10, n), 0.0)
+        assigned, prices = auction(benefit, candidates, reserve, epsilon)
+        value = assignment_value(benefit, candidates, reserve, assigned)
+        assert len(set(assigned[assigned >= 0])) == int((assigned >= 0).sum())
+        assert value >= exhaustive(benefit, candidates, reserve) - n * epsilon - 1e-9
+    print(f"Checked {checks} small instances against exhaustive search")
+
+    waiting, idle = build_city(orders, drivers, rng)
+    dispatcher = BatchDispatcher(GeoGridIndex(), send=None, broadcast=None, speed_kmh=lambda now: SPEED_KMH, k=k)
+    order_lat, order_lng, waited = (np.array(column) for column in list(zip(*waiting))[1:])
+    driver_lat, driver_lng = (np.array(column) for column in list(zip(*idle))[1:])
+
+    started = time.perf_counter()
+    candidates, km = nearest_drivers(order_lat, order_lng, driver_lat, driver_lng, k, dispatcher.max_radius_km)
+    nearest_seconds = time.perf_counter() - started
+
+    pickup_minutes = km * ROAD_FACTOR * 60.0 / SPEED_KMH
+    reserve = np.zeros(orders)
+    unmatched_cost = dispatcher.max_pickup_minutes + dispatcher.age_weight * waited
+    benefit = np.where(candidates >= 0, unmatched_cost[:, None] - pickup_minutes, -np.inf)
+    candidates[benefit <= 0] = -1
+    started = time.perf_counter()
+    assigned, prices = auction(benefit, candidates, reserve, epsilon)
+    auction_seconds = time.perf_counter() - started
+
+    value = assignment_value(benefit, candidates, reserve, assigned)
+    bound = dual_bound(benefit, candidates, reserve, prices)
+    matched = assigned >= 0
+    slot = np.argmax(candidates == assigned[:, None], axis=1)
+    batch_minutes = pickup_minutes[matched, slot[matched]]
+
+    started = time.perf_counter()
+    dispatcher.match(waiting, idle, datetime.utcnow())
+    match_seconds = time.perf_counter() - started
+
+    greedy = first_tap(dispatcher, waiting, idle)
+    greedy_minutes = np.array([distance * ROAD_FACTOR * 60.0 / SPEED_KMH for _, _, distance in greedy])
+    greedy_served = np.zeros(orders, dtype=bool)
+    greedy_served[[row for row, _, _ in greedy]] = True
+    costs = (
+        ("batch", batch_minutes, batch_minutes.sum() + unmatched_cost[~matched].sum()),
+        ("first tap", greedy_minutes, greedy_minutes.sum() + unmatched_cost[~greedy_served].sum()),
+    )
+
+    print(f"{orders:,} orders x {drivers:,} drivers, k={k}, epsilon={epsilon}")
+    print(f"  nearest drivers  {nearest_seconds * 1000:>8.0f} ms")
+    print(f"  auction          {auction_seconds * 1000:>8.0f} ms")
+    print(f"  full match       {match_seconds * 1000:>8.0f} ms (tick every {dispatcher.interval:.0f}s)")
+    print(f"  gap to optimum   {(bound - value) / max(1, orders):>8.3f} min per order (at most {epsilon})")
+    print(f"{'dispatch':<12} {'served':>7} {'mean pickup min':>16} {'p95 pickup min':>15} {'total cost min':>15}")
+    for name, minutes, cost in costs:
+        print(f"{name:<12} {len(minutes):>7,} {minutes.mean():>16.1f} {np.percentile(minutes, 95):>15.1f} {cost:>15,.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--orders", type=int, default=5000, help="orders waiting for a driver")
+    parser.add_argument("--drivers", type=int, default=5000, help="idle drivers")
+    parser.add_argument("--k", type=int, default=12, help="nearest drivers considered per order")
+    parser.add_argument("--epsilon", type=float, default=0.1, help="auction bid increment, in minutes")
+    parser.add_argument("--checks", type=int, default=300, help="small instances checked exhaustively")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    main(args.orders, args.drivers, args.k, args.epsilon, args.checks, args.seed)
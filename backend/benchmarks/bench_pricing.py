@@ -0,0 +1,77 @@
+"""Cart pricing throughput for carts of 1 to 100 items.
+
+Run from the backend directory::
+
+    python -m benchmarks.bench_pricing
+
+"warm" prices from the cached menu; "cold" invalidates the cache before
+every cart so each one also pays for loading the menu (served here by an
+in-process stand-in for the Motor collection, so only our own CPU cost
+is measured).
+"""
+import argparse
+import asyncio
+import time
+import uuid
+from types import SimpleNamespace
+
+from pricing import PricingEngine
+
+RESTAURANT_ID = "bench-restaurant"
+
+
+class FakeCursor:
+    def __init__(self, documents):
+        self.documents = documents
+
+    async def to_list(self, length):
+        return list(self.documents)
+
+
+class FakeMenuCollection:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def find(self, query, projection=None):
+        return FakeCursor(self.documents)
+
+
+def build_menu(size: int):
+    return [
+        {"id": str(uuid.uuid4()), "name": f"Item {i}", "price": 5 + (i % 40) * 0.25, "is_available": True, "preparation_time": 10 + i % 20}
+        for i in range(size)
+    ]
+
+
+async def measure(engine: PricingEngine, cart, cold: bool, min_time: float) -> float:
+    runs = 0
+    started = time.perf_counter()
+    while True:
+        for _ in range(100):
+            if cold:
+                engine.invalidate(RESTAURANT_ID)
+            await engine.price(RESTAURANT_ID, 2.99, cart)
+        runs += 100
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            return runs / elapsed
+
+
+async def main(min_time: float, menu_size: int):
+    menu = build_menu(menu_size)
+    db = SimpleNamespace(menu_items=FakeMenuCollection(menu))
+    engine = PricingEngine(db)
+    print(f"{'items':>5} {'warm carts/s':>14} {'warm us/cart':>13} {'cold carts/s':>14} {'cold us/cart':>13}")
+    for size in (1, 5, 10, 25, 50, 100):
+        cart = [SimpleNamespace(menu_item_id=menu[i % menu_size]["id"], quantity=1 + i % 3) for i in range(size)]
+        warm = await measure(engine, cart, cold=False, min_time=min_time)
+        cold = await measure(engine, cart, cold=True, min_time=min_time)
+        print(f"{size:>5} {warm:>14,.0f} {1e6 / warm:>13.1f} {cold:>14,.0f} {1e6 / cold:>13.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds to run each measurement")
+    parser.add_argument("--menu-size", type=int, default=120, help="items on the benchmark menu")
+    args = parser.parse_args()
+    asyncio.run(main(args.min_time, args.menu_size))
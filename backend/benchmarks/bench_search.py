@@ -0,0 +1,144 @@
+"""Restaurant search latency at city scale.
+
+Run from the backend directory::
+
+    python -m benchmarks.bench_search
+
+Indexes ``--restaurants`` restaurants spread over a 40 km wide city and
+times searches from random customer locations: no filter, a cuisine, a
+text query, both, and the second page of an unfiltered search. Every
+search is first checked against a brute-force ranking of the whole city.
+"""
+import argparse
+import random
+import time
+import uuid
+
+from pagination import MAX_LIMIT
+from search import DEFAULT_RADIUS_KM, MINUTES_PER_KM, NAME_MATCH_BONUS, RATING_WEIGHT, RestaurantSearchIndex, tokenize
+from geo import haversine_km
+
+CENTER = (48.8566, 2.3522)
+SPAN_DEG = 0.18  # about 40 km across
+
+CUISINES = ["Italian", "Japanese", "Mexican", "Indian", "Chinese", "French", "Thai", "Lebanese", "American", "Vegan"]
+WORDS = [
+    "pizza", "pasta", "sushi", "ramen", "tacos", "burrito", "curry", "biryani", "noodles", "dumplings",
+    "crêpes", "bistro", "grill", "burger", "falafel", "kebab", "salad", "bakery", "wok", "tandoori",
+    "garden", "corner", "house", "kitchen", "express", "street", "golden", "little", "royal", "fresh",
+]
+QUERIES = ["pizza", "sushi bar", "golden", "curry house", "crep", "fresh salad", "ra"]
+
+
+def build_restaurants(count: int, rng: random.Random):
+    restaurants = []
+    for i in range(count):
+        name = " ".join(rng.sample(WORDS, 2)).title()
+        restaurants.append({
+            "id": str(uuid.UUID(int=rng.getrandbits(128))),
+            "name": name,
+            "description": " ".join(rng.sample(WORDS, 6)),
+            "location": {
+                "lat": CENTER[0] + rng.uniform(-SPAN_DEG / 2, SPAN_DEG / 2),
+                "lng": CENTER[1] + rng.uniform(-SPAN_DEG / 2, SPAN_DEG / 2) * 1.5,
+            },
+            "cuisine_type": rng.choice(CUISINES),
+            "rating": round(rng.uniform(2.5, 5.0), 1),
+            "estimated_delivery_time": rng.choice([15, 20, 25, 30, 35, 45, 60]),
+            "is_active": True,
+        })
+    return restaurants
+
+
+def brute_force(restaurants, lat, lng, radius_km, cuisine, query, limit, after=None):
+    terms = tokenize(query or "")
+    ranked = []
+    for doc in restaurants:
+        if cuisine and doc["cuisine_type"].lower() != cuisine.lower():
+            continue
+        words = set(tokenize(doc["name"] + " " + doc["description"] + " " + doc["cuisine_type"]))
+        name_words = set(tokenize(doc["name"]))
+
+        def matches(term, vocabulary):
+            return term in vocabulary if len(term) < 2 else any(w.startswith(term) for w in vocabulary)
+
+        if not all(matches(t, words) for t in terms):
+            continue
+        distance = haversine_km(lat, lng, doc["location"]["lat"], doc["location"]["lng"])
+        if distance > radius_km:
+            continue
+        score = doc["estimated_delivery_time"] - RATING_WEIGHT * doc["rating"] + distance * MINUTES_PER_KM
+        if terms and all(matches(t, name_words) for t in terms):
+            score -= NAME_MATCH_BONUS
+        if after is None or (score, doc["id"]) > after:
+            ranked.append((score, doc["id"]))
+    return [restaurant_id for _, restaurant_id in sorted(ranked)[:limit]]
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def main(count: int, searches: int, limit: int, checks: int, seed: int):
+    rng = random.Random(seed)
+    restaurants = build_restaurants(count, rng)
+    index = RestaurantSearchIndex()
+    started = time.perf_counter()
+    for doc in restaurants:
+        index.upsert(doc)
+    print(f"Indexed {count:,} restaurants in {time.perf_counter() - started:.2f}s")
+
+    def random_point():
+        return (CENTER[0] + rng.uniform(-SPAN_DEG / 2, SPAN_DEG / 2),
+                CENTER[1] + rng.uniform(-SPAN_DEG / 2, SPAN_DEG / 2) * 1.5)
+
+    def second_page(lat, lng, radius_km, cuisine, query):
+        last = index.search(lat, lng, radius_km, cuisine, query, limit)[-1]
+        return index.search(lat, lng, radius_km, cuisine, query, limit, after=(last.score, last.id))
+
+    cases = [
+        ("nearby", lambda: (None, None), index.search),
+        ("cuisine", lambda: (rng.choice(CUISINES), None), index.search),
+        ("text", lambda: (None, rng.choice(QUERIES)), index.search),
+        ("cuisine + text", lambda: (rng.choice(CUISINES), rng.choice(QUERIES)), index.search),
+        ("nearby, page 2", lambda: (None, None), second_page),
+    ]
+
+    for name, params, run in cases:
+        for _ in range(checks):
+            lat, lng = random_point()
+            cuisine, query = params()
+            hits = run(lat, lng, DEFAULT_RADIUS_KM, cuisine, query)
+            after = None
+            if run is second_page:
+                first = brute_force(restaurants, lat, lng, DEFAULT_RADIUS_KM, cuisine, query, limit)
+                first_hits = index.search(lat, lng, DEFAULT_RADIUS_KM, cuisine, query, limit)
+                assert [hit.id for hit in first_hits] == first
+                after = (first_hits[-1].score, first_hits[-1].id)
+            expected = brute_force(restaurants, lat, lng, DEFAULT_RADIUS_KM, cuisine, query, limit, after)
+            assert [hit.id for hit in hits] == expected, (name, cuisine, query)
+
+    print(f"{'search':<16} {'p50 us':>9} {'p95 us':>9} {'p99 us':>9} {'max us':>9} {'hits':>5}")
+    for name, params, run in cases:
+        timings = []
+        hits = 0
+        for _ in range(searches):
+            lat, lng = random_point()
+            cuisine, query = params()
+            started = time.perf_counter()
+            hits += len(run(lat, lng, DEFAULT_RADIUS_KM, cuisine, query))
+            timings.append((time.perf_counter() - started) * 1e6)
+        print(f"{name:<16} {percentile(timings, 0.5):>9.0f} {percentile(timings, 0.95):>9.0f} "
+              f"{percentile(timings, 0.99):>9.0f} {max(timings):>9.0f} {hits / searches:>5.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--restaurants", type=int, default=50000, help="restaurants in the city")
+    parser.add_argument("--searches", type=int, default=2000, help="timed searches per kind")
+    parser.add_argument("--limit", type=int, default=20, help=f"page size (the endpoint allows up to {MAX_LIMIT})")
+    parser.add_argument("--checks", type=int, default=20, help="searches per kind checked against brute force")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    main(args.restaurants, args.searches, args.limit, args.checks, args.seed)
@@ -0,0 +1,119 @@
+"""JSON encoding cost of Order and Restaurant lists and of driver broadcasts.
+
+Run from the backend directory::
+
+    python -m benchmarks.bench_serialization
+
+"stdlib" is the previous path: FastAPI's ``jsonable_encoder`` followed by
+``json.dumps`` (what ``JSONResponse`` and ``send_json`` do). "orjson" is ``serialization.dumps`` on the same data.
+The broadcast rows encode one ``new_order`` message for every connected
+driver (previously once per driver) against once per broadcast.
+"""
+import argparse
+import json
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+
+# Importing server only builds the app; nothing connects at import time
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "bench")
+os.environ.setdefault("STRIPE_SECRET_KEY", "sk_test_bench")
+os.environ.setdefault("PAYMENT_GATEWAY", "fake")
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+
+from serialization import dumps  # noqa: E402
+from server import Order, OrderItem, Restaurant  # noqa: E402
+
+
+def build_orders(count: int):
+    now = datetime.utcnow()
+    return [
+        Order(
+            customer_id=str(uuid.uuid4()),
+            restaurant_id=str(uuid.uuid4()),
+            items=[OrderItem(menu_item_id=str(uuid.uuid4()), quantity=1 + j % 3) for j in range(3)],
+            subtotal=30.0 + i,
+            delivery_fee=2.99,
+            tax=2.4,
+            total=35.39 + i,
+            delivery_address=f"{i} Main St",
+            delivery_location={"lat": 40.7 + i / 1000, "lng": -74.0},
+            seq=i,
+            estimated_delivery_time=now + timedelta(minutes=30),
+        )
+        for i in range(count)
+    ]
+
+
+def build_restaurants(count: int):
+    return [
+        Restaurant(
+            name=f"Restaurant {i}",
+            description="Delicious food delivered fast",
+            address=f"{i} Restaurant St",
+            location={"lat": 40.7 + i / 1000, "lng": -74.0},
+            cuisine_type="American",
+            owner_id=str(uuid.uuid4()),
+            phone="+1234567890",
+        )
+        for i in range(count)
+    ]
+
+
+def measure(fn, min_time: float) -> float:
+    """Calls per second of ``fn``."""
+    runs = 0
+    started = time.perf_counter()
+    while True:
+        for _ in range(10):
+            fn()
+        runs += 10
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            return runs / elapsed
+
+
+def stdlib_list(models):
+    return json.dumps(jsonable_encoder(models)).encode()
+
+
+def orjson_list(models):
+    return dumps([model.model_dump() for model in models])
+
+
+def main(min_time: float, size: int, drivers: int):
+    orders = build_orders(size)
+    restaurants = build_restaurants(size)
+    # What the list endpoints actually hold: raw documents from Mongo
+    order_documents = [order.model_dump() for order in orders]
+    message = {"type": "new_order", "order": jsonable_encoder(orders[0])}
+
+    assert json.loads(stdlib_list(orders)) == json.loads(orjson_list(orders))
+
+    cases = [
+        (f"{size} Order models", lambda: stdlib_list(orders), lambda: orjson_list(orders)),
+        (f"{size} Restaurant models", lambda: stdlib_list(restaurants), lambda: orjson_list(restaurants)),
+        (f"{size} order documents", lambda: json.dumps(jsonable_encoder(order_documents)), lambda: dumps(order_documents)),
+        (
+            f"broadcast to {drivers} drivers",
+            lambda: [json.dumps(message) for _ in range(drivers)],
+            lambda: [dumps(message)] * drivers,
+        ),
+    ]
+    print(f"{'payload':<28} {'stdlib us':>11} {'orjson us':>11} {'speedup':>8}")
+    for name, before, after in cases:
+        slow = measure(before, min_time)
+        fast = measure(after, min_time)
+        print(f"{name:<28} {1e6 / slow:>11.1f} {1e6 / fast:>11.1f} {fast / slow:>7.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds to run each measurement")
+    parser.add_argument("--size", type=int, default=100, help="items per list")
+    parser.add_argument("--drivers", type=int, default=500, help="recipients of the broadcast")
+    args = parser.parse_args()
+    main(args.min_time, args.size, args.drivers)
@@ -0,0 +1,712 @@
+"""Offline load test: mixed customer, driver and restaurant traffic against a local server.
+
+Run from the backend directory::
+
+    python -m benchmarks.loadtest --duration 60 --output baseline.json
+    python -m benchmarks.loadtest --duration 60 --compare baseline.json
+
+Install ``requirements-dev.txt`` first (httpx, websockets, mongomock-motor).
+By default ``server:app`` is started under uvicorn in a subprocess with an
+in-memory Mongo stand-in (mongomock-motor) and the fake payment gateway,
+so nothing external is needed. ``--mongo mongodb://localhost:27017`` uses
+a local mongod instead (a throwaway database, dropped afterwards), and
+``--url`` targets a server that is already running, e.g. several uvicorn
+workers with ``WS_BACKPLANE=mongo``. mongomock ignores indexes and scans
+every document on each query, so past a few hundred users it dominates
+the server's CPU time; use a real mongod for runs with thousands of
+clients.
+
+After registering the users and restaurants, every customer, driver and
+restaurant owner holds a WebSocket open, and for ``--duration`` seconds:
+
+- customers place orders at ``--order-rate`` per second and browse
+  restaurants, menus and their orders at ``--browse-rate`` per second;
+- drivers accept the offers pushed to them, restaurants prepare the food,
+  and the driver picks it up and delivers it;
+- every driver sends a location frame every ``--ping-interval`` seconds.
+
+Arrivals are open loop, so a slow server shows up as latency instead of
+as fewer requests. The report has p50/p95/p99 per endpoint, WebSocket
+delivery latency (from the request that caused a message to the message
+arriving, per recipient and message type), and event loop lag both on
+the server (from /api/admin/metrics) and in this process. If the load
+generator itself lags, its latencies are inflated. Location updates are
+coalesced by design, so some of them count as missed.
+
+``--output`` saves the report as JSON. ``--compare`` prints the change in
+p95/p99 against a saved report and exits non-zero when any of them grew
+by more than ``--threshold``.
+
+Needs ``httpx``, plus ``mongomock-motor`` for the in-memory database.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+import websockets
+
+from metrics import LoopLagMonitor, Registry
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+# The simulated city: everyone lives inside this lat/lng box
+CITY = (40.70, 40.78, -74.02, -73.94)
+
+# Server counters worth a line in the report, as deltas over the run
+SERVER_COUNTERS = (
+    "ws_messages_sent_total",
+    "ws_messages_dropped_total",
+    "ws_send_failures_total",
+    "outbox_tasks_total",
+    "order_assignments_total",
+    "event_loop_stalls_total",
+)
+
+
+def percentile(ordered: List[float], q: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered))) - 1))]
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "p50_ms": percentile(ordered, 50) * 1000,
+        "p95_ms": percentile(ordered, 95) * 1000,
+        "p99_ms": percentile(ordered, 99) * 1000,
+        "max_ms": (ordered[-1] if ordered else 0.0) * 1000,
+    }
+
+
+def random_point() -> Dict[str, float]:
+    return {"lat": round(random.uniform(CITY[0], CITY[1]), 6), "lng": round(random.uniform(CITY[2], CITY[3]), 6)}
+
+
+def raise_fd_limit():
+    # Every simulated client holds a socket
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+# Server process
+
+def exit_with_parent():
+    """Shut the server down if the load generator that started it dies."""
+    parent = os.getppid()
+
+    def watch():
+        while os.getppid() == parent:
+            time.sleep(1.0)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    threading.Thread(target=watch, daemon=True).start()
+
+
+def serve(port: int, mongo: str, payment_latency: float):
+    os.environ["PAYMENT_GATEWAY"] = "fake"
+    os.environ["FAKE_PAYMENT_LATENCY"] = str(payment_latency)
+    os.environ.setdefault("STRIPE_SECRET_KEY", "sk_test_loadtest")
+    os.environ.setdefault("DB_NAME", f"loadtest_{uuid.uuid4().hex[:8]}")
+    if mongo == "memory":
+        try:
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError:
+            raise SystemExit("--mongo memory needs mongomock-motor (pip install mongomock-motor)")
+        import motor.motor_asyncio
+        # server.py builds its client at import time
+        motor.motor_asyncio.AsyncIOMotorClient = AsyncMongoMockClient
+        os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    else:
+        os.environ["MONGO_URL"] = mongo
+
+    import uvicorn
+
+    raise_fd_limit()
+    exit_with_parent()
+    import server
+    logging.getLogger().setLevel(logging.WARNING)
+    uvicorn.run(server.app, host="127.0.0.1", port=port, log_level="warning", access_log=False)
+
+    if mongo != "memory":
+        from pymongo import MongoClient
+
+        MongoClient(mongo).drop_database(os.environ["DB_NAME"])
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_until_up(base_url: str, process: subprocess.Popen, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise SystemExit(f"Server exited during startup with code {process.returncode}")
+            try:
+                if (await client.get("/api/restaurants")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise SystemExit("Server did not come up in time")
+
+
+# Measurements
+
+class Recorder:
+    """Request latencies per endpoint and WebSocket delivery latencies per message kind.
+
+    A delivery is keyed by ``(recipient role, message type, ...ids)``. The
+    sender calls ``expect`` with the time it started the triggering request
+    and the reader calls ``received``; whichever comes second records the
+    latency, since a message can beat the HTTP response that caused it.
+    """
+
+    def __init__(self):
+        self.recording = False
+        self.requests: Dict[str, List[float]] = defaultdict(list)
+        self.rejected: Dict[str, int] = defaultdict(int)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.deliveries: Dict[str, List[float]] = defaultdict(list)
+        self.missed: Dict[str, int] = defaultdict(int)
+        self.expected: Dict[Tuple, float] = {}
+        self.arrived: Dict[Tuple, float] = {}
+
+    async def request(self, client: httpx.AsyncClient, name: str, method: str, url: str, **kwargs) -> Optional[httpx.Response]:
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            if self.recording:
+                self.errors[name] += 1
+            return None
+        if self.recording:
+            self.requests[name].append(time.perf_counter() - started)
+            if response.status_code >= 500:
+                self.errors[name] += 1
+            elif response.status_code >= 400:
+                self.rejected[name] += 1
+        return response
+
+    def expect(self, key: Tuple, sent_at: float):
+        arrived_at = self.arrived.pop(key, None)
+        if arrived_at is None:
+            self.expected[key] = sent_at
+        else:
+            self._delivered(key, arrived_at - sent_at)
+
+    def received(self, key: Tuple):
+        sent_at = self.expected.pop(key, None)
+        if sent_at is None:
+            self.arrived[key] = time.perf_counter()
+        else:
+            self._delivered(key, time.perf_counter() - sent_at)
+
+    def _delivered(self, key: Tuple, latency: float):
+        if self.recording:
+            self.deliveries[f"{key[0]}:{key[1]}"].append(latency)
+
+    def prune(self, max_age: float):
+        """Forget deliveries that never completed; expected ones count as missed."""
+        cutoff = time.perf_counter() - max_age
+        for key in [key for key, at in self.expected.items() if at < cutoff]:
+            del self.expected[key]
+            if self.recording:
+                self.missed[f"{key[0]}:{key[1]}"] += 1
+        for key in [key for key, at in self.arrived.items() if at < cutoff]:
+            del self.arrived[key]
+
+
+# Simulated users
+
+@dataclass
+class SimUser:
+    role: str
+    id: str
+    headers: Dict[str, str]
+    token: str
+    websocket: Any = None
+
+
+@dataclass
+class SimRestaurant:
+    id: str
+    owner: SimUser
+    menu: List[str] = field(default_factory=list)
+
+
+@dataclass
+class SimDriver(SimUser):
+    lat: float = 0.0
+    lng: float = 0.0
+    busy: bool = False
+    active_order: Optional[str] = None
+
+
+class Simulation:
+    def __init__(self, args, base_url: str):
+        self.args = args
+        self.base_url = base_url
+        self.ws_url = base_url.replace("http", "ws", 1)
+        self.run_id = uuid.uuid4().hex[:8]
+        self.recorder = Recorder()
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=30.0,
+            limits=httpx.Limits(max_connections=args.http_connections, max_keepalive_connections=args.http_connections),
+        )
+        self.customers: List[SimUser] = []
+        self.drivers: List[SimDriver] = []
+        self.restaurants: List[SimRestaurant] = []
+        self.admin: Optional[SimUser] = None
+        self.assignments: Dict[str, asyncio.Future] = {}
+        self.counts: Dict[str, int] = defaultdict(int)
+        self.tasks: set = set()
+        self.server_lag: List[float] = []
+        self.server_lag_max = 0.0
+        self.client_lag = LoopLagMonitor(Registry(), interval=0.1, window=1_000_000)
+
+    def spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def think(self, scale: float = 1.0):
+        await asyncio.sleep(random.expovariate(1 / (self.args.stage_delay * scale)))
+
+    # Setup
+
+    async def register(self, role: str, index: int, user_class=SimUser, **extra) -> SimUser:
+        response = await self.client.post("/api/auth/register", json={
+            "email": f"loadtest-{role}-{index}-{self.run_id}@example.com",
+            "name": f"{role.title()} {index}",
+            "phone": "+15550000000",
+            "user_type": role,
+            **extra,
+        })
+        response.raise_for_status()
+        data = response.json()
+        token = data["token"]
+        return user_class(role=role, id=data["user"]["id"], headers={"Authorization": f"Bearer {token}"}, token=token)
+
+    async def create_restaurant(self, index: int) -> SimRestaurant:
+        owner = await self.register("restaurant", index)
+        response = await self.client.post("/api/restaurants", headers=owner.headers, json={
+            "name": f"Load Test Kitchen {index}",
+            "description": "Pizza, pasta and salads",
+            "address": f"{index} Test Avenue",
+            "location": random_point(),
+            "cuisine_type": random.choice(["Italian", "American", "Mexican", "Thai"]),
+            "phone": "+15550000000",
+        })
+        response.raise_for_status()
+        restaurant = SimRestaurant(id=response.json()["id"], owner=owner)
+        for item in range(self.args.menu_items):
+            response = await self.client.post(f"/api/restaurants/{restaurant.id}/menu", headers=owner.headers, json={
+                "name": f"Dish {item}",
+                "description": "House special",
+                "price": round(random.uniform(12, 30), 2),
+                "category": random.choice(["starter", "main", "dessert"]),
+            })
+            response.raise_for_status()
+            restaurant.menu.append(response.json()["id"])
+        return restaurant
+
+    async def gather_limited(self, coroutines, limit: int = 50):
+        semaphore = asyncio.Semaphore(limit)
+
+        async def limited(coroutine):
+            async with semaphore:
+                return await coroutine
+
+        return await asyncio.gather(*(limited(c) for c in coroutines))
+
+    async def setup(self):
+        args = self.args
+        self.admin = await self.register("admin", 0)
+        self.restaurants = await self.gather_limited(self.create_restaurant(i) for i in range(args.restaurants))
+        self.customers = await self.gather_limited(self.register("customer", i) for i in range(args.customers))
+        self.drivers = await self.gather_limited(
+            self.register("driver", i, user_class=SimDriver, is_available=True) for i in range(args.drivers)
+        )
+        for driver in self.drivers:
+            driver.lat, driver.lng = random_point().values()
+        users = [restaurant.owner for restaurant in self.restaurants] + self.customers + self.drivers
+        await self.gather_limited((self.connect(user) for user in users), limit=100)
+
+    async def connect(self, user: SimUser):
+        user.websocket = await websockets.connect(
+            f"{self.ws_url}/ws/{user.role}_{user.id}?token={user.token}",
+            ping_interval=None,
+            open_timeout=60,
+            max_size=None,
+        )
+        self.spawn(self.read(user))
+        if isinstance(user, SimDriver):
+            # Drivers only get offers once the server knows where they are
+            await self.send_location(user)
+
+    # WebSocket clients
+
+    async def read(self, user: SimUser):
+        try:
+            async for raw in user.websocket:
+                self.on_message(user, json.loads(raw))
+        except websockets.ConnectionClosed:
+            self.counts["ws_closed"] += 1
+
+    def on_message(self, user: SimUser, message: Dict[str, Any]):
+        kind = message.get("type")
+        if user.role == "restaurant" and kind == "new_order":
+            self.recorder.received(("restaurant", kind, message["order"]["id"]))
+        elif user.role == "driver" and kind == "new_order":
+            order_id = message["order"]["id"]
+            self.recorder.received(("driver", kind, order_id))
+            if not user.busy:
+                user.busy = True
+                self.spawn(self.accept(user, order_id))
+        elif user.role == "customer":
+            if kind == "order_status_update":
+                self.recorder.received(("customer", kind, message["order_id"], message["status"]))
+            elif kind in ("driver_assigned", "payment_ready"):
+                self.recorder.received(("customer", kind, message["order_id"]))
+            elif kind == "driver_location_update":
+                location = message["location"]
+                self.recorder.received(("customer", kind, message["order_id"], location["lat"], location["lng"]))
+
+    async def send_location(self, driver: SimDriver):
+        driver.lat = min(max(driver.lat + random.gauss(0, 0.0005), CITY[0]), CITY[1])
+        driver.lng = min(max(driver.lng + random.gauss(0, 0.0005), CITY[2]), CITY[3])
+        lat, lng = round(driver.lat, 6), round(driver.lng, 6)
+        if driver.active_order is not None:
+            self.recorder.expect(("customer", "driver_location_update", driver.active_order, lat, lng), time.perf_counter())
+        await driver.websocket.send(json.dumps({"type": "location", "lat": lat, "lng": lng}))
+        self.counts["location_pings"] += 1
+
+    async def drive(self, driver: SimDriver):
+        interval = self.args.ping_interval
+        await asyncio.sleep(random.uniform(0, interval))
+        while True:
+            try:
+                await self.send_location(driver)
+            except websockets.ConnectionClosed:
+                return
+            await asyncio.sleep(interval * random.uniform(0.8, 1.2))
+
+    # Order lifecycle
+
+    async def accept(self, driver: SimDriver, order_id: str):
+        await asyncio.sleep(random.uniform(0.05, 0.3))  # reaction time
+        started = time.perf_counter()
+        response = await self.recorder.request(
+            self.client, "POST /orders/{id}/assign-driver", "POST", f"/api/orders/{order_id}/assign-driver",
+            headers=driver.headers,
+        )
+        if response is None or response.status_code != 200:
+            driver.busy = False
+            return
+        self.recorder.expect(("customer", "driver_assigned", order_id), started)
+        assigned = self.assignments.get(order_id)
+        if assigned is not None and not assigned.done():
+            assigned.set_result(driver)
+
+    async def transition(self, user: SimUser, order_id: str, status: str) -> bool:
+        started = time.perf_counter()
+        response = await self.recorder.request(
+            self.client, "PUT /orders/{id}/status", "PUT", f"/api/orders/{order_id}/status",
+            params={"status": status}, headers=user.headers,
+        )
+        if response is None or response.status_code != 200:
+            return False
+        self.recorder.expect(("customer", "order_status_update", order_id, status), started)
+        return True
+
+    async def place_order(self):
+        customer = random.choice(self.customers)
+        restaurant = random.choice(self.restaurants)
+        items = random.sample(restaurant.menu, k=random.randint(1, min(3, len(restaurant.menu))))
+        started = time.perf_counter()
+        response = await self.recorder.request(self.client, "POST /orders", "POST", "/api/orders", headers=customer.headers, json={
+            "restaurant_id": restaurant.id,
+            "items": [{"menu_item_id": item, "quantity": random.randint(1, 3)} for item in items],
+            "delivery_address": "1 Load Test Street",
+            "delivery_location": random_point(),
+        })
+        if response is None or response.status_code != 200:
+            return
+        order_id = response.json()["order"]["id"]
+        self.counts["orders_placed"] += 1
+        for key in (("restaurant", "new_order", order_id), ("driver", "new_order", order_id),
+                    ("customer", "payment_ready", order_id)):
+            self.recorder.expect(key, started)
+
+        assigned = asyncio.get_running_loop().create_future()
+        self.assignments[order_id] = assigned
+        try:
+            driver = await asyncio.wait_for(assigned, timeout=self.args.assign_timeout)
+        except asyncio.TimeoutError:
+            self.counts["orders_unassigned"] += 1
+            await self.transition(restaurant.owner, order_id, "cancelled")
+            return
+        finally:
+            self.assignments.pop(order_id, None)
+
+        try:
+            for status in ("preparing", "ready"):
+                await self.think()
+                if not await self.transition(restaurant.owner, order_id, status):
+                    return
+            await self.think()
+            if not await self.transition(driver, order_id, "picked_up"):
+                return
+            driver.active_order = order_id
+            await self.think(scale=3)
+            if await self.transition(driver, order_id, "delivered"):
+                self.counts["orders_delivered"] += 1
+        finally:
+            driver.active_order = None
+            driver.busy = False
+
+    async def browse(self):
+        customer = random.choice(self.customers)
+        choice = random.random()
+        if choice < 0.4:
+            await self.recorder.request(self.client, "GET /restaurants", "GET", "/api/restaurants")
+        elif choice < 0.8:
+            restaurant = random.choice(self.restaurants)
+            await self.recorder.request(
+                self.client, "GET /restaurants/{id}/menu", "GET", f"/api/restaurants/{restaurant.id}/menu"
+            )
+        else:
+            await self.recorder.request(self.client, "GET /orders", "GET", "/api/orders", headers=customer.headers)
+
+    async def arrivals(self, rate: float, action):
+        """Start ``action`` as a Poisson process, on schedule even if earlier ones are still running."""
+        if rate <= 0:
+            return
+        next_at = time.perf_counter()
+        while True:
+            next_at += random.expovariate(rate)
+            await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+            self.spawn(action())
+
+    # Server side
+
+    async def server_metrics(self) -> Dict[str, Dict[str, float]]:
+        response = await self.client.get("/api/admin/metrics", headers=self.admin.headers)
+        response.raise_for_status()
+        return response.json()
+
+    async def sample_server(self):
+        while True:
+            await asyncio.sleep(1.0)
+            self.recorder.prune(max_age=max(30.0, self.args.assign_timeout * 2))
+            try:
+                metrics = await self.server_metrics()
+            except httpx.HTTPError:
+                continue
+            self.server_lag.append(metrics.get("event_loop_lag_seconds", {}).get("", 0.0))
+            self.server_lag_max = max(self.server_lag_max, metrics.get("event_loop_lag_max_seconds", {}).get("", 0.0))
+
+    # Run
+
+    async def run(self) -> Dict[str, Any]:
+        args = self.args
+        setup_started = time.perf_counter()
+        await self.setup()
+        setup_seconds = time.perf_counter() - setup_started
+        print(f"Setup: {len(self.customers)} customers, {len(self.drivers)} drivers, "
+              f"{len(self.restaurants)} restaurants connected in {setup_seconds:.1f}s", file=sys.stderr)
+
+        before = await self.server_metrics()
+        self.recorder.recording = True
+        self.client_lag.start()
+        started = time.perf_counter()
+        loops = [
+            self.arrivals(args.order_rate, self.place_order),
+            self.arrivals(args.browse_rate, self.browse),
+            self.sample_server(),
+            *(self.drive(driver) for driver in self.drivers),
+        ]
+        runners = [asyncio.create_task(loop) for loop in loops]
+        await asyncio.sleep(args.duration)
+        self.recorder.recording = False
+        elapsed = time.perf_counter() - started
+        await self.client_lag.close()
+        after = await self.server_metrics()
+
+        for task in runners + list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*runners, *self.tasks, return_exceptions=True)
+        users = [restaurant.owner for restaurant in self.restaurants] + self.customers + self.drivers
+        await asyncio.gather(*(user.websocket.close() for user in users if user.websocket), return_exceptions=True)
+        await self.client.aclose()
+        return self.report(elapsed, before, after)
+
+    def report(self, elapsed: float, before, after) -> Dict[str, Any]:
+        recorder = self.recorder
+        endpoints = {}
+        for name, samples in sorted(recorder.requests.items()):
+            endpoints[name] = {
+                **summarize(samples), "rejected": recorder.rejected[name], "errors": recorder.errors[name],
+                "per_second": len(samples) / elapsed,
+            }
+        deliveries = {
+            kind: {**summarize(samples), "missed": recorder.missed[kind]}
+            for kind, samples in sorted(recorder.deliveries.items())
+        }
+
+        def counter_delta(name):
+            old = before.get(name, {})
+            return {labels or "total": value - old.get(labels, 0) for labels, value in after.get(name, {}).items()
+                    if value - old.get(labels, 0)}
+
+        return {
+            "config": {name: value for name, value in vars(self.args).items() if name not in ("compare", "output", "serve")},
+            "duration_seconds": elapsed,
+            "counts": dict(self.counts, ws_clients=len(self.customers) + len(self.drivers) + len(self.restaurants)),
+            "endpoints": endpoints,
+            "deliveries": deliveries,
+            "loop_lag": {
+                "server": {**summarize(self.server_lag), "max_ms": self.server_lag_max * 1000},
+                "load_generator": summarize(list(self.client_lag.samples)),
+            },
+            "server_counters": {name: counter_delta(name) for name in SERVER_COUNTERS},
+        }
+
+
+# Output
+
+def print_table(title: str, rows: Dict[str, Dict[str, float]], extra: Tuple[str, ...] = ()):
+    print(f"\n{title:<34} {'count':>7} " + " ".join(f"{name:>8}" for name in extra) +
+          f" {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for name, row in rows.items():
+        print(f"{name:<34} {row['count']:>7} " + " ".join(f"{row[name]:>8}" for name in extra) +
+              f" {row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f} {row['p99_ms']:>8.1f} {row['max_ms']:>8.1f}")
+
+
+def print_report(report: Dict[str, Any]):
+    print(f"Ran {report['duration_seconds']:.1f}s: " + ", ".join(f"{name} {value}" for name, value in sorted(report["counts"].items())))
+    print_table("endpoint", report["endpoints"], extra=("rejected", "errors"))
+    print_table("websocket delivery", report["deliveries"], extra=("missed",))
+    print_table("event loop lag", report["loop_lag"])
+    print("\nserver counters over the run:")
+    for name, values in report["server_counters"].items():
+        if values:
+            print(f"  {name}: " + ", ".join(f"{labels} {value:g}" for labels, value in sorted(values.items())))
+
+
+# A percentile is only compared when enough samples lie beyond it to make
+# it more than the single slowest request
+MIN_SAMPLES = {"p95_ms": 20, "p99_ms": 100}
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], threshold: float, noise_ms: float = 1.0) -> List[str]:
+    """Print p95/p99 changes against ``baseline``; returns the regressions."""
+    regressions = []
+    print(f"\n{'compared to baseline':<46} {'before':>8} {'after':>8} {'change':>8}")
+    sections = [("endpoints", report["endpoints"]), ("deliveries", report["deliveries"]),
+                ("loop_lag", {"server": report["loop_lag"]["server"]})]
+    for section, rows in sections:
+        for name, row in rows.items():
+            old = baseline.get(section, {}).get(name)
+            if not old:
+                continue
+            for stat, min_samples in MIN_SAMPLES.items():
+                if min(row["count"], old["count"]) < min_samples:
+                    continue
+                before, after = old[stat], row[stat]
+                change = (after - before) / before if before else 0.0
+                regressed = after > before * (1 + threshold) and after - before > noise_ms
+                label = f"{name} {stat[:3]}"
+                print(f"{label:<46} {before:>8.1f} {after:>8.1f} {change:>+7.0%}" + ("  REGRESSION" if regressed else ""))
+                if regressed:
+                    regressions.append(label)
+    return regressions
+
+
+async def main(args) -> int:
+    raise_fd_limit()
+    process = None
+    base_url = args.url
+    if base_url is None:
+        port = free_port()
+        process = subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.loadtest", "--serve", "--port", str(port), "--mongo", args.mongo,
+             "--payment-latency", str(args.payment_latency)],
+            cwd=BACKEND_DIR,
+        )
+        base_url = f"http://127.0.0.1:{port}"
+    try:
+        if process is not None:
+            await wait_until_up(base_url, process)
+        report = await Simulation(args, base_url.rstrip("/")).run()
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+
+    print_report(report)
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) above {args.threshold:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="target an already running server instead of starting one")
+    parser.add_argument("--mongo", default="memory", help='"memory" for mongomock, or a mongodb:// URL')
+    parser.add_argument("--payment-latency", type=float, default=0.3, help="simulated payment provider round trip")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of measured traffic")
+    parser.add_argument("--customers", type=int, default=300)
+    parser.add_argument("--drivers", type=int, default=100)
+    parser.add_argument("--restaurants", type=int, default=20)
+    parser.add_argument("--menu-items", type=int, default=5, help="menu items per restaurant")
+    parser.add_argument("--order-rate", type=float, default=5.0, help="orders per second")
+    parser.add_argument("--browse-rate", type=float, default=20.0, help="browsing requests per second")
+    parser.add_argument("--ping-interval", type=float, default=4.0, help="seconds between driver location frames")
+    parser.add_argument("--stage-delay", type=float, default=1.0, help="mean seconds between order status changes")
+    parser.add_argument("--assign-timeout", type=float, default=20.0, help="cancel orders no driver accepted by then")
+    parser.add_argument("--http-connections", type=int, default=200, help="HTTP connection pool size")
+    parser.add_argument("--seed", type=int, help="random seed, for repeatable traffic")
+    parser.add_argument("--output", help="write the report as JSON")
+    parser.add_argument("--compare", help="JSON report of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative p95/p99 growth that counts as a regression")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, default=8001, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+    if args.serve:
+        serve(args.port, args.mongo, args.payment_latency)
+    else:
+        sys.exit(asyncio.run(main(args)))
@@ -0,0 +1,130 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Set, Tuple
+
+from metrics import REGISTRY
+
+cache_requests = REGISTRY.counter("cache_requests_total", "Cache lookups by cache name and result")
+
+
+class TTLCache:
+    """Size- and TTL-bounded LRU cache for a single worker.
+
+    Loads that race with an invalidation are discarded: take ``generation``
+    before reading from the database and pass it to ``set``, and the value is
+    only stored if that key was not invalidated in between.
+    """
+
+    def __init__(self, name: str, maxsize: int = 10000, ttl: float = 60.0, clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key -> (expires_at, value)
+        self.generation = 0
+        # Generation of the latest invalidation per key, bounded like the
+        # entries; anything older than ``invalidation_floor`` was forgotten.
+        self.invalidations: "OrderedDict[Hashable, int]" = OrderedDict()
+        self.invalidation_floor = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > self.clock():
+                self.entries.move_to_end(key)
+                cache_requests.inc(cache=self.name, result="hit")
+                return entry[1]
+            del self.entries[key]
+        cache_requests.inc(cache=self.name, result="miss")
+        return None
+
+    def set(self, key: Hashable, value: Any, generation: Optional[int] = None):
+        if generation is not None and (
+            generation < self.invalidation_floor or self.invalidations.get(key, -1) > generation
+        ):
+            return
+        self.entries[key] = (self.clock() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        self.generation += 1
+        self.entries.pop(key, None)
+        self.invalidations[key] = self.generation
+        self.invalidations.move_to_end(key)
+        while len(self.invalidations) > self.maxsize:
+            _, forgotten = self.invalidations.popitem(last=False)
+            self.invalidation_floor = forgotten
+
+    def clear(self):
+        self.generation += 1
+        self.entries.clear()
+        self.invalidations.clear()
+        self.invalidation_floor = self.generation
+
+
+class ResponseCache:
+    """Read-through cache of rendered JSON response bodies with ETags.
+
+    Entries are grouped under tags (e.g. ``"restaurants"`` or
+    ``"menu:<restaurant id>"``); writes invalidate a whole tag. Concurrent
+    misses for the same key share a single load.
+    """
+
+    def __init__(self, name: str, maxsize: int = 5000, ttl: float = 60.0):
+        self.entries = TTLCache(name, maxsize=maxsize, ttl=ttl)
+        self.tag_keys: Dict[str, Set[Hashable]] = {}
+        self.tag_generations: Dict[str, int] = {}
+        self.inflight: Dict[Hashable, asyncio.Future] = {}
+
+    def invalidate(self, tag: str):
+        self.tag_generations[tag] = self.tag_generations.get(tag, 0) + 1
+        for key in self.tag_keys.pop(tag, ()):
+            self.entries.invalidate(key)
+
+    async def get(
+        self, tag: str, key: Hashable, load: Callable[[], Awaitable[Tuple[bytes, Dict[str, str]]]]
+    ) -> Tuple[bytes, str, Dict[str, str]]:
+        """Return ``(body, etag, headers)`` for ``key``, calling ``load`` on a miss.
+
+        ``load`` returns the rendered body and any headers to cache with it.
+        """
+        cache_key = (tag, key)
+        entry = self.entries.get(cache_key)
+        if entry is not None:
+            return entry
+        pending = self.inflight.get(cache_key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[cache_key] = future
+        tag_generation = self.tag_generations.get(tag, 0)
+        try:
+            body, headers = await load()
+            entry = (body, '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"', headers)
+            if self.tag_generations.get(tag, 0) == tag_generation:
+                self.entries.set(cache_key, entry)
+                keys = self.tag_keys.setdefault(tag, set())
+                keys.add(cache_key)
+                if len(keys) > self.entries.maxsize:
+                    # Forget keys the LRU already evicted
+                    keys.intersection_update(self.entries.entries)
+            future.set_result(entry)
+            return entry
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Waiters retrieve it; don't warn about an unobserved exception
+            future.exception()
+            raise
+        finally:
+            del self.inflight[cache_key]
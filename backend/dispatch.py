@@ -0,0 +1,122 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from geo import GeoGridIndex
+
+logger = logging.getLogger(__name__)
+
+
+class OrderDispatcher:
+    """Offers new orders to the nearest available drivers, widening in rings.
+
+    Each dispatched order gets a background task that offers it to the ``k``
+    closest drivers within ``initial_radius_km`` of the restaurant, waits
+    ``ring_timeout`` seconds for someone to accept, then grows the radius by
+    ``radius_growth`` and offers it to the next closest drivers, up to
+    ``max_radius_km``. If no driver with a known position was found at all,
+    the order falls back to ``broadcast`` so it is never silently dropped.
+    The drivers an order was offered to are remembered until it is accepted
+    or for ``forget_after`` seconds once its offers have all gone out.
+    """
+
+    def __init__(
+        self,
+        index: GeoGridIndex,
+        send: Callable[[str, Dict[str, Any]], Awaitable[None]],
+        broadcast: Callable[[Dict[str, Any]], Awaitable[None]],
+        is_available: Optional[Callable[[str], bool]] = None,
+        k: int = 10,
+        initial_radius_km: float = 3.0,
+        radius_growth: float = 2.0,
+        max_radius_km: float = 24.0,
+        ring_timeout: float = 20.0,
+        max_location_age: float = 300.0,
+        forget_after: float = 1800.0,
+    ):
+        self.index = index
+        self.send = send
+        self.broadcast = broadcast
+        self.is_available = is_available
+        self.k = k
+        self.initial_radius_km = initial_radius_km
+        self.radius_growth = radius_growth
+        self.max_radius_km = max_radius_km
+        self.ring_timeout = ring_timeout
+        self.max_location_age = max_location_age
+        self.forget_after = forget_after
+        self.offers: Dict[str, Set[str]] = {}
+        self._accepted: Dict[str, asyncio.Event] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def dispatch(self, order_id: str, location: Dict[str, float], message: Dict[str, Any]):
+        """Start offering ``order_id`` to drivers around ``location`` in the background."""
+        offered = self.offers[order_id] = set()
+        accepted = self._accepted[order_id] = asyncio.Event()
+        # The order may be accepted before the task first runs, so it gets
+        # its own references rather than looking them up later
+        task = asyncio.create_task(self._run(order_id, location, message, offered, accepted))
+        self._tasks[order_id] = task
+        task.add_done_callback(lambda _: self._finished(order_id, offered, accepted))
+
+    def accept(self, order_id: str) -> Set[str]:
+        """Stop dispatching ``order_id`` and return the drivers it was offered to."""
+        event = self._accepted.pop(order_id, None)
+        if event is not None:
+            event.set()
+        return self.offers.pop(order_id, set())
+
+    def _finished(self, order_id: str, offered: Set[str], accepted: asyncio.Event):
+        self._tasks.pop(order_id, None)
+        # A redispatched order has replaced these entries with its own
+        if self._accepted.get(order_id) is accepted:
+            del self._accepted[order_id]
+        # Kept a while so a late accept still withdraws the other offers
+        asyncio.get_running_loop().call_later(self.forget_after, self._forget, order_id, offered)
+
+    def _forget(self, order_id: str, offered: Set[str]):
+        if self.offers.get(order_id) is offered:
+            del self.offers[order_id]
+
+    async def close(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(
+        self, order_id: str, location: Dict[str, float], message: Dict[str, Any], offered: Set[str], accepted: asyncio.Event
+    ):
+        radius = self.initial_radius_km
+        try:
+            while not accepted.is_set():
+                candidates = self.index.nearest(
+                    location["lat"],
+                    location["lng"],
+                    self.k,
+                    radius,
+                    max_age=self.max_location_age,
+                    predicate=lambda driver_id: driver_id not in offered and (
+                        self.is_available is None or self.is_available(driver_id)
+                    ),
+                )
+                for _, driver_id in candidates:
+                    offered.add(driver_id)
+                    await self.send(driver_id, message)
+
+                if radius >= self.max_radius_km:
+                    break
+                if candidates:
+                    try:
+                        await asyncio.wait_for(accepted.wait(), timeout=self.ring_timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                radius = min(radius * self.radius_growth, self.max_radius_km)
+
+            if not offered and not accepted.is_set():
+                logger.info("No located drivers near order %s, broadcasting", order_id)
+                await self.broadcast(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Dispatch failed for order %s", order_id)
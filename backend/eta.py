@@ -0,0 +1,339 @@
+import asyncio
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from geo import haversine_km_array
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+recompute_seconds = REGISTRY.histogram("eta_recompute_seconds", "Time to recompute the ETA of every active order")
+etas_pushed = REGISTRY.counter("eta_updates_pushed_total", "Changed ETAs pushed to customers")
+
+Location = Dict[str, float]
+
+# Statuses whose ETA still moves, in lifecycle order; the index is the stage
+ACTIVE_STATUSES = ("pending", "confirmed", "preparing", "ready", "picked_up")
+PENDING, CONFIRMED, PREPARING, READY, PICKED_UP = range(len(ACTIVE_STATUSES))
+STAGES = {status: stage for stage, status in enumerate(ACTIVE_STATUSES)}
+
+# Average driving speed in km/h by hour of day, slowest at lunch and dinner
+SPEED_PROFILE_KMH = (
+    28, 30, 30, 30, 30, 28, 24, 20, 18, 20, 22, 20,
+    17, 18, 21, 22, 20, 17, 16, 17, 20, 23, 25, 27,
+)
+ROAD_FACTOR = 1.3  # road kilometres per straight-line kilometre
+QUEUE_MINUTES_PER_ORDER = 4.0  # kitchen delay per order already being prepared
+DEFAULT_PREPARATION_MINUTES = 15.0  # orders placed before the cart's prep time was kept
+MIN_REMAINING_PREPARATION_MINUTES = 2.0  # a preparing order past its prep time is nearly done, not done
+UNASSIGNED_PICKUP_MINUTES = 8.0  # for a driver to reach the restaurant when none is located yet
+HANDOFF_MINUTES = 2.0  # at the counter and again at the door
+
+# Lateness of past deliveries against their estimate, per restaurant. The
+# average is shrunk towards zero as if HISTORY_PRIOR_ORDERS more orders had
+# been on time, so a restaurant with a handful of orders barely moves.
+HISTORY_WINDOW = timedelta(days=7)
+HISTORY_PRIOR_ORDERS = 10
+MAX_CORRECTION_MINUTES = 30.0
+
+# The refresh lease document, and how many intervals it outlives its last renewal
+LEASE_ID = "eta_refresh"
+LEASE_INTERVALS = 3
+
+ORDER_PROJECTION = {
+    "_id": 0, "id": 1, "status": 1, "customer_id": 1, "restaurant_id": 1, "driver_id": 1,
+    "delivery_location": 1, "created_at": 1, "updated_at": 1, "estimated_delivery_time": 1, "eta": 1, "version": 1,
+}
+
+
+def baseline_minutes(
+    stage: np.ndarray,
+    preparation: np.ndarray,
+    stage_elapsed: np.ndarray,
+    queue_depth: np.ndarray,
+    pickup_km: np.ndarray,
+    delivery_km: np.ndarray,
+    remaining_km: np.ndarray,
+    speed_kmh: float,
+) -> np.ndarray:
+    """Minutes until delivery for each order, before any history correction.
+
+    ``stage_elapsed`` is the minutes since the order entered its status and
+    ``queue_depth`` the other orders being prepared at its restaurant.
+    ``pickup_km`` (driver to restaurant) and ``remaining_km`` (driver to
+    customer) are NaN for orders without a located driver; ``delivery_km``
+    is restaurant to customer.
+    """
+    minutes_per_km = ROAD_FACTOR * 60.0 / speed_kmh
+    kitchen = np.where(stage <= CONFIRMED, queue_depth * QUEUE_MINUTES_PER_ORDER + preparation, 0.0)
+    kitchen = np.where(
+        stage == PREPARING, np.maximum(preparation - stage_elapsed, MIN_REMAINING_PREPARATION_MINUTES), kitchen
+    )
+    pickup = np.where(np.isnan(pickup_km), UNASSIGNED_PICKUP_MINUTES, pickup_km * minutes_per_km)
+    from_restaurant = np.maximum(kitchen, pickup) + HANDOFF_MINUTES + delivery_km * minutes_per_km
+    on_the_way = np.where(np.isnan(remaining_km), delivery_km, remaining_km) * minutes_per_km
+    return np.where(stage == PICKED_UP, on_the_way, from_restaurant) + HANDOFF_MINUTES
+
+
+class ETAEngine:
+    """Estimates delivery times and keeps the ETAs of active orders current.
+
+    An estimate is the kitchen time (the slowest item in the cart, behind
+    the restaurant's queue of orders being prepared), or the driver's ride
+    to the restaurant if that is longer, then the ride to the customer at
+    the hour's average speed. A per-restaurant correction learned from how
+    late past deliveries were is added, shrinking as the order gets closer.
+
+    Every ``interval`` seconds one worker, whichever holds the refresh
+    lease, streams the active orders and recomputes their ETAs
+    ``batch_size`` orders at a time, each batch in one vectorized pass. An
+    ETA that moved by ``push_threshold`` minutes or more is saved on the
+    order as a versioned change (``versioned`` builds the update,
+    ``record_delta`` logs the delta for clients catching up) and pushed to
+    the customer. A batch is saved with one bulk write, compare-and-set on
+    the version read, so an order changed meanwhile keeps its ETA until the
+    next refresh. ``is_local``, when given, skips the push to customers
+    without a socket on this worker. Every worker reloads the kitchen queue
+    depths its quotes use.
+    """
+
+    def __init__(
+        self,
+        db,
+        locate_restaurant: Callable[[str], Optional[Tuple[float, float]]],
+        driver_position: Callable[[str], Optional[Location]],
+        notify: Callable[[dict, str], Awaitable[None]],
+        versioned: Callable[[dict], dict],
+        record_delta: Callable[[dict, dict, int], dict],
+        is_local: Optional[Callable[[str], bool]] = None,
+        interval: float = 15.0,
+        push_threshold: float = 2.0,
+        history_interval: float = 600.0,
+        speed_profile: Sequence[float] = SPEED_PROFILE_KMH,
+        utc_offset_hours: float = 0.0,
+        batch_size: int = 1000,
+    ):
+        self.db = db
+        self.locate_restaurant = locate_restaurant
+        self.driver_position = driver_position
+        self.notify = notify
+        self.versioned = versioned
+        self.record_delta = record_delta
+        self.is_local = is_local
+        self.interval = interval
+        self.push_threshold = push_threshold
+        self.history_interval = history_interval
+        self.speed_profile = np.asarray(speed_profile, dtype=float)
+        self.utc_offset = timedelta(hours=utc_offset_hours)
+        self.batch_size = batch_size
+        self.holder = uuid.uuid4().hex
+        # restaurant id -> minutes to add, and orders being prepared as of the last refresh
+        self.corrections: Dict[str, float] = {}
+        self.queue_depths: Dict[str, int] = {}
+        self._history_loaded_at: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def speed_kmh(self, now: datetime) -> float:
+        return float(self.speed_profile[(now + self.utc_offset).hour])
+
+    def quote(
+        self, restaurant_id: str, restaurant_location: Location, delivery_location: Location,
+        preparation_minutes: float, now: datetime,
+    ) -> Tuple[datetime, datetime]:
+        """ETA of an order about to be placed, and the same estimate without the history correction."""
+        delivery_km = haversine_km_array(
+            restaurant_location["lat"], restaurant_location["lng"], delivery_location["lat"], delivery_location["lng"]
+        )
+        minutes = float(baseline_minutes(
+            np.array([PENDING]), np.array([float(preparation_minutes)]), np.zeros(1),
+            np.array([self.queue_depths.get(restaurant_id, 0)]), np.array([np.nan]),
+            np.atleast_1d(delivery_km), np.array([np.nan]), self.speed_kmh(now),
+        )[0])
+        baseline = now + timedelta(minutes=minutes)
+        return baseline + timedelta(minutes=self.corrections.get(restaurant_id, 0.0)), baseline
+
+    def estimate(
+        self, orders: List[Dict[str, Any]], now: datetime, queue_depths: Optional[Dict[str, int]] = None
+    ) -> np.ndarray:
+        """Minutes from ``now`` until each order is delivered; NaN where it cannot be estimated.
+
+        Kitchen queues are counted from ``orders`` unless ``queue_depths``
+        (orders being prepared per restaurant) is given.
+        """
+        # Gathered into lists and converted once; per-element array writes cost more than the math
+        stages, preparation, stage_elapsed, placed_minutes, restaurant_codes, corrections, coordinates = (
+            [], [], [], [], [], [], []
+        )
+        codes: Dict[str, int] = {}
+        nowhere = (np.nan, np.nan)
+        for order in orders:
+            stages.append(STAGES[order["status"]])
+            eta = order.get("eta") or {}
+            preparation.append(eta.get("preparation_minutes", DEFAULT_PREPARATION_MINUTES))
+            baseline = eta.get("baseline")
+            placed_minutes.append((baseline - order["created_at"]).total_seconds() / 60 if baseline else np.nan)
+            stage_elapsed.append((now - order.get("updated_at", order["created_at"])).total_seconds() / 60)
+            restaurant_id = order["restaurant_id"]
+            restaurant_codes.append(codes.setdefault(restaurant_id, len(codes)))
+            corrections.append(self.corrections.get(restaurant_id, 0.0))
+            location = order.get("delivery_location") or {}
+            driver = self.driver_position(order["driver_id"]) if order.get("driver_id") else None
+            coordinates.append((
+                *(self.locate_restaurant(restaurant_id) or nowhere),
+                location.get("lat", np.nan), location.get("lng", np.nan),
+                *((driver["lat"], driver["lng"]) if driver else nowhere),
+            ))
+        stage = np.array(stages, dtype=np.int8)
+        restaurant_code = np.array(restaurant_codes, dtype=np.int64)
+        placed_minutes = np.array(placed_minutes, dtype=float)
+        coordinates = np.array(coordinates, dtype=float).reshape(-1, 6)  # restaurant, customer, driver lat/lng
+
+        # Orders being prepared at each restaurant, not counting the order itself
+        preparing = stage == PREPARING
+        if queue_depths is None:
+            depth = np.bincount(restaurant_code, weights=preparing, minlength=len(codes))
+            self.queue_depths = {restaurant_id: int(depth[code]) for restaurant_id, code in codes.items() if depth[code]}
+        else:
+            depth = np.array([queue_depths.get(restaurant_id, 0) for restaurant_id in codes], dtype=float)
+        queue_depth = depth[restaurant_code] - preparing
+
+        restaurant, customer, driver = coordinates[:, 0:2], coordinates[:, 2:4], coordinates[:, 4:6]
+        minutes = baseline_minutes(
+            stage, np.array(preparation, dtype=float), np.array(stage_elapsed, dtype=float), queue_depth,
+            pickup_km=haversine_km_array(driver[:, 0], driver[:, 1], restaurant[:, 0], restaurant[:, 1]),
+            delivery_km=haversine_km_array(restaurant[:, 0], restaurant[:, 1], customer[:, 0], customer[:, 1]),
+            remaining_km=haversine_km_array(driver[:, 0], driver[:, 1], customer[:, 0], customer[:, 1]),
+            speed_kmh=self.speed_kmh(now),
+        )
+        # Spread the correction over the trip: all of it at placement, none at the door
+        share = np.where(np.isnan(placed_minutes), 1.0, np.clip(minutes / np.fmax(placed_minutes, 1.0), 0.0, 1.0))
+        return np.maximum(minutes + np.array(corrections) * share, 1.0)
+
+    async def refresh(self, now: Optional[datetime] = None) -> int:
+        """Recompute every active order's ETA; save and push the ones that moved. Returns how many were saved.
+
+        Only the worker holding the refresh lease does this; the others just
+        reload the queue depths and return 0.
+        """
+        now = now or datetime.utcnow()
+        self.queue_depths = await self.load_queue_depths()
+        if not await self._hold_lease(now):
+            return 0
+
+        saved = 0
+        batch: List[Dict[str, Any]] = []
+        async for order in self.db.orders.find({"status": {"$in": list(ACTIVE_STATUSES)}}, ORDER_PROJECTION):
+            batch.append(order)
+            if len(batch) == self.batch_size:
+                saved += await self._refresh_batch(batch, now)
+                batch = []
+        if batch:
+            saved += await self._refresh_batch(batch, now)
+        return saved
+
+    async def _refresh_batch(self, orders: List[Dict[str, Any]], now: datetime) -> int:
+        started = time.perf_counter()
+        minutes = self.estimate(orders, now, self.queue_depths)
+        previous = np.array([
+            (order["estimated_delivery_time"] - now).total_seconds() / 60 if order.get("estimated_delivery_time") else np.nan
+            for order in orders
+        ])
+        moved = np.flatnonzero(~np.isnan(minutes) & ~(np.abs(minutes - previous) < self.push_threshold))
+        recompute_seconds.observe(time.perf_counter() - started)
+        if not moved.size:
+            return 0
+
+        changed = []
+        for i in moved:
+            estimated = (now + timedelta(minutes=float(minutes[i]))).replace(microsecond=0)
+            changed.append((orders[i], float(minutes[i]), self.versioned({"$set": {"estimated_delivery_time": estimated}})))
+        # Only orders still as read; one changed meanwhile is estimated again next time
+        result = await self.db.orders.bulk_write([
+            UpdateOne({"id": order["id"], "version": order.get("version")}, update) for order, _, update in changed
+        ], ordered=False)
+        if result.modified_count < len(changed):
+            seqs = [update["$set"]["seq"] for _, _, update in changed]
+            applied = {
+                order["id"]
+                for order in await self.db.orders.find({"seq": {"$in": seqs}}, {"_id": 0, "id": 1}).to_list(None)
+            }
+            changed = [entry for entry in changed if entry[0]["id"] in applied]
+
+        for order, order_minutes, update in changed:
+            delta = self.record_delta(order, update["$set"], order.get("version", 0) + 1)
+            if self.is_local is None or self.is_local(order["customer_id"]):
+                await self.notify({
+                    "type": "eta_update",
+                    "order_id": order["id"],
+                    "estimated_delivery_time": update["$set"]["estimated_delivery_time"],
+                    "minutes": int(round(order_minutes)),
+                    **delta,
+                }, order["customer_id"])
+                etas_pushed.inc()
+        return len(changed)
+
+    async def load_queue_depths(self) -> Dict[str, int]:
+        """Orders being prepared per restaurant."""
+        pipeline = [
+            {"$match": {"status": "preparing"}},
+            {"$group": {"_id": "$restaurant_id", "orders": {"$sum": 1}}},
+        ]
+        return {row["_id"]: row["orders"] async for row in self.db.orders.aggregate(pipeline)}
+
+    async def _hold_lease(self, now: datetime) -> bool:
+        # Taken over once the holder has missed a few refreshes
+        try:
+            await self.db.leases.find_one_and_update(
+                {"_id": LEASE_ID, "$or": [{"holder": self.holder}, {"expires_at": {"$lte": now}}]},
+                {"$set": {"holder": self.holder, "expires_at": now + timedelta(seconds=self.interval * LEASE_INTERVALS)}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # Held by a live worker: the upsert collided with its lease
+            return False
+        return True
+
+    async def load_history(self, now: Optional[datetime] = None):
+        """Recompute per-restaurant corrections from recent deliveries."""
+        now = now or datetime.utcnow()
+        pipeline = [
+            {"$match": {"status": "delivered", "created_at": {"$gte": now - HISTORY_WINDOW}, "eta.baseline": {"$ne": None}}},
+            {"$group": {
+                "_id": "$restaurant_id",
+                "late_ms": {"$sum": {"$subtract": ["$actual_delivery_time", "$eta.baseline"]}},
+                "orders": {"$sum": 1},
+            }},
+        ]
+        corrections = {}
+        async for row in self.db.orders.aggregate(pipeline):
+            minutes = row["late_ms"] / 60000 / (row["orders"] + HISTORY_PRIOR_ORDERS)
+            corrections[row["_id"]] = float(np.clip(minutes, -MAX_CORRECTION_MINUTES, MAX_CORRECTION_MINUTES))
+        self.corrections = corrections
+        self._history_loaded_at = time.monotonic()
+
+    async def _run(self):
+        while True:
+            try:
+                if self._history_loaded_at is None or time.monotonic() - self._history_loaded_at >= self.history_interval:
+                    await self.load_history()
+                await self.refresh()
+            except Exception:
+                logger.exception("Refreshing ETAs failed")
+            await asyncio.sleep(self.interval)
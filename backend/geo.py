@@ -0,0 +1,134 @@
+import heapq
+import math
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE_LAT = 111.32
+
+
+def haversine_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Great-circle distance between two points in kilometres."""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def haversine_km_array(lat1, lng1, lat2, lng2) -> np.ndarray:
+    """``haversine_km`` over NumPy arrays (or scalars), broadcasting like any ufunc."""
+    phi1 = np.radians(lat1)
+    phi2 = np.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = np.radians(np.subtract(lng2, lng1))
+    a = np.sin(dphi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class GeoGridIndex:
+    """In-process spatial index of points bucketed into a fixed lat/lng grid.
+
+    Each point lives in exactly one cell, so an upsert is O(1) and a radius
+    query only visits the cells overlapping the search box. Good enough for
+    city-scale fleets where the number of points per cell stays small.
+    """
+
+    def __init__(self, cell_size_km: float = 1.0):
+        self.cell_deg = cell_size_km / KM_PER_DEGREE_LAT
+        self.points: Dict[str, Tuple[float, float, float]] = {}  # id -> (lat, lng, updated_at)
+        self.cells: Dict[Tuple[int, int], Set[str]] = {}
+        self._cell_of: Dict[str, Tuple[int, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def __contains__(self, point_id: str) -> bool:
+        return point_id in self.points
+
+    def _cell(self, lat: float, lng: float) -> Tuple[int, int]:
+        return int(math.floor(lat / self.cell_deg)), int(math.floor(lng / self.cell_deg))
+
+    def upsert(self, point_id: str, lat: float, lng: float, updated_at: Optional[float] = None):
+        cell = self._cell(lat, lng)
+        previous = self._cell_of.get(point_id)
+        if previous != cell:
+            if previous is not None:
+                self._discard_from_cell(point_id, previous)
+            self.cells.setdefault(cell, set()).add(point_id)
+            self._cell_of[point_id] = cell
+        self.points[point_id] = (lat, lng, time.monotonic() if updated_at is None else updated_at)
+
+    def remove(self, point_id: str):
+        cell = self._cell_of.pop(point_id, None)
+        if cell is not None:
+            self._discard_from_cell(point_id, cell)
+        self.points.pop(point_id, None)
+
+    def _discard_from_cell(self, point_id: str, cell: Tuple[int, int]):
+        members = self.cells.get(cell)
+        if members is not None:
+            members.discard(point_id)
+            if not members:
+                del self.cells[cell]
+
+    def get(self, point_id: str) -> Optional[Tuple[float, float]]:
+        point = self.points.get(point_id)
+        return (point[0], point[1]) if point else None
+
+    def within(
+        self,
+        lat: float,
+        lng: float,
+        radius_km: float,
+        max_age: Optional[float] = None,
+        predicate: Optional[Callable[[str], bool]] = None,
+    ) -> List[Tuple[float, str]]:
+        """Return ``(distance_km, id)`` pairs inside ``radius_km``, unsorted."""
+        lat_span = int(math.ceil(radius_km / KM_PER_DEGREE_LAT / self.cell_deg))
+        cos_lat = max(math.cos(math.radians(lat)), 0.01)
+        lng_span = int(math.ceil(radius_km / (KM_PER_DEGREE_LAT * cos_lat) / self.cell_deg))
+        center_row, center_col = self._cell(lat, lng)
+        oldest = time.monotonic() - max_age if max_age is not None else None
+
+        results = []
+        # Walk whichever is smaller: the cells in the search box or the occupied cells.
+        if (2 * lat_span + 1) * (2 * lng_span + 1) <= len(self.cells):
+            candidate_cells = (
+                self.cells.get((row, col))
+                for row in range(center_row - lat_span, center_row + lat_span + 1)
+                for col in range(center_col - lng_span, center_col + lng_span + 1)
+            )
+        else:
+            candidate_cells = (
+                members for (row, col), members in self.cells.items()
+                if abs(row - center_row) <= lat_span and abs(col - center_col) <= lng_span
+            )
+        for members in candidate_cells:
+            if not members:
+                continue
+            for point_id in members:
+                p_lat, p_lng, updated_at = self.points[point_id]
+                if oldest is not None and updated_at < oldest:
+                    continue
+                if predicate is not None and not predicate(point_id):
+                    continue
+                distance = haversine_km(lat, lng, p_lat, p_lng)
+                if distance <= radius_km:
+                    results.append((distance, point_id))
+        return results
+
+    def nearest(
+        self,
+        lat: float,
+        lng: float,
+        k: int,
+        radius_km: float,
+        max_age: Optional[float] = None,
+        predicate: Optional[Callable[[str], bool]] = None,
+    ) -> List[Tuple[float, str]]:
+        """Return up to ``k`` ``(distance_km, id)`` pairs inside ``radius_km``, closest first."""
+        return heapq.nsmallest(k, self.within(lat, lng, radius_km, max_age=max_age, predicate=predicate))
@@ -0,0 +1,180 @@
+"""Index declarations for every collection the app queries.
+
+``ensure_indexes`` creates them idempotently at startup. ``check_query_plans``
+runs ``explain()`` on each query shape the app issues and reports any that
+would scan the whole collection::
+
+    python -m indexes --check      # exits non-zero on a COLLSCAN
+"""
+import argparse
+import asyncio
+import logging
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+logger = logging.getLogger(__name__)
+
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("email", ASCENDING), ("user_type", ASCENDING)], name="email_user_type_unique", unique=True),
+    ],
+    "restaurants": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("owner_id", ASCENDING)], name="owner_id"),
+        IndexModel([("is_active", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="active_page"),
+        IndexModel(
+            [("is_active", ASCENDING), ("cuisine_type", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)],
+            name="active_cuisine_page",
+        ),
+    ],
+    "menu_items": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel(
+            [("restaurant_id", ASCENDING), ("is_available", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)],
+            name="restaurant_available_page",
+        ),
+        IndexModel(
+            [("restaurant_id", ASCENDING), ("is_available", ASCENDING), ("category", ASCENDING),
+             ("created_at", ASCENDING), ("id", ASCENDING)],
+            name="restaurant_available_category_page",
+        ),
+    ],
+    "orders": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="page"),
+        IndexModel([("customer_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="customer_page"),
+        IndexModel([("driver_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="driver_page"),
+        IndexModel([("driver_id", ASCENDING), ("status", ASCENDING)], name="driver_status"),
+        IndexModel([("restaurant_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="restaurant_page"),
+        IndexModel([("status", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="status_page"),
+        # Catch-up reads of orders changed since a sequence number
+        IndexModel([("customer_id", ASCENDING), ("seq", ASCENDING), ("id", ASCENDING)], name="customer_changes"),
+        IndexModel([("driver_id", ASCENDING), ("seq", ASCENDING), ("id", ASCENDING)], name="driver_changes"),
+        IndexModel([("restaurant_id", ASCENDING), ("seq", ASCENDING), ("id", ASCENDING)], name="restaurant_changes"),
+        IndexModel([("seq", ASCENDING), ("id", ASCENDING)], name="changes"),
+        # Only documents with queued work carry due_at
+        IndexModel([("outbox.payment.due_at", ASCENDING)], name="outbox_payment", sparse=True),
+        IndexModel([("outbox.dispatch.due_at", ASCENDING)], name="outbox_dispatch", sparse=True),
+    ],
+    "analytics_rollups": [
+        IndexModel([("granularity", ASCENDING), ("restaurant_id", ASCENDING), ("bucket", ASCENDING)], name="series"),
+        IndexModel([("expires_at", ASCENDING)], name="expiry", expireAfterSeconds=0),
+    ],
+}
+
+NEWEST_FIRST = [("created_at", DESCENDING), ("id", DESCENDING)]
+OLDEST_FIRST = [("created_at", ASCENDING), ("id", ASCENDING)]
+BY_SEQ = [("seq", ASCENDING), ("id", ASCENDING)]
+
+# (collection, filter, sort) for every query the app issues. Keep in sync
+# with server.py when adding queries.
+QUERY_SHAPES: List[Tuple[str, Dict[str, Any], Optional[List[Tuple[str, int]]]]] = [
+    # Also each UpdateOne of the location flush's bulk_write
+    ("users", {"id": "u"}, None),
+    ("users", {"email": "e", "user_type": "customer"}, None),
+    ("restaurants", {"id": "r"}, None),
+    ("restaurants", {"id": "r", "owner_id": "u"}, None),
+    ("restaurants", {"owner_id": "u"}, None),
+    ("restaurants", {"is_active": True}, OLDEST_FIRST),
+    ("restaurants", {"is_active": True, "cuisine_type": "Thai"}, OLDEST_FIRST),
+    # Search index load at startup
+    ("restaurants", {"is_active": True}, None),
+    ("menu_items", {"restaurant_id": "r"}, None),
+    ("menu_items", {"restaurant_id": "r", "is_available": True}, OLDEST_FIRST),
+    ("menu_items", {"restaurant_id": "r", "is_available": True, "category": "main"}, OLDEST_FIRST),
+    ("orders", {"id": "o"}, None),
+    ("orders", {"id": "o", "driver_id": None, "status": {"$in": ["pending", "confirmed", "preparing", "ready"]}}, None),
+    ("orders", {}, NEWEST_FIRST),
+    ("orders", {"customer_id": "u"}, NEWEST_FIRST),
+    ("orders", {"driver_id": "u"}, NEWEST_FIRST),
+    ("orders", {"restaurant_id": {"$in": ["r1", "r2"]}}, NEWEST_FIRST),
+    ("orders", {"status": {"$in": ["pending", "confirmed"]}}, NEWEST_FIRST),
+    ("orders", {"driver_id": "u", "status": {"$in": ["picked_up"]}}, None),
+    ("orders", {"status": "delivered"}, None),
+    ("orders", {"status": "preparing"}, None),
+    ("orders", {"id": "o", "version": 3}, None),
+    ("orders", {"seq": {"$in": [1, 2]}}, None),
+    ("orders", {"status": {"$in": ["pending", "confirmed", "preparing", "ready", "picked_up"]}}, None),
+    ("orders", {"status": "delivered", "created_at": {"$gte": datetime(2024, 1, 1)}}, None),
+    ("orders", {"status": {"$in": ["confirmed", "preparing", "ready", "picked_up"]}}, None),
+    ("orders", {"customer_id": "u", "seq": {"$gt": 0}}, BY_SEQ),
+    ("orders", {"driver_id": "u", "seq": {"$gt": 0}}, BY_SEQ),
+    ("orders", {"restaurant_id": {"$in": ["r1", "r2"]}, "seq": {"$gt": 0}}, BY_SEQ),
+    ("orders", {"seq": {"$gt": 0}}, BY_SEQ),
+    ("orders", {"outbox.payment.due_at": {"$lte": datetime(2024, 1, 1)}}, [("outbox.payment.due_at", ASCENDING)]),
+    ("orders", {"outbox.dispatch.due_at": {"$lte": datetime(2024, 1, 1)}}, [("outbox.dispatch.due_at", ASCENDING)]),
+    # Outbox backlog counts
+    ("orders", {"outbox.payment.due_at": {"$exists": True}}, None),
+    ("orders", {"outbox.dispatch.due_at": {"$exists": True}}, None),
+    ("analytics_rollups", {"granularity": "hour", "restaurant_id": None, "bucket": {"$gte": datetime(2024, 1, 1)}},
+     [("bucket", ASCENDING)]),
+]
+
+
+async def ensure_indexes(db):
+    """Create every declared index; already-existing ones are left alone."""
+    for collection, indexes in INDEXES.items():
+        try:
+            await db[collection].create_indexes(indexes)
+        except Exception:
+            # Usually a conflicting existing index or duplicate data under a
+            # unique index; keep serving and surface it in the logs.
+            logger.exception("Creating indexes on %s failed", collection)
+
+
+def _stages(plan: Any):
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _stages(value)
+
+
+async def check_query_plans(db) -> List[str]:
+    """Explain every query shape; return a description of each one that COLLSCANs."""
+    problems = []
+    for collection, query, sort in QUERY_SHAPES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = await cursor.limit(101).explain()
+        winning_plan = explain.get("queryPlanner", {}).get("winningPlan", {})
+        if "COLLSCAN" in set(_stages(winning_plan)):
+            problems.append(f"{collection}.find({query}) sort={sort} does a COLLSCAN")
+    return problems
+
+
+async def _main(check: bool) -> int:
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(Path(__file__).parent / ".env")
+    client = AsyncIOMotorClient(os.environ["MONGO_URL"])
+    db = client[os.environ["DB_NAME"]]
+    try:
+        await ensure_indexes(db)
+        if not check:
+            return 0
+        problems = await check_query_plans(db)
+        for problem in problems:
+            print(problem)
+        print(f"{len(QUERY_SHAPES) - len(problems)}/{len(QUERY_SHAPES)} query shapes use an index")
+        return 1 if problems else 0
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create indexes and optionally verify query plans")
+    parser.add_argument("--check", action="store_true", help="explain every query shape and fail on COLLSCAN")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    raise SystemExit(asyncio.run(_main(args.check)))
@@ -0,0 +1,189 @@
+import time
+from typing import Any, Callable, Dict
+
+from metrics import REGISTRY, Registry
+
+# Motor collection methods that are one round trip each
+TIMED_OPERATIONS = frozenset({
+    "find_one", "find_one_and_update", "find_one_and_replace", "find_one_and_delete",
+    "insert_one", "insert_many", "update_one", "update_many", "replace_one", "delete_one", "delete_many",
+    "bulk_write", "count_documents", "estimated_document_count", "distinct", "create_index", "create_indexes",
+})
+
+# Methods returning a cursor, timed when the cursor is read
+CURSOR_OPERATIONS = frozenset({"find", "aggregate"})
+
+
+class MetricsMiddleware:
+    """Times every HTTP request by method, route template and status code.
+
+    Plain ASGI rather than ``BaseHTTPMiddleware``, so it adds two clock
+    reads and a histogram update per request and nothing else. Requests
+    that match no route share the route label "unmatched", which keeps
+    scanners from creating a series per path.
+    """
+
+    def __init__(self, app, registry: Registry = REGISTRY):
+        self.app = app
+        self.duration = registry.histogram(
+            "http_request_duration_seconds", "HTTP request latency by method, route and status"
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_and_record_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_record_status)
+        finally:
+            route = scope.get("route")
+            self.duration.observe(
+                time.perf_counter() - started,
+                method=scope["method"], route=getattr(route, "path", "unmatched"), status=status,
+            )
+
+
+class InstrumentedCursor:
+    """A Motor cursor whose reads are timed as one operation.
+
+    ``to_list`` is observed directly; an ``async for`` is observed once it is
+    exhausted, as the time spent waiting on the database only (not on the
+    loop body). Chained calls like ``sort`` keep returning the wrapper.
+    """
+
+    def __init__(self, cursor, observe: Callable[[float], None]):
+        self._cursor = cursor
+        self._observe = observe
+        self._iterator = None
+        self._elapsed = 0.0
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._cursor, name)
+        if not callable(attr):
+            return attr
+
+        def chained(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            return self if result is self._cursor else result
+
+        return chained
+
+    async def to_list(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await self._cursor.to_list(*args, **kwargs)
+        finally:
+            self._observe(time.perf_counter() - started)
+
+    def __aiter__(self):
+        self._iterator = self._cursor.__aiter__()
+        return self
+
+    async def __anext__(self):
+        started = time.perf_counter()
+        try:
+            return await self._iterator.__anext__()
+        except StopAsyncIteration:
+            self._observe(self._elapsed + time.perf_counter() - started)
+            raise
+        finally:
+            self._elapsed += time.perf_counter() - started
+
+
+class InstrumentedCollection:
+    """Proxy for a Motor collection that times each operation."""
+
+    def __init__(self, collection, name: str, registry: Registry):
+        self._collection = collection
+        self._name = name
+        self._duration = registry.histogram(
+            "mongo_operation_seconds", "MongoDB operation latency by collection and operation"
+        )
+        self._errors = registry.counter(
+            "mongo_operation_errors_total", "MongoDB operations that raised, by collection and operation"
+        )
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._collection, name)
+        if name in TIMED_OPERATIONS:
+            wrapped = self._timed(name, attr)
+        elif name in CURSOR_OPERATIONS:
+            wrapped = self._timed_cursor(name, attr)
+        else:
+            return attr
+        # Later lookups find the wrapper without going through __getattr__
+        self.__dict__[name] = wrapped
+        return wrapped
+
+    def _observer(self, operation: str) -> Callable[[float], None]:
+        def observe(seconds: float):
+            self._duration.observe(seconds, collection=self._name, operation=operation)
+        return observe
+
+    def _timed(self, operation: str, method):
+        observe = self._observer(operation)
+
+        async def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            except Exception:
+                self._errors.inc(collection=self._name, operation=operation)
+                raise
+            finally:
+                observe(time.perf_counter() - started)
+
+        return timed
+
+    def _timed_cursor(self, operation: str, method):
+        observe = self._observer(operation)
+
+        def timed_cursor(*args, **kwargs):
+            cursor = method(*args, **kwargs)
+            if kwargs.get("cursor_type"):
+                # Tailable cursors wait for new data; their read time is not latency
+                return cursor
+            return InstrumentedCursor(cursor, observe)
+
+        return timed_cursor
+
+
+class InstrumentedDatabase:
+    """Proxy for a Motor database whose collections time every operation.
+
+    Attribute and item access to collections work as on the real handle;
+    everything else (``list_collection_names``, ``command``, ...) passes
+    straight through.
+    """
+
+    def __init__(self, db, registry: Registry = REGISTRY):
+        self._db = db
+        self._registry = registry
+        self._collections: Dict[str, InstrumentedCollection] = {}
+
+    def _collection(self, name: str) -> InstrumentedCollection:
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections[name] = InstrumentedCollection(self._db[name], name, self._registry)
+        return collection
+
+    def __getitem__(self, name: str) -> InstrumentedCollection:
+        return self._collection(name)
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._db, name)
+        if hasattr(attr, "insert_one") and hasattr(attr, "find"):
+            # Cached as an attribute so ``db.orders`` skips this method next time
+            collection = self.__dict__[name] = self._collection(name)
+            return collection
+        return attr
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from pymongo import UpdateOne
+
+from geo import GeoGridIndex
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+locations_ingested = REGISTRY.counter("driver_locations_ingested_total", "Driver location pings accepted")
+locations_flushed = REGISTRY.counter("driver_locations_flushed_total", "Driver positions written to Mongo")
+
+Location = Dict[str, float]
+
+
+class LocationPipeline:
+    """Keeps live driver positions in memory and persists them in batches.
+
+    ``ingest`` never touches the database: it records the position, updates
+    the dispatch index and pushes the position to the customers of the
+    driver's in-flight orders, which are cached per driver. Positions are
+    written to ``users.location`` by a background task every
+    ``flush_interval`` seconds with a single unordered ``bulk_write``. On the
+    same tick the latest positions and the drivers removed since the last
+    tick are handed to ``replicate`` in one call, for other workers to apply
+    with ``apply_remote``.
+    """
+
+    def __init__(
+        self,
+        db,
+        index: GeoGridIndex,
+        notify: Callable[[dict, str], Awaitable[None]],
+        load_active_orders: Callable[[str], Awaitable[Dict[str, str]]],
+        replicate: Optional[Callable[[Dict[str, Location], List[str]], None]] = None,
+        on_flushed: Optional[Callable[[Iterable[str]], None]] = None,
+        flush_interval: float = 2.0,
+        active_orders_ttl: float = 30.0,
+    ):
+        self.db = db
+        self.index = index
+        self.notify = notify
+        self.load_active_orders = load_active_orders
+        self.replicate = replicate
+        self.on_flushed = on_flushed
+        self.flush_interval = flush_interval
+        self.active_orders_ttl = active_orders_ttl
+        self.positions: Dict[str, Tuple[Location, datetime]] = {}
+        self.dirty: Dict[str, Tuple[Location, datetime]] = {}
+        # Not yet sent to other workers
+        self.unreplicated: Dict[str, Location] = {}
+        self.removed: Set[str] = set()
+        # driver id -> (loaded_at, {order id: customer id}), and the reverse
+        # order id -> (driver id, customer id)
+        self.active_orders: Dict[str, Tuple[float, Dict[str, str]]] = {}
+        self.order_routes: Dict[str, Tuple[str, str]] = {}
+        self._refreshing: Dict[str, asyncio.Task] = {}
+        self._flusher: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        for task in list(self._refreshing.values()):
+            task.cancel()
+        await self.flush()
+
+    async def ingest(self, driver_id: str, location: Location, recorded_at: Optional[datetime] = None):
+        recorded_at = recorded_at or datetime.utcnow()
+        previous = self.positions.get(driver_id)
+        if previous is not None and previous[1] > recorded_at:
+            # Out-of-order point from a buffered batch
+            return
+        self._apply(driver_id, location, recorded_at)
+        self.dirty[driver_id] = (location, recorded_at)
+        locations_ingested.inc()
+        if self.replicate is not None:
+            self.unreplicated[driver_id] = location
+            self.removed.discard(driver_id)
+
+        for order_id, customer_id in self._orders_for(driver_id).items():
+            await self.notify({
+                "type": "driver_location_update",
+                "order_id": order_id,
+                "location": location
+            }, customer_id)
+
+    def apply_remote(self, positions: Dict[str, Location], removed: Iterable[str] = ()):
+        """Record positions ingested, and drivers removed, by another worker."""
+        now = datetime.utcnow()
+        for driver_id, location in positions.items():
+            self._apply(driver_id, location, now)
+        for driver_id in removed:
+            self.positions.pop(driver_id, None)
+            self.index.remove(driver_id)
+
+    def _apply(self, driver_id: str, location: Location, recorded_at: datetime):
+        self.positions[driver_id] = (location, recorded_at)
+        self.index.upsert(driver_id, location["lat"], location["lng"])
+
+    def remove(self, driver_id: str):
+        self.positions.pop(driver_id, None)
+        self.index.remove(driver_id)
+        if self.replicate is not None:
+            self.unreplicated.pop(driver_id, None)
+            self.removed.add(driver_id)
+
+    def position(self, driver_id: str) -> Optional[Location]:
+        entry = self.positions.get(driver_id)
+        return entry[0] if entry else None
+
+    def order_route(self, order_id: str) -> Optional[Tuple[str, str]]:
+        """``(driver_id, customer_id)`` of a cached in-flight order."""
+        return self.order_routes.get(order_id)
+
+    # Active-order cache. Status changes on this worker update it directly;
+    # the TTL bounds staleness for changes made on other workers.
+
+    def order_started(self, driver_id: str, order_id: str, customer_id: str):
+        entry = self.active_orders.get(driver_id)
+        if entry is not None:
+            entry[1][order_id] = customer_id
+        self.order_routes[order_id] = (driver_id, customer_id)
+
+    def order_finished(self, driver_id: str, order_id: str):
+        entry = self.active_orders.get(driver_id)
+        if entry is not None:
+            entry[1].pop(order_id, None)
+        self.order_routes.pop(order_id, None)
+
+    def _orders_for(self, driver_id: str) -> Dict[str, str]:
+        entry = self.active_orders.get(driver_id)
+        if entry is None or time.monotonic() - entry[0] > self.active_orders_ttl:
+            if driver_id not in self._refreshing:
+                task = asyncio.create_task(self._refresh(driver_id))
+                self._refreshing[driver_id] = task
+                task.add_done_callback(lambda _: self._refreshing.pop(driver_id, None))
+        return dict(entry[1]) if entry is not None else {}
+
+    async def _refresh(self, driver_id: str):
+        try:
+            orders = await self.load_active_orders(driver_id)
+        except Exception:
+            logger.exception("Loading active orders for driver %s failed", driver_id)
+            return
+        previous = self.active_orders.get(driver_id)
+        if previous is not None:
+            for order_id in previous[1]:
+                route = self.order_routes.get(order_id)
+                if order_id not in orders and route is not None and route[0] == driver_id:
+                    del self.order_routes[order_id]
+        self.active_orders[driver_id] = (time.monotonic(), orders)
+        for order_id, customer_id in orders.items():
+            self.order_routes[order_id] = (driver_id, customer_id)
+
+    async def flush(self):
+        self._replicate()
+        if not self.dirty:
+            return
+        batch, self.dirty = self.dirty, {}
+        requests = [
+            UpdateOne({"id": driver_id}, {"$set": {"location": location, "location_updated_at": recorded_at}})
+            for driver_id, (location, recorded_at) in batch.items()
+        ]
+        try:
+            await self.db.users.bulk_write(requests, ordered=False)
+        except Exception:
+            # Keep newer points that arrived meanwhile, retry the rest next tick
+            for driver_id, entry in batch.items():
+                self.dirty.setdefault(driver_id, entry)
+            raise
+        locations_flushed.inc(len(requests))
+        if self.on_flushed is not None:
+            self.on_flushed(batch.keys())
+
+    def _replicate(self):
+        if not self.unreplicated and not self.removed:
+            return
+        positions, removed = self.unreplicated, list(self.removed)
+        self.unreplicated, self.removed = {}, set()
+        self.replicate(positions, removed)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Flushing driver locations failed")
@@ -0,0 +1,209 @@
+import asyncio
+import math
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+# Latency buckets in seconds, from a fast Mongo lookup to a slow Stripe call
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_key(labels: Dict[str, str]) -> LabelKey:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+class Counter:
+    """Monotonic counter, optionally split by labels."""
+
+    type = "counter"
+
+    def __init__(self, name: str, description: str = ""):
+        self.name = name
+        self.description = description
+        self.values: Dict[LabelKey, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self.values.get(_label_key(labels), 0)
+
+    def samples(self) -> List[Tuple[LabelKey, float]]:
+        return list(self.values.items())
+
+
+class Gauge:
+    """Point-in-time value, either set explicitly or computed by ``function`` on read."""
+
+    type = "gauge"
+
+    def __init__(self, name: str, description: str = "", function: Optional[Callable[[], Dict[LabelKey, float]]] = None):
+        self.name = name
+        self.description = description
+        self.values: Dict[LabelKey, float] = {}
+        self.function = function
+
+    def set(self, value: float, **labels):
+        self.values[_label_key(labels)] = value
+
+    def samples(self) -> List[Tuple[LabelKey, float]]:
+        if self.function is not None:
+            return list(self.function().items())
+        return list(self.values.items())
+
+
+class Histogram:
+    """Observed values counted into cumulative ``buckets``, optionally split by labels.
+
+    Observing is a bisect and two additions, cheap enough for every request
+    and every Mongo call.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, description: str = "", buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts with a final +Inf bucket, sum]
+        self.values: Dict[LabelKey, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def series(self) -> List[Tuple[LabelKey, List[int], float]]:
+        with self._lock:
+            return [(labels, list(counts), total) for labels, (counts, total) in self.values.items()]
+
+    def samples(self) -> List[Tuple[LabelKey, float]]:
+        samples = []
+        for labels, counts, total in self.series():
+            samples.append((labels + (("stat", "count"),), float(sum(counts))))
+            samples.append((labels + (("stat", "sum"),), total))
+        return samples
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: LabelKey) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, object] = {}
+
+    def _register(self, metric):
+        existing = self.metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, description: str = "") -> Counter:
+        return self._register(Counter(name, description))
+
+    def gauge(self, name: str, description: str = "", function=None) -> Gauge:
+        return self._register(Gauge(name, description, function))
+
+    def histogram(self, name: str, description: str = "", buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, description, buckets))
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """Plain-dict view of every metric, keyed by ``name`` then rendered labels."""
+        result = {}
+        for name, metric in self.metrics.items():
+            result[name] = {
+                ",".join(f"{k}={v}" for k, v in labels) or "": value
+                for labels, value in metric.samples()
+            }
+        return result
+
+    def render(self) -> str:
+        """Every metric in the Prometheus text exposition format (0.0.4)."""
+        lines = []
+        for name, metric in self.metrics.items():
+            if metric.description:
+                lines.append(f"# HELP {name} {metric.description}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            if metric.type != "histogram":
+                lines.extend(f"{name}{_format_labels(labels)} {_format_value(value)}" for labels, value in metric.samples())
+                continue
+            for labels, counts, total in metric.series():
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (math.inf,), counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', _format_value(bound)),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up a task that sleeps ``interval``.
+
+    Anything blocking the loop (sync I/O, heavy CPU in a handler) shows up as
+    lag. Reports the latest lag and the worst lag over the last ``window``
+    samples, and counts samples above ``stall_threshold`` seconds.
+    """
+
+    def __init__(self, registry: Registry = REGISTRY, interval: float = 0.25, window: int = 240,
+                 stall_threshold: float = 0.1):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.samples = deque(maxlen=window)
+        self._task: Optional[asyncio.Task] = None
+        registry.gauge("event_loop_lag_seconds", "Latest event loop lag",
+                       function=lambda: {(): self.samples[-1] if self.samples else 0.0})
+        registry.gauge("event_loop_lag_max_seconds", "Worst event loop lag over the recent window",
+                       function=lambda: {(): max(self.samples, default=0.0)})
+        self.stalls = registry.counter("event_loop_stalls_total", "Event loop lag samples above the stall threshold")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - expected)
+            self.samples.append(lag)
+            if lag > self.stall_threshold:
+                self.stalls.inc()
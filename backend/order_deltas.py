@@ -0,0 +1,80 @@
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional
+
+from metrics import REGISTRY
+
+deltas_served = REGISTRY.counter("order_deltas_served_total", "Order catch-up requests by source (log, database)")
+
+# Catch-up requests look this far behind the client's ``since`` so writes
+# that were stamped earlier but committed later (or on another worker with a
+# slightly different clock) are not missed. Clients drop deltas whose
+# ``version`` they already have.
+OVERLAP_US = 5_000_000
+
+
+class SeqClock:
+    """Monotonic sequence numbers in microseconds since the epoch.
+
+    Close to wall-clock time, so numbers from different workers are
+    comparable, and never repeated or decreasing within a worker.
+    """
+
+    def __init__(self, clock: Callable[[], int] = time.time_ns):
+        self.clock = clock
+        self.last = 0
+        self._lock = threading.Lock()
+
+    def next(self) -> int:
+        with self._lock:
+            self.last = max(self.last + 1, self.clock() // 1000)
+            return self.last
+
+    def observe(self, seq: int):
+        """Never issue numbers below ``seq`` seen from another worker."""
+        with self._lock:
+            self.last = max(self.last, seq)
+
+
+class DeltaLog:
+    """The most recent order deltas, for incremental catch-up after a reconnect.
+
+    Holds up to ``maxlen`` deltas. ``floor`` is the newest sequence number
+    that is no longer covered: anything asking for changes before it must
+    be served from the database instead.
+    """
+
+    def __init__(self, clock: SeqClock, maxlen: int = 10000):
+        self.clock = clock
+        self.entries: deque = deque()
+        self.maxlen = maxlen
+        self.floor = clock.next()
+
+    def append(self, delta: Dict[str, Any]):
+        self.entries.append(delta)
+        while len(self.entries) > self.maxlen:
+            self.floor = max(self.floor, self.entries.popleft()["seq"])
+
+    def since(self, seq: int, visible: Callable[[Dict[str, Any]], bool]) -> Optional[List[Dict[str, Any]]]:
+        """Deltas after ``seq`` (minus the overlap) visible to the caller, oldest
+        first, or None when the log no longer reaches back that far."""
+        start = seq - OVERLAP_US
+        if start < self.floor:
+            return None
+        deltas = [delta for delta in self.entries if delta["seq"] > start and visible(delta)]
+        deltas.sort(key=lambda delta: delta["seq"])
+        return deltas
+
+
+def order_delta(order: Dict[str, Any], seq: int, version: int, changes: Dict[str, Any]) -> Dict[str, Any]:
+    """A delta for ``order`` (any version of it with the routing fields)."""
+    return {
+        "order_id": order["id"],
+        "seq": seq,
+        "version": version,
+        "changes": changes,
+        "customer_id": order["customer_id"],
+        "restaurant_id": order["restaurant_id"],
+        "driver_id": changes.get("driver_id", order.get("driver_id")),
+    }
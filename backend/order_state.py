@@ -0,0 +1,186 @@
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+from pymongo import ReturnDocument, UpdateOne
+
+# Order lifecycle:
+#   pending -> confirmed -> preparing -> ready -> picked_up -> delivered
+# with cancellation allowed until the food is ready. Each edge lists the
+# user types that may take it; ownership of the order is checked as well.
+TRANSITIONS: Dict[str, Dict[str, Set[str]]] = {
+    "pending": {"confirmed": {"restaurant"}, "cancelled": {"customer", "restaurant", "admin"}},
+    "confirmed": {"preparing": {"restaurant"}, "cancelled": {"restaurant", "admin"}},
+    "preparing": {"ready": {"restaurant"}, "cancelled": {"restaurant", "admin"}},
+    "ready": {"picked_up": {"driver"}},
+    "picked_up": {"delivered": {"driver"}},
+}
+
+# What the side effects of a transition need to know about the order
+ORDER_PROJECTION = {
+    "_id": 0, "id": 1, "status": 1, "customer_id": 1, "restaurant_id": 1, "driver_id": 1,
+    "total": 1, "created_at": 1, "version": 1,
+}
+
+MAX_BATCH = 100
+# Rounds of read and compare-and-set before a bulk transition gives up on an order
+MAX_BULK_ATTEMPTS = 3
+
+
+class TransitionError(Exception):
+    """The order cannot move to the requested status."""
+
+
+class OrderNotFound(TransitionError):
+    pass
+
+
+class TransitionForbidden(TransitionError):
+    pass
+
+
+@dataclass
+class Actor:
+    id: str
+    user_type: str
+    restaurant_ids: Sequence[str] = field(default_factory=tuple)
+
+
+def sources(target: str, user_type: str) -> List[str]:
+    """Statuses from which ``user_type`` may move an order to ``target``."""
+    return [status for status, edges in TRANSITIONS.items() if user_type in edges.get(target, ())]
+
+
+def ownership_filter(actor: Actor) -> Dict[str, Any]:
+    if actor.user_type == "customer":
+        return {"customer_id": actor.id}
+    if actor.user_type == "restaurant":
+        return {"restaurant_id": {"$in": list(actor.restaurant_ids)}}
+    if actor.user_type == "driver":
+        return {"driver_id": actor.id}
+    return {}
+
+
+def transition_changes(target: str, now: datetime, seq: Optional[int] = None) -> Dict[str, Any]:
+    changes = {"status": target, "updated_at": now}
+    if target == "delivered":
+        changes["actual_delivery_time"] = now
+    if seq is not None:
+        changes["seq"] = seq
+    return changes
+
+
+def rejection(order: Optional[Dict[str, Any]], target: str, actor: Actor) -> Optional[TransitionError]:
+    """Why ``actor`` cannot move ``order`` to ``target``, or None if it can."""
+    if order is None:
+        return OrderNotFound("Order not found")
+    for name, value in ownership_filter(actor).items():
+        allowed = value["$in"] if isinstance(value, dict) else [value]
+        if order.get(name) not in allowed:
+            return TransitionForbidden("Not authorized to update this order")
+    status = getattr(order["status"], "value", order["status"])
+    if status not in sources(target, actor.user_type):
+        return TransitionError(f"Cannot move order from {status} to {target}")
+    return None
+
+
+class OrderStateMachine:
+    """Applies status transitions as conditional atomic updates.
+
+    The legal previous statuses and the actor's ownership are part of the
+    update filter, so a transition is one round trip and concurrent updates
+    cannot skip or repeat a step. The order is only read again to explain a
+    rejected transition. With a ``clock``, every transition also stamps the
+    order with a new ``seq`` and bumps its ``version``.
+    """
+
+    def __init__(self, db, clock: Optional[Callable[[], int]] = None):
+        self.db = db
+        self.clock = clock
+
+    def _changes(self, target: str, now: datetime) -> Dict[str, Any]:
+        return transition_changes(target, now, self.clock() if self.clock else None)
+
+    def _update(self, changes: Dict[str, Any]) -> Dict[str, Any]:
+        update = {"$set": changes}
+        if self.clock:
+            update["$inc"] = {"version": 1}
+        return update
+
+    def check_role(self, target: str, actor: Actor):
+        if not sources(target, actor.user_type):
+            raise TransitionForbidden("Not authorized to update this status")
+
+    async def transition(
+        self, order_id: str, target: str, actor: Actor, now: Optional[datetime] = None
+    ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """Move one order to ``target``; returns the order as it was before and the fields set."""
+        self.check_role(target, actor)
+        changes = self._changes(target, now or datetime.utcnow())
+        order = await self.db.orders.find_one_and_update(
+            {"id": order_id, "status": {"$in": sources(target, actor.user_type)}, **ownership_filter(actor)},
+            self._update(changes),
+            projection=ORDER_PROJECTION,
+            return_document=ReturnDocument.BEFORE,
+        )
+        if order is None:
+            current = await self.db.orders.find_one({"id": order_id}, ORDER_PROJECTION)
+            raise rejection(current, target, actor) or TransitionError("Order changed concurrently")
+        return order, changes
+
+    async def transition_many(
+        self, order_ids: Sequence[str], target: str, actor: Actor, now: Optional[datetime] = None
+    ) -> Tuple[List[Tuple[Dict[str, Any], Dict[str, Any]]], Dict[str, str]]:
+        """Move many orders to ``target``, usually in one read and one bulk write.
+
+        Returns ``(order before, fields set)`` for each applied order and the
+        reason each other order was rejected.
+        """
+        self.check_role(target, actor)
+        now = now or datetime.utcnow()
+        pending = list(dict.fromkeys(order_ids))
+        ownership = ownership_filter(actor)
+        applied, failed = [], {}
+        for _ in range(MAX_BULK_ATTEMPTS):
+            found = {
+                order["id"]: order
+                for order in await self.db.orders.find({"id": {"$in": pending}}, ORDER_PROJECTION).to_list(None)
+            }
+            candidates = []
+            for order_id in pending:
+                order = found.get(order_id)
+                error = rejection(order, target, actor)
+                if error is None:
+                    candidates.append((order, self._changes(target, now)))
+                else:
+                    failed[order_id] = str(error)
+            if not candidates:
+                break
+
+            # Compare-and-set on the status and version we just read, so the
+            # version each delta announces is exact; orders changed in between
+            # (by a transition, a payment or an ETA refresh) are read again
+            result = await self.db.orders.bulk_write([
+                UpdateOne(
+                    {"id": order["id"], "status": order["status"], "version": order.get("version"), **ownership},
+                    self._update(changes),
+                )
+                for order, changes in candidates
+            ], ordered=False)
+            if result.modified_count == len(candidates):
+                applied.extend(candidates)
+                break
+
+            applied_ids = {
+                order["id"]
+                for order in await self.db.orders.find(
+                    {"id": {"$in": [order["id"] for order, _ in candidates]}, "status": target, "updated_at": now},
+                    {"_id": 0, "id": 1},
+                ).to_list(None)
+            }
+            applied.extend(candidate for candidate in candidates if candidate[0]["id"] in applied_ids)
+            pending = [order["id"] for order, _ in candidates if order["id"] not in applied_ids]
+        else:
+            for order_id in pending:
+                failed[order_id] = "Order changed concurrently"
+        return applied, failed
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from pymongo import ReturnDocument
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+outbox_tasks = REGISTRY.counter("outbox_tasks_total", "Outbox task attempts by kind and result")
+
+Handler = Callable[[Dict[str, Any]], Awaitable[Optional[Dict[str, Any]]]]
+
+
+class Outbox:
+    """Durable follow-up work stored inside the documents it belongs to.
+
+    A document is inserted together with its pending tasks under
+    ``<field>.<kind>``, so persisting the document and queueing its work is a
+    single atomic write and needs nothing but Mongo. Workers claim a task by
+    pushing its ``due_at`` forward by ``lease`` with ``find_one_and_update``;
+    a worker that dies simply lets the lease expire and another one picks the
+    task up again. Failed attempts are retried with exponential backoff up to
+    ``max_attempts``, then handed to ``on_failed``.
+
+    Delivery is at least once, so handlers must be idempotent. Completion is
+    fenced on the claim token, so a worker whose lease expired cannot
+    overwrite the outcome of the worker that took over.
+    """
+
+    def __init__(
+        self,
+        db,
+        collection: str,
+        handlers: Dict[str, Handler],
+        on_failed: Optional[Callable[[str, Dict[str, Any], str], Awaitable[None]]] = None,
+        field: str = "outbox",
+        workers: int = 4,
+        lease: float = 30.0,
+        poll_interval: float = 1.0,
+        max_attempts: int = 8,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        max_backlog: int = 1000,
+    ):
+        self.db = db
+        self.collection_name = collection
+        self.handlers = handlers
+        self.on_failed = on_failed
+        self.field = field
+        self.workers = workers
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_backlog = max_backlog
+        self.backlog: Dict[str, int] = {kind: 0 for kind in handlers}
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        REGISTRY.gauge(
+            "outbox_backlog", "Outbox tasks waiting or running, by kind",
+            function=lambda: {(("kind", kind),): count for kind, count in self.backlog.items()},
+        )
+
+    @property
+    def collection(self):
+        return self.db[self.collection_name]
+
+    def tasks(self, *kinds: str, now: Optional[datetime] = None) -> Dict[str, Any]:
+        """Fields to merge into a new document to queue ``kinds`` for it."""
+        now = now or datetime.utcnow()
+        return {self.field: {kind: {"status": "pending", "attempts": 0, "due_at": now} for kind in kinds}}
+
+    @property
+    def overloaded(self) -> bool:
+        return sum(self.backlog.values()) >= self.max_backlog
+
+    def notify(self, *kinds: str):
+        """Wake idle workers after queueing ``kinds``, instead of waiting for the next poll."""
+        for kind in kinds or self.backlog:
+            self.backlog[kind] += 1
+        self._wakeup.set()
+
+    def start(self):
+        if self._tasks:
+            return
+        for kind in self.handlers:
+            for _ in range(self.workers):
+                self._tasks.append(asyncio.create_task(self._work(kind)))
+        self._tasks.append(asyncio.create_task(self._watch_backlog()))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    # Workers
+
+    async def _work(self, kind: str):
+        while True:
+            try:
+                document = await self._claim(kind)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Claiming %s outbox task failed", kind)
+                document = None
+            if document is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._run(kind, document)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # The lease expires and the task is claimed again
+                logger.exception("Recording %s outbox result for %s failed", kind, document.get("id"))
+
+    async def _claim(self, kind: str) -> Optional[Dict[str, Any]]:
+        now = datetime.utcnow()
+        path = f"{self.field}.{kind}"
+        return await self.collection.find_one_and_update(
+            {f"{path}.due_at": {"$lte": now}},
+            {
+                "$set": {
+                    f"{path}.status": "running",
+                    f"{path}.due_at": now + timedelta(seconds=self.lease),
+                    f"{path}.claim": uuid.uuid4().hex,
+                },
+                "$inc": {f"{path}.attempts": 1},
+            },
+            sort=[(f"{path}.due_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def _run(self, kind: str, document: Dict[str, Any]):
+        path = f"{self.field}.{kind}"
+        task = document[self.field][kind]
+        fence = {"_id": document["_id"], f"{path}.claim": task["claim"]}
+        try:
+            result = await asyncio.wait_for(self.handlers[kind](document), timeout=self.lease)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            if task["attempts"] >= self.max_attempts:
+                outbox_tasks.inc(kind=kind, result="failed")
+                self._settled(kind)
+                logger.error("Outbox task %s for %s failed permanently: %s", kind, document.get("id"), error)
+                await self.collection.update_one(fence, {
+                    "$set": {f"{path}.status": "failed", f"{path}.error": error},
+                    "$unset": {f"{path}.due_at": "", f"{path}.claim": ""},
+                })
+                if self.on_failed is not None:
+                    await self.on_failed(kind, document, error)
+            else:
+                outbox_tasks.inc(kind=kind, result="retry")
+                delay = min(self.backoff * 2 ** (task["attempts"] - 1), self.max_backoff)
+                await self.collection.update_one(fence, {"$set": {
+                    f"{path}.status": "pending",
+                    f"{path}.due_at": datetime.utcnow() + timedelta(seconds=delay),
+                    f"{path}.error": error,
+                }})
+            return
+
+        outbox_tasks.inc(kind=kind, result="done")
+        self._settled(kind)
+        update = {
+            "$set": {f"{path}.status": "done", f"{path}.done_at": datetime.utcnow()},
+            "$unset": {f"{path}.due_at": "", f"{path}.claim": ""},
+        }
+        if result:
+            update["$set"][f"{path}.result"] = result
+        await self.collection.update_one(fence, update)
+
+    def _settled(self, kind: str):
+        # Keep the estimate current between counts
+        self.backlog[kind] = max(0, self.backlog[kind] - 1)
+
+    async def _watch_backlog(self):
+        while True:
+            for kind in self.handlers:
+                try:
+                    self.backlog[kind] = await self.collection.count_documents(
+                        {f"{self.field}.{kind}.due_at": {"$exists": True}}
+                    )
+                except Exception:
+                    logger.exception("Counting %s outbox backlog failed", kind)
+            await asyncio.sleep(self.poll_interval * 5)
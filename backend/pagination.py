@@ -0,0 +1,99 @@
+import base64
+import json
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import ASCENDING, DESCENDING
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 200
+
+
+class CursorError(ValueError):
+    """The ``after`` cursor is malformed or was issued for another listing."""
+
+
+# Keyset pagination: pages are ordered by (sort_field, id) and a cursor holds
+# the key of the last item returned, so the next page is a range scan from
+# that key instead of an ever-growing skip.
+
+def encode_cursor(document: Dict[str, Any], sort_field: str) -> str:
+    value = document[sort_field]
+    if isinstance(value, datetime):
+        value = {"$date": value.isoformat()}
+    raw = json.dumps([value, document["id"]], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(token: str) -> Tuple[Any, str]:
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        value, last_id = json.loads(raw)
+        if isinstance(value, dict):
+            value = datetime.fromisoformat(value["$date"])
+    except (ValueError, TypeError, KeyError):
+        raise CursorError("Invalid cursor")
+    if not isinstance(last_id, str):
+        raise CursorError("Invalid cursor")
+    return value, last_id
+
+
+def keyset_filter(sort_field: str, direction: int, after: str) -> Dict[str, Any]:
+    value, last_id = decode_cursor(after)
+    op = "$gt" if direction == ASCENDING else "$lt"
+    return {"$or": [
+        {sort_field: {op: value}},
+        {sort_field: value, "id": {op: last_id}},
+    ]}
+
+
+def build_projection(
+    fields: Optional[str], allowed: Iterable[str], sort_field: str, hidden: Iterable[str] = ()
+) -> Dict[str, int]:
+    """Mongo projection for a comma-separated ``fields`` parameter.
+
+    ``id`` and the sort field are always included so the cursor can be built.
+    ``hidden`` fields are internal and left out when no fields are requested.
+    """
+    projection = {"_id": 0}
+    if not fields:
+        projection.update({field: 0 for field in hidden})
+        return projection
+    allowed = set(allowed)
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in allowed]
+    if unknown:
+        raise CursorError(f"Unknown fields: {', '.join(unknown)}")
+    for field in requested + ["id", sort_field]:
+        projection[field] = 1
+    return projection
+
+
+async def fetch_page(
+    collection,
+    query: Dict[str, Any],
+    limit: int = DEFAULT_LIMIT,
+    after: Optional[str] = None,
+    sort_field: str = "created_at",
+    direction: int = ASCENDING,
+    projection: Optional[Dict[str, int]] = None,
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Return one page of raw documents and the cursor of the next page, if any.
+
+    Reads ``limit + 1`` documents in a single batch; the extra one only tells
+    whether another page exists.
+    """
+    limit = max(1, min(limit, MAX_LIMIT))
+    if after:
+        query = {"$and": [query, keyset_filter(sort_field, direction, after)]}
+    cursor = (
+        collection.find(query, projection or {"_id": 0})
+        .sort([(sort_field, direction), ("id", direction)])
+        .limit(limit + 1)
+        .batch_size(limit + 1)
+    )
+    documents = await cursor.to_list(limit + 1)
+    if len(documents) <= limit:
+        return documents, None
+    documents = documents[:limit]
+    return documents, encode_cursor(documents[-1], sort_field)
@@ -0,0 +1,121 @@
+import asyncio
+import hashlib
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+import stripe
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+payment_requests = REGISTRY.counter("payment_requests_total", "Payment gateway calls by gateway and result")
+payment_latency = REGISTRY.histogram("payment_request_duration_seconds", "Payment gateway call latency by gateway and result")
+
+
+class PaymentError(Exception):
+    """The payment provider rejected the request or could not be reached."""
+
+
+@dataclass
+class PaymentIntent:
+    id: str
+    client_secret: str
+
+
+def idempotency_key(order_id: str) -> str:
+    # One intent per order: a retried or duplicated request for the same
+    # order gets the intent Stripe already created instead of a second one
+    return f"order-{order_id}-payment-intent"
+
+
+class PaymentGateway:
+    name = "base"
+
+    async def create_intent(self, order_id: str, amount_cents: int, currency: str = "usd",
+                            metadata: Optional[Dict[str, str]] = None) -> PaymentIntent:
+        started = time.perf_counter()
+        result = "error"
+        try:
+            intent = await self._create_intent(order_id, amount_cents, currency, metadata or {})
+            result = "ok"
+            return intent
+        finally:
+            payment_requests.inc(gateway=self.name, result=result)
+            payment_latency.observe(time.perf_counter() - started, gateway=self.name, result=result)
+
+    async def _create_intent(self, order_id, amount_cents, currency, metadata) -> PaymentIntent:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class StripeGateway(PaymentGateway):
+    """Stripe calls run on a small dedicated thread pool.
+
+    The Stripe SDK is blocking; calling it from a handler stalls the event
+    loop (and every WebSocket) for the whole round trip. Each pool thread
+    keeps its own HTTP session, so connections are reused across calls.
+    ``timeout`` bounds both the HTTP request and the wait on the loop side.
+    """
+
+    name = "stripe"
+
+    def __init__(self, api_key: str, max_workers: int = 8, timeout: float = 10.0, max_network_retries: int = 2):
+        self.timeout = timeout
+        self.client = stripe.StripeClient(
+            api_key,
+            http_client=stripe.RequestsClient(timeout=timeout),
+            max_network_retries=max_network_retries,
+        )
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stripe")
+
+    def _create_sync(self, order_id, amount_cents, currency, metadata) -> PaymentIntent:
+        intent = self.client.payment_intents.create(
+            params={"amount": amount_cents, "currency": currency, "metadata": {**metadata, "order_id": order_id}},
+            options={"idempotency_key": idempotency_key(order_id)},
+        )
+        return PaymentIntent(id=intent.id, client_secret=intent.client_secret)
+
+    async def _create_intent(self, order_id, amount_cents, currency, metadata) -> PaymentIntent:
+        loop = asyncio.get_running_loop()
+        call = loop.run_in_executor(self.executor, self._create_sync, order_id, amount_cents, currency, metadata)
+        try:
+            # Retries happen inside the pool thread; leave them room before giving up
+            return await asyncio.wait_for(call, self.timeout * 2)
+        except asyncio.TimeoutError:
+            raise PaymentError("Payment provider timed out")
+        except stripe.StripeError as e:
+            raise PaymentError(e.user_message or "Payment provider error") from e
+
+    async def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class FakePaymentGateway(PaymentGateway):
+    """In-process stand-in for Stripe, for load tests and local development.
+
+    ``latency`` simulates the provider round trip without blocking the loop.
+    Intents are idempotent per order like the real thing.
+    """
+
+    name = "fake"
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.intents: Dict[str, PaymentIntent] = {}
+
+    async def _create_intent(self, order_id, amount_cents, currency, metadata) -> PaymentIntent:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        key = idempotency_key(order_id)
+        intent = self.intents.get(key)
+        if intent is None:
+            digest = hashlib.blake2b(key.encode(), digest_size=12).hexdigest()
+            intent = PaymentIntent(id=f"pi_fake_{digest}", client_secret=f"pi_fake_{digest}_secret")
+            self.intents[key] = intent
+        return intent
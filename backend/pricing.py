@@ -0,0 +1,90 @@
+from dataclasses import dataclass
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Dict, Iterable, List, Optional
+
+from cache import TTLCache
+
+TAX_RATE = Decimal("0.08")
+CENTS = Decimal("0.01")
+
+MENU_PROJECTION = {"_id": 0, "id": 1, "name": 1, "price": 1, "is_available": 1, "preparation_time": 1}
+
+
+class PricingError(Exception):
+    """The cart cannot be priced, e.g. unknown or unavailable items."""
+
+
+def to_money(value) -> Decimal:
+    # Prices are stored as floats; go through str so 12.99 stays 12.99
+    return Decimal(str(value)).quantize(CENTS, rounding=ROUND_HALF_UP)
+
+
+@dataclass
+class Quote:
+    subtotal: Decimal
+    delivery_fee: Decimal
+    tax: Decimal
+    total: Decimal
+    max_preparation_time: int
+
+
+class PricingEngine:
+    """Prices carts server-side from the restaurant's menu.
+
+    Menus are cached per restaurant (one query loads the whole menu on a
+    miss) and must be invalidated with ``invalidate`` whenever a menu item
+    of that restaurant is written.
+    """
+
+    def __init__(self, db, cache: Optional[TTLCache] = None, tax_rate: Decimal = TAX_RATE):
+        self.db = db
+        self.cache = cache or TTLCache("menus", maxsize=2000, ttl=300)
+        self.tax_rate = tax_rate
+
+    def invalidate(self, restaurant_id: str):
+        self.cache.invalidate(restaurant_id)
+
+    async def menu(self, restaurant_id: str) -> Dict[str, dict]:
+        items = self.cache.get(restaurant_id)
+        if items is None:
+            generation = self.cache.generation
+            documents = await self.db.menu_items.find({"restaurant_id": restaurant_id}, MENU_PROJECTION).to_list(None)
+            items = {}
+            for document in documents:
+                document["unit_price"] = to_money(document["price"])
+                items[document["id"]] = document
+            self.cache.set(restaurant_id, items, generation)
+        return items
+
+    async def price(self, restaurant_id: str, delivery_fee: float, items: Iterable) -> Quote:
+        """Price ``items`` (objects with ``menu_item_id`` and ``quantity``)."""
+        return self.quote(await self.menu(restaurant_id), delivery_fee, items)
+
+    def quote(self, menu: Dict[str, dict], delivery_fee: float, items: Iterable) -> Quote:
+        """Price ``items`` against a menu as returned by ``menu``."""
+        subtotal = Decimal(0)
+        max_preparation_time = 0
+        count = 0
+        for item in items:
+            count += 1
+            if item.quantity < 1:
+                raise PricingError(f"Invalid quantity for item {item.menu_item_id}")
+            menu_item = menu.get(item.menu_item_id)
+            if menu_item is None:
+                raise PricingError(f"Menu item {item.menu_item_id} not found")
+            if not menu_item.get("is_available", True):
+                raise PricingError(f"{menu_item.get('name', item.menu_item_id)} is not available")
+            subtotal += menu_item["unit_price"] * item.quantity
+            max_preparation_time = max(max_preparation_time, menu_item.get("preparation_time", 0))
+        if not count:
+            raise PricingError("Order has no items")
+
+        fee = to_money(delivery_fee)
+        tax = (subtotal * self.tax_rate).quantize(CENTS, rounding=ROUND_HALF_UP)
+        return Quote(
+            subtotal=subtotal,
+            delivery_fee=fee,
+            tax=tax,
+            total=subtotal + fee + tax,
+            max_preparation_time=max_preparation_time,
+        )
@@ -0,0 +1,371 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Hashable, List, Optional, Set
+
+from fastapi import WebSocket
+
+from backplane import Backplane, Envelope
+from metrics import REGISTRY
+from ws_protocol import JSON, Codec, negotiate
+
+logger = logging.getLogger(__name__)
+
+# Workers announce themselves this often; a worker not heard from for
+# NODE_TIMEOUT is presumed dead and the sockets it held are forgotten
+HEARTBEAT_INTERVAL = 5.0
+NODE_TIMEOUT = 3 * HEARTBEAT_INTERVAL
+
+# Connection ids are "<user_type>_<user_id>" (see the React client); messages
+# addressed to a bare user id are routed to whichever of these the user holds.
+USER_TYPE_PREFIXES = ("customer_", "driver_", "restaurant_", "admin_")
+
+# Message types where only the latest value matters, keyed by the field that
+# identifies the stream. A newer message replaces a queued older one in place.
+COALESCE_FIELDS = {
+    "driver_location_update": "order_id",
+}
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+DISCONNECT = "disconnect"
+
+messages_sent = REGISTRY.counter("ws_messages_sent_total", "WebSocket messages written to clients")
+messages_dropped = REGISTRY.counter("ws_messages_dropped_total", "WebSocket messages dropped before sending, by reason")
+send_failures = REGISTRY.counter("ws_send_failures_total", "WebSocket sends that raised and closed the connection")
+bytes_sent = REGISTRY.counter("ws_bytes_sent_total", "WebSocket payload bytes written to clients, by encoding")
+queue_wait = REGISTRY.histogram("ws_message_queue_seconds", "Time outbound WebSocket messages wait in the connection queue, by user type")
+send_latency = REGISTRY.histogram("ws_send_seconds", "Time to write one WebSocket message to the socket, by user type")
+
+
+def coalesce_key(message: Dict[str, Any]) -> Optional[Hashable]:
+    field = COALESCE_FIELDS.get(message.get("type"))
+    if field is None or field not in message:
+        return None
+    return message["type"], message[field]
+
+
+def user_id_of(connection_id: str) -> Optional[str]:
+    for prefix in USER_TYPE_PREFIXES:
+        if connection_id.startswith(prefix):
+            return connection_id[len(prefix):]
+    return None
+
+
+def user_type_of(connection_id: str) -> str:
+    return connection_id.split("_", 1)[0] if user_id_of(connection_id) else "unknown"
+
+
+class Connection:
+    """One WebSocket plus its bounded outbound queue and writer task."""
+
+    def __init__(self, manager: "ConnectionManager", connection_id: str, websocket: WebSocket, max_queue: int,
+                 overflow: str, codec: Codec = JSON):
+        self.manager = manager
+        self.connection_id = connection_id
+        self.websocket = websocket
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.codec = codec
+        self.user_type = user_type_of(connection_id)
+        # Each slot is a mutable [key, message, encoded, queued_at] list so
+        # coalescing can replace the message without moving it in the queue.
+        # ``encoded`` maps codec name to the serialized message and is shared
+        # by every recipient of a broadcast, so each encoding is produced once.
+        self.queue: deque = deque()
+        self.pending: Dict[Hashable, list] = {}
+        self.ready = asyncio.Event()
+        self.channels: Set[str] = set()
+        self.closed = False
+        self.writer = asyncio.create_task(self._write_loop())
+
+    def enqueue(self, message: Dict[str, Any], encoded: Optional[Dict[str, Any]] = None) -> bool:
+        if self.closed:
+            return False
+        key = coalesce_key(message)
+        if key is not None and key in self.pending:
+            self.pending[key][1:] = [message, encoded, time.perf_counter()]
+            messages_dropped.inc(reason="coalesced")
+            return True
+
+        if len(self.queue) >= self.max_queue:
+            if self.overflow == DROP_NEWEST:
+                messages_dropped.inc(reason="overflow")
+                return False
+            if self.overflow == DISCONNECT:
+                messages_dropped.inc(len(self.queue) + 1, reason="overflow")
+                self.manager.disconnect(self.connection_id, self)
+                return False
+            old_key = self.queue.popleft()[0]
+            if old_key is not None:
+                self.pending.pop(old_key, None)
+            messages_dropped.inc(reason="overflow")
+
+        slot = [key, message, encoded, time.perf_counter()]
+        self.queue.append(slot)
+        if key is not None:
+            self.pending[key] = slot
+        self.ready.set()
+        return True
+
+    async def _write_loop(self):
+        try:
+            while True:
+                if not self.queue:
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+                key, message, encoded, queued_at = self.queue.popleft()
+                if key is not None:
+                    self.pending.pop(key, None)
+                if encoded is None:
+                    encoded = {}
+                payload = encoded.get(self.codec.name)
+                if payload is None:
+                    payload = encoded[self.codec.name] = self.codec.encode(message)
+                started = time.perf_counter()
+                queue_wait.observe(started - queued_at, user_type=self.user_type)
+                if isinstance(payload, bytes):
+                    await self.websocket.send_bytes(payload)
+                else:
+                    await self.websocket.send_text(payload)
+                send_latency.observe(time.perf_counter() - started, user_type=self.user_type)
+                messages_sent.inc()
+                bytes_sent.inc(len(payload), encoding=self.codec.name)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            send_failures.inc()
+            logger.info("Dropping connection %s after failed send", self.connection_id)
+            self.manager.disconnect(self.connection_id, self)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.queue:
+            messages_dropped.inc(len(self.queue), reason="disconnected")
+        self.queue.clear()
+        self.pending.clear()
+        if self.writer is not asyncio.current_task():
+            self.writer.cancel()
+
+
+class ConnectionManager:
+    """Tracks live WebSockets and delivers messages without blocking the caller.
+
+    Sending only enqueues onto the connection's bounded queue; a per-connection
+    writer task does the actual send, so a slow client can only delay
+    its own messages. When a queue is full the ``overflow`` policy decides
+    whether the oldest message, the new message or the connection is dropped.
+
+    Each connection negotiates its encoding (see ``ws_protocol``) through
+    the WebSocket subprotocol when it is accepted.
+
+    Connections can also ``join`` named channels (e.g. one per restaurant);
+    ``send_to_channel`` reaches every member without looking anyone up.
+
+    With a ``backplane`` every send is also published to the other workers,
+    which deliver it to whatever sockets they hold, and connection presence is
+    shared so ``is_connected`` sees sockets held anywhere. Workers publish a
+    heartbeat every ``HEARTBEAT_INTERVAL``; presence announced by a worker
+    that stops sending anything for ``NODE_TIMEOUT`` is dropped.
+    """
+
+    def __init__(self, max_queue: int = 256, overflow: str = DROP_OLDEST, backplane: Optional[Backplane] = None):
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.backplane = backplane
+        self.connections: Dict[str, Connection] = {}
+        self.user_connections: Dict[str, Set[str]] = {}
+        self.remote_connections: Dict[str, str] = {}  # connection id -> node id
+        self.node_seen: Dict[str, float] = {}  # node id -> monotonic time last heard from
+        self._heartbeat: Optional[asyncio.Task] = None
+        self.channels: Dict[str, Set[str]] = {}  # channel -> local connection ids
+        self.subscribers: Dict[str, List[Callable[[Envelope], None]]] = {}
+        REGISTRY.gauge("ws_connections", "Open WebSocket connections", function=self._connection_counts)
+        REGISTRY.gauge("ws_queue_depth", "Queued outbound WebSocket messages", function=self._queue_depths)
+
+    @property
+    def active_connections(self) -> Dict[str, WebSocket]:
+        return {connection_id: connection.websocket for connection_id, connection in self.connections.items()}
+
+    def is_connected(self, connection_id: str) -> bool:
+        return connection_id in self.connections or connection_id in self.remote_connections
+
+    def has_local(self, user_id: str) -> bool:
+        """Whether ``user_id`` has a socket on this worker."""
+        return bool(self._targets(user_id))
+
+    async def start(self):
+        if self.backplane is not None:
+            await self.backplane.start(self._on_envelope)
+            self._publish({"kind": "sync"})
+            self._heartbeat = asyncio.create_task(self._heartbeat_loop())
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            self._publish({"kind": "heartbeat"})
+            self._expire_nodes(time.monotonic())
+
+    def _expire_nodes(self, now: float):
+        for node in [node for node, seen in self.node_seen.items() if now - seen > NODE_TIMEOUT]:
+            del self.node_seen[node]
+            self._forget_node(node)
+
+    def _forget_node(self, node: str):
+        for connection_id in [c for c, held_by in self.remote_connections.items() if held_by == node]:
+            del self.remote_connections[connection_id]
+
+    def _publish(self, envelope: Envelope):
+        if self.backplane is not None:
+            self.backplane.publish(envelope)
+
+    def subscribe(self, kind: str, handler: Callable[[Envelope], None]):
+        """Call ``handler`` with every ``kind`` event published by other workers."""
+        self.subscribers.setdefault(kind, []).append(handler)
+
+    def publish(self, kind: str, **data):
+        """Share an application event with the other workers, if there are any."""
+        self._publish({"kind": kind, **data})
+
+    async def _on_envelope(self, envelope: Envelope):
+        kind = envelope["kind"]
+        self.node_seen[envelope["origin"]] = time.monotonic()
+        if kind == "heartbeat":
+            pass
+        elif kind == "personal":
+            self._deliver_personal(envelope["message"], envelope["target"])
+        elif kind == "drivers":
+            self._deliver_to_drivers(envelope["message"])
+        elif kind == "channel":
+            self._deliver_to_channel(envelope["message"], envelope["channel"])
+        elif kind == "connected":
+            self.remote_connections[envelope["connection_id"]] = envelope["origin"]
+        elif kind == "disconnected":
+            if self.remote_connections.get(envelope["connection_id"]) == envelope["origin"]:
+                del self.remote_connections[envelope["connection_id"]]
+        elif kind == "sync":
+            # A worker (re)started: forget what it held and re-announce ours
+            self._forget_node(envelope["origin"])
+            for connection_id in self.connections:
+                self._publish({"kind": "connected", "connection_id": connection_id})
+        else:
+            for handler in self.subscribers.get(kind, ()):
+                handler(envelope)
+
+    async def connect(self, websocket: WebSocket, user_id: str) -> Connection:
+        codec, subprotocol = negotiate(websocket.scope.get("subprotocols", ()))
+        await websocket.accept(subprotocol=subprotocol)
+        previous = self.connections.get(user_id)
+        if previous is not None:
+            self.disconnect(user_id, previous)
+        connection = Connection(self, user_id, websocket, self.max_queue, self.overflow, codec)
+        self.connections[user_id] = connection
+        owner = user_id_of(user_id)
+        if owner is not None:
+            self.user_connections.setdefault(owner, set()).add(user_id)
+        self._publish({"kind": "connected", "connection_id": user_id})
+        return connection
+
+    def disconnect(self, user_id: str, connection: Optional[Connection] = None):
+        current = self.connections.get(user_id)
+        if current is None or (connection is not None and current is not connection):
+            if connection is not None:
+                connection.close()
+            return
+        del self.connections[user_id]
+        for channel in current.channels:
+            self._leave(channel, user_id)
+        current.close()
+        owner = user_id_of(user_id)
+        if owner is not None and owner in self.user_connections:
+            self.user_connections[owner].discard(user_id)
+            if not self.user_connections[owner]:
+                del self.user_connections[owner]
+        self._publish({"kind": "disconnected", "connection_id": user_id})
+
+    def join(self, connection_id: str, channel: str):
+        """Subscribe a local connection (or every connection of a user) to ``channel``."""
+        for connection in self._targets(connection_id):
+            connection.channels.add(channel)
+            self.channels.setdefault(channel, set()).add(connection.connection_id)
+
+    def leave(self, connection_id: str, channel: str):
+        for connection in self._targets(connection_id):
+            connection.channels.discard(channel)
+            self._leave(channel, connection.connection_id)
+
+    def _leave(self, channel: str, connection_id: str):
+        members = self.channels.get(channel)
+        if members is not None:
+            members.discard(connection_id)
+            if not members:
+                del self.channels[channel]
+
+    def _targets(self, user_id: str) -> List[Connection]:
+        connection = self.connections.get(user_id)
+        if connection is not None:
+            return [connection]
+        return [self.connections[c] for c in self.user_connections.get(user_id, ()) if c in self.connections]
+
+    # Fan-out hands every recipient the same ``encoded`` dict, so the message
+    # is serialized once per encoding in use rather than once per socket.
+
+    def _deliver_personal(self, message: dict, user_id: str):
+        encoded = {}
+        for connection in self._targets(user_id):
+            connection.enqueue(message, encoded)
+
+    def _deliver_to_drivers(self, message: dict):
+        encoded = {}
+        for connection_id, connection in list(self.connections.items()):
+            if connection_id.startswith("driver_"):
+                connection.enqueue(message, encoded)
+
+    def _deliver_to_channel(self, message: dict, channel: str):
+        encoded = {}
+        for connection_id in list(self.channels.get(channel, ())):
+            connection = self.connections.get(connection_id)
+            if connection is not None:
+                connection.enqueue(message, encoded)
+
+    async def send_personal_message(self, message: dict, user_id: str):
+        self._deliver_personal(message, user_id)
+        self._publish({"kind": "personal", "target": user_id, "message": message})
+
+    async def broadcast_to_drivers(self, message: dict):
+        self._deliver_to_drivers(message)
+        self._publish({"kind": "drivers", "message": message})
+
+    async def send_to_channel(self, message: dict, channel: str):
+        self._deliver_to_channel(message, channel)
+        self._publish({"kind": "channel", "channel": channel, "message": message})
+
+    async def close(self):
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            await asyncio.gather(self._heartbeat, return_exceptions=True)
+            self._heartbeat = None
+        connections = list(self.connections.values())
+        for connection in connections:
+            self.disconnect(connection.connection_id, connection)
+        await asyncio.gather(*(c.writer for c in connections), return_exceptions=True)
+        if self.backplane is not None:
+            await self.backplane.close()
+
+    def _connection_counts(self):
+        counts: Dict[tuple, float] = {}
+        for connection in self.connections.values():
+            key = (("user_type", connection.user_type),)
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def _queue_depths(self):
+        depths = [len(c.queue) for c in self.connections.values()]
+        return {
+            (("stat", "total"),): float(sum(depths)),
+            (("stat", "max"),): float(max(depths, default=0)),
+        }
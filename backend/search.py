@@ -0,0 +1,286 @@
+import heapq
+import math
+import re
+import unicodedata
+from bisect import bisect_left, insort
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from geo import KM_PER_DEGREE_LAT, haversine_km
+
+# Ranking: the estimated minutes until the food is at the door (kitchen
+# time plus the ride) minus a bonus per rating star, and minus a bonus when
+# every search term is in the restaurant's name. Lower ranks first.
+MINUTES_PER_KM = 3.0  # 20 km/h through city traffic
+RATING_WEIGHT = 4.0  # minutes per star
+NAME_MATCH_BONUS = 5.0
+
+DEFAULT_RADIUS_KM = 10.0
+MAX_RADIUS_KM = 50.0
+
+# Text matches fewer than this are ranked one by one; above it the grid
+# search runs with the matches as a filter
+DIRECT_RANK_LIMIT = 512
+
+_TOKEN = re.compile(r"[^\W_]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase words of ``text`` with accents removed ("Crêpes" -> "crepes")."""
+    folded = unicodedata.normalize("NFKD", text.lower())
+    return _TOKEN.findall("".join(c for c in folded if not unicodedata.combining(c)))
+
+
+class SearchHit:
+    """One ranked restaurant. Orders worst first so a heap of hits keeps the best."""
+
+    __slots__ = ("score", "id", "distance_km", "eta_minutes", "document")
+
+    def __init__(self, score: float, restaurant_id: str, distance_km: float, eta_minutes: float,
+                 document: Dict[str, Any]):
+        self.score = score
+        self.id = restaurant_id
+        self.distance_km = distance_km
+        self.eta_minutes = eta_minutes
+        self.document = document
+
+    def __lt__(self, other: "SearchHit") -> bool:
+        return (self.score, self.id) > (other.score, other.id)
+
+
+class _Entry:
+    __slots__ = ("document", "lat", "lng", "prep_minutes", "static", "cell", "tokens", "name_tokens", "cuisine")
+
+    def __init__(self, document: Dict[str, Any], lat: float, lng: float):
+        self.document = document
+        self.lat = lat
+        self.lng = lng
+        self.prep_minutes = float(document.get("estimated_delivery_time") or 0)
+        # The part of the score that does not depend on where the customer is
+        self.static = self.prep_minutes - RATING_WEIGHT * float(document.get("rating") or 0.0)
+        self.name_tokens = set(tokenize(document.get("name") or ""))
+        self.cuisine = (document.get("cuisine_type") or "").strip().lower()
+        self.tokens = (self.name_tokens | set(tokenize(document.get("description") or ""))
+                       | set(tokenize(self.cuisine)))
+        self.cell: Tuple[int, int] = (0, 0)
+
+
+class RestaurantSearchIndex:
+    """In-process index of active restaurants for location-aware discovery.
+
+    Restaurants are bucketed into a lat/lng grid like ``GeoGridIndex``, but
+    each cell keeps its restaurants sorted by the location-independent part
+    of their score. A search visits cells best-bound first (closest corner,
+    best restaurant in the cell) and stops once no unvisited cell can beat
+    the page it holds, so a dense city rarely needs more than a few cells.
+    Name, description and cuisine words go into an inverted index; every
+    search term must match a word, as a prefix when it has two letters or
+    more.
+    """
+
+    def __init__(self, cell_size_km: float = 2.0):
+        self.cell_deg = cell_size_km / KM_PER_DEGREE_LAT
+        self.entries: Dict[str, _Entry] = {}
+        self.cells: Dict[Tuple[int, int], List[Tuple[float, str]]] = {}
+        self.postings: Dict[str, Set[str]] = {}
+        self.name_postings: Dict[str, Set[str]] = {}
+        self.cuisines: Dict[str, Set[str]] = {}
+        self._vocabulary: List[str] = []
+        self._vocabulary_stale = False
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, restaurant_id: str) -> bool:
+        return restaurant_id in self.entries
+
+    def location(self, restaurant_id: str) -> Optional[Tuple[float, float]]:
+        entry = self.entries.get(restaurant_id)
+        return (entry.lat, entry.lng) if entry else None
+
+    def _cell(self, lat: float, lng: float) -> Tuple[int, int]:
+        return int(math.floor(lat / self.cell_deg)), int(math.floor(lng / self.cell_deg))
+
+    async def load(self, collection):
+        """Index every active restaurant in ``collection``."""
+        async for document in collection.find({"is_active": True}, {"_id": 0}):
+            self.upsert(document)
+
+    def upsert(self, document: Dict[str, Any]):
+        """Index or reindex a restaurant document; inactive ones are removed."""
+        restaurant_id = document["id"]
+        self.remove(restaurant_id)
+        location = document.get("location") or {}
+        try:
+            lat, lng = float(location["lat"]), float(location["lng"])
+        except (KeyError, TypeError, ValueError):
+            return
+        if not document.get("is_active", True):
+            return
+
+        entry = _Entry(document, lat, lng)
+        entry.cell = self._cell(lat, lng)
+        self.entries[restaurant_id] = entry
+        insort(self.cells.setdefault(entry.cell, []), (entry.static, restaurant_id))
+        for token in entry.tokens:
+            if token not in self.postings:
+                self._vocabulary_stale = True
+            self.postings.setdefault(token, set()).add(restaurant_id)
+        for token in entry.name_tokens:
+            self.name_postings.setdefault(token, set()).add(restaurant_id)
+        self.cuisines.setdefault(entry.cuisine, set()).add(restaurant_id)
+
+    def remove(self, restaurant_id: str):
+        entry = self.entries.pop(restaurant_id, None)
+        if entry is None:
+            return
+        members = self.cells[entry.cell]
+        del members[bisect_left(members, (entry.static, restaurant_id))]
+        if not members:
+            del self.cells[entry.cell]
+        for token in entry.tokens:
+            self._discard(self.postings, token, restaurant_id)
+        for token in entry.name_tokens:
+            self._discard(self.name_postings, token, restaurant_id)
+        self._discard(self.cuisines, entry.cuisine, restaurant_id)
+
+    def _discard(self, index: Dict[str, Set[str]], key: str, restaurant_id: str):
+        ids = index.get(key)
+        if ids is not None:
+            ids.discard(restaurant_id)
+            if not ids:
+                del index[key]
+
+    def _expand(self, term: str) -> List[str]:
+        """Indexed words matching ``term``: itself, or every word it prefixes."""
+        if len(term) < 2:
+            return [term] if term in self.postings else []
+        if self._vocabulary_stale:
+            self._vocabulary = sorted(self.postings)
+            self._vocabulary_stale = False
+        words = []
+        for i in range(bisect_left(self._vocabulary, term), len(self._vocabulary)):
+            if not self._vocabulary[i].startswith(term):
+                break
+            words.append(self._vocabulary[i])
+        return words
+
+    def _matching(self, index: Dict[str, Set[str]], words: Iterable[str]) -> Set[str]:
+        matched: Set[str] = set()
+        for word in words:
+            matched.update(index.get(word, ()))
+        return matched
+
+    def _text_matches(self, terms: List[str]) -> Tuple[Set[str], Set[str]]:
+        """Ids matching every term anywhere, and those matching every term in the name."""
+        expanded = sorted((self._expand(term) for term in terms), key=len)
+        matches: Optional[Set[str]] = None
+        in_name: Optional[Set[str]] = None
+        for words in expanded:
+            hits = self._matching(self.postings, words)
+            matches = hits if matches is None else matches & hits
+            name_hits = self._matching(self.name_postings, words)
+            in_name = name_hits if in_name is None else in_name & name_hits
+            if not matches:
+                break
+        return matches or set(), (in_name or set()) & (matches or set())
+
+    def search(
+        self,
+        lat: float,
+        lng: float,
+        radius_km: float = DEFAULT_RADIUS_KM,
+        cuisine: Optional[str] = None,
+        query: Optional[str] = None,
+        limit: int = 20,
+        after: Optional[Tuple[float, str]] = None,
+    ) -> List[SearchHit]:
+        """Best ``limit`` restaurants within ``radius_km``, best first.
+
+        ``after`` is the ``(score, id)`` of the last hit of the previous page.
+        """
+        candidates: Optional[Set[str]] = None
+        in_name: Set[str] = set()
+        terms = tokenize(query or "")
+        if terms:
+            candidates, in_name = self._text_matches(terms)
+        if cuisine:
+            by_cuisine = self.cuisines.get(cuisine.strip().lower(), set())
+            candidates = by_cuisine if candidates is None else candidates & by_cuisine
+        if candidates is not None and not candidates:
+            return []
+
+        page: List[SearchHit] = []
+
+        def offer(restaurant_id: str, entry: _Entry):
+            distance = haversine_km(lat, lng, entry.lat, entry.lng)
+            if distance > radius_km:
+                return
+            score = entry.static + distance * MINUTES_PER_KM
+            if restaurant_id in in_name:
+                score -= NAME_MATCH_BONUS
+            if after is not None and (score, restaurant_id) <= after:
+                return
+            hit = SearchHit(score, restaurant_id, distance, entry.prep_minutes + distance * MINUTES_PER_KM,
+                            entry.document)
+            if len(page) < limit:
+                heapq.heappush(page, hit)
+            elif page[0] < hit:
+                heapq.heapreplace(page, hit)
+
+        if candidates is not None and len(candidates) <= DIRECT_RANK_LIMIT:
+            for restaurant_id in candidates:
+                offer(restaurant_id, self.entries[restaurant_id])
+        else:
+            self._search_cells(lat, lng, radius_km, limit, candidates, bool(in_name), page, offer)
+        return sorted(page, reverse=True)
+
+    def _search_cells(self, lat, lng, radius_km, limit, candidates, name_bonus, page, offer):
+        bonus = NAME_MATCH_BONUS if name_bonus else 0.0
+        bounds = []
+        for cell, distance in self._cells_within(lat, lng, radius_km):
+            members = self.cells[cell]
+            ride = distance * MINUTES_PER_KM - bonus
+            bounds.append((ride + members[0][0], cell, ride))
+        heapq.heapify(bounds)
+
+        entries = self.entries
+        while bounds:
+            bound, cell, ride = heapq.heappop(bounds)
+            if len(page) == limit and bound > page[0].score:
+                break
+            for static, restaurant_id in self.cells[cell]:
+                if len(page) == limit and ride + static > page[0].score:
+                    break
+                if candidates is None or restaurant_id in candidates:
+                    offer(restaurant_id, entries[restaurant_id])
+
+    def _cells_within(self, lat: float, lng: float, radius_km: float) -> List[Tuple[Tuple[int, int], float]]:
+        """Occupied cells whose closest point is within ``radius_km``, with that distance."""
+        lat_span = int(math.ceil(radius_km / KM_PER_DEGREE_LAT / self.cell_deg))
+        cos_lat = max(math.cos(math.radians(lat)), 0.01)
+        lng_span = int(math.ceil(radius_km / (KM_PER_DEGREE_LAT * cos_lat) / self.cell_deg))
+        center_row, center_col = self._cell(lat, lng)
+
+        # Walk whichever is smaller: the cells in the search box or the occupied cells
+        if (2 * lat_span + 1) * (2 * lng_span + 1) <= len(self.cells):
+            candidate_cells = [
+                (row, col)
+                for row in range(center_row - lat_span, center_row + lat_span + 1)
+                for col in range(center_col - lng_span, center_col + lng_span + 1)
+                if (row, col) in self.cells
+            ]
+        else:
+            candidate_cells = [
+                (row, col) for row, col in self.cells
+                if abs(row - center_row) <= lat_span and abs(col - center_col) <= lng_span
+            ]
+
+        cells = []
+        deg = self.cell_deg
+        for row, col in candidate_cells:
+            nearest_lat = min(max(lat, row * deg), (row + 1) * deg)
+            nearest_lng = min(max(lng, col * deg), (col + 1) * deg)
+            distance = haversine_km(lat, lng, nearest_lat, nearest_lng)
+            if distance <= radius_km:
+                cells.append(((row, col), distance))
+        return cells
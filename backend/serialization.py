@@ -0,0 +1,56 @@
+from datetime import date, time
+from decimal import Decimal
+from enum import Enum
+from typing import Any
+from uuid import UUID
+
+import msgpack
+import orjson
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+
+# One JSON encoder for HTTP responses and WebSocket frames. orjson handles
+# datetimes, enums and UUIDs natively (naive datetimes come out in the same
+# ISO format as FastAPI's encoder); the fallback covers the rest.
+OPTIONS = orjson.OPT_NON_STR_KEYS
+
+
+def _default(value: Any):
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(value: Any) -> bytes:
+    return orjson.dumps(value, default=_default, option=OPTIONS)
+
+
+def dumps_text(value: Any) -> str:
+    return dumps(value).decode()
+
+
+def _msgpack_default(value: Any):
+    # Same values on the wire as the JSON encoding produces
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, UUID):
+        return str(value)
+    return _default(value)
+
+
+def packb(value: Any) -> bytes:
+    """MessagePack counterpart of ``dumps``, for binary WebSocket clients."""
+    return msgpack.packb(value, default=_msgpack_default)
+
+
+class FastJSONResponse(ORJSONResponse):
+    """Default response class: serializes with ``dumps`` in a single pass."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
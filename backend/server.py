@@ -1,68 +1,144 @@
-from fastapi import FastAPI, APIRouter, HTTPException, WebSocket, WebSocketDisconnect, Depends, Depends
+from fastapi import FastAPI, APIRouter, HTTPException, WebSocket, WebSocketDisconnect, Depends, Depends, Request, Query
+from fastapi.responses import Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field, ValidationError
+from typing import List, Optional, Dict, Any, Union
 import uuid
 from datetime import datetime, timedelta
 import jwt
-import stripe
 import asyncio
 from enum import Enum
+from geo import GeoGridIndex
+from batch_dispatch import BatchDispatcher
+from dispatch import OrderDispatcher
+from eta import ETAEngine
+from realtime import ConnectionManager
+from backplane import InMemoryBackplane, MongoBackplane
+from metrics import REGISTRY, LoopLagMonitor
+from instrumentation import InstrumentedDatabase, MetricsMiddleware
+from cache import ResponseCache, TTLCache
+from location_ingest import LocationPipeline
+from pricing import PricingEngine, PricingError, to_money
+from payments import FakePaymentGateway, StripeGateway
+from outbox import Outbox
+from order_deltas import OVERLAP_US, DeltaLog, SeqClock, deltas_served, order_delta
+from order_state import MAX_BATCH, Actor, OrderNotFound, OrderStateMachine, TransitionError, TransitionForbidden
+from pagination import DEFAULT_LIMIT, MAX_LIMIT, CursorError, build_projection, decode_cursor, encode_cursor, fetch_page
+from pymongo import DESCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from indexes import ensure_indexes
+from analytics import BUCKET_SIZES, MAX_SERIES_POINTS, AnalyticsRollups, naive_utc, status_name
+from serialization import FastJSONResponse, dumps
+from search import DEFAULT_RADIUS_KM, MAX_RADIUS_KM, RestaurantSearchIndex
+from ws_protocol import AckFrame, AuthFrame, FrameError, LocationFrame, PingFrame
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
+# MongoDB connection. Every collection operation is timed into
+# mongo_operation_seconds.
 mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+db = InstrumentedDatabase(client[os.environ['DB_NAME']])
 
-# Stripe configuration
-stripe.api_key = os.environ['STRIPE_SECRET_KEY']
+# Payments go through a gateway that keeps Stripe's blocking SDK off the
+# event loop. PAYMENT_GATEWAY=fake uses an in-process fake for load tests.
+def create_payment_gateway():
+    if os.environ.get("PAYMENT_GATEWAY", "").lower() == "fake":
+        return FakePaymentGateway(latency=float(os.environ.get("FAKE_PAYMENT_LATENCY", "0")))
+    return StripeGateway(
+        os.environ['STRIPE_SECRET_KEY'],
+        max_workers=int(os.environ.get("STRIPE_MAX_WORKERS", "8")),
+        timeout=float(os.environ.get("STRIPE_TIMEOUT", "10")),
+    )
+
+payment_gateway = create_payment_gateway()
+loop_lag = LoopLagMonitor()
 
 # JWT configuration
 JWT_SECRET = "your-secret-key-change-in-production"
 JWT_ALGORITHM = "HS256"
 
-app = FastAPI()
+app = FastAPI(default_response_class=FastJSONResponse)
 api_router = APIRouter(prefix="/api")
 security = HTTPBearer()
 
-# WebSocket connections manager
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
-    
-    async def connect(self, websocket: WebSocket, user_id: str):
-        await websocket.accept()
-        self.active_connections[user_id] = websocket
-    
-    def disconnect(self, user_id: str):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
-    
-    async def send_personal_message(self, message: dict, user_id: str):
-        if user_id in self.active_connections:
-            try:
-                await self.active_connections[user_id].send_json(message)
-            except:
-                self.disconnect(user_id)
-    
-    async def broadcast_to_drivers(self, message: dict):
-        for user_id, connection in self.active_connections.items():
-            if user_id.startswith("driver_"):
-                try:
-                    await connection.send_json(message)
-                except:
-                    self.disconnect(user_id)
+# WebSocket connections manager. With more than one uvicorn worker set
+# WS_BACKPLANE=mongo so messages reach sockets held by other workers.
+def create_backplane():
+    kind = os.environ.get("WS_BACKPLANE", "").lower()
+    if kind == "mongo":
+        return MongoBackplane(db)
+    if kind == "memory":
+        return InMemoryBackplane()
+    return None
+
+manager = ConnectionManager(backplane=create_backplane())
+
+# Online drivers indexed by their last reported position, used to offer
+# new orders to the nearest drivers instead of every connected one.
+driver_index = GeoGridIndex(cell_size_km=1.0)
+
+async def send_to_driver(driver_id: str, message: dict):
+    await manager.send_personal_message(message, f"driver_{driver_id}")
+
+async def busy_drivers() -> set:
+    return set(await db.orders.distinct(
+        "driver_id", {"status": {"$in": ["confirmed", "preparing", "ready", "picked_up"]}}
+    )) - {None}
 
-manager = ConnectionManager()
+# DISPATCH_MODE=batch matches waiting orders to idle drivers every few
+# seconds instead of offering each order to its nearest drivers in rings
+BATCH_DISPATCH = os.environ.get("DISPATCH_MODE", "").lower() == "batch"
+if BATCH_DISPATCH:
+    dispatcher = BatchDispatcher(
+        driver_index,
+        send=send_to_driver,
+        broadcast=manager.broadcast_to_drivers,
+        is_available=lambda driver_id: manager.is_connected(f"driver_{driver_id}"),
+        load_busy=busy_drivers,
+        speed_kmh=lambda now: eta_engine.speed_kmh(now),
+        interval=float(os.environ.get("DISPATCH_INTERVAL", "5")),
+    )
+else:
+    dispatcher = OrderDispatcher(
+        driver_index,
+        send=send_to_driver,
+        broadcast=manager.broadcast_to_drivers,
+        is_available=lambda driver_id: manager.is_connected(f"driver_{driver_id}"),
+    )
+
+# Recently assigned orders, so drivers racing for one are turned away
+# without a database round trip
+taken_orders = TTLCache("taken_orders", maxsize=10000, ttl=600)
+assignments = REGISTRY.counter("order_assignments_total", "Driver accept attempts by result (won, lost, not_found)")
+offers_withdrawn = REGISTRY.counter("order_offers_withdrawn_total", "Offers withdrawn from other drivers after an order was taken")
+
+async def release_order(order_id: str, driver_id: str):
+    # Stop dispatching and tell the other offered drivers to stop competing
+    taken_orders.set(order_id, driver_id)
+    competitors = dispatcher.accept(order_id) - {driver_id}
+    offers_withdrawn.inc(len(competitors))
+    for other in competitors:
+        await send_to_driver(other, {"type": "order_taken", "order_id": order_id})
+
+manager.subscribe("order_taken", lambda event: asyncio.create_task(release_order(event["order_id"], event["driver_id"])))
+
+async def withdraw_order(order_id: str):
+    # Stop dispatching a cancelled order and take it off the offered drivers' screens
+    offered = dispatcher.accept(order_id)
+    offers_withdrawn.inc(len(offered))
+    for driver_id in offered:
+        await send_to_driver(driver_id, {"type": "order_withdrawn", "order_id": order_id})
+
+manager.subscribe("order_withdrawn", lambda event: asyncio.create_task(withdraw_order(event["order_id"])))
 
 # Enums
 class UserType(str, Enum):
@@ -80,6 +156,14 @@ class OrderStatus(str, Enum):
     DELIVERED = "delivered"
     CANCELLED = "cancelled"
 
+# Statuses in which an order without a driver can still be taken
+ASSIGNABLE_STATUSES = [OrderStatus.PENDING.value, OrderStatus.CONFIRMED.value, OrderStatus.PREPARING.value, OrderStatus.READY.value]
+
+class PaymentStatus(str, Enum):
+    PENDING = "pending"
+    CREATED = "created"
+    FAILED = "failed"
+
 # Models
 class User(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -121,6 +205,10 @@ class Restaurant(BaseModel):
     estimated_delivery_time: int = 30  # minutes
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
+class RestaurantSearchResult(Restaurant):
+    distance_km: float
+    eta_minutes: int  # kitchen time plus the ride to the customer
+
 class RestaurantCreate(BaseModel):
     name: str
     description: str
@@ -172,12 +260,27 @@ class Order(BaseModel):
     delivery_address: str
     delivery_location: Dict[str, float]
     payment_intent_id: Optional[str] = None
+    payment_status: PaymentStatus = PaymentStatus.PENDING
+    seq: Optional[int] = None
+    version: int = 1
     estimated_delivery_time: datetime
     actual_delivery_time: Optional[datetime] = None
     special_instructions: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
+class OrderDelta(BaseModel):
+    order_id: str
+    seq: int
+    version: int
+    changes: Dict[str, Any]
+
+class OrderChanges(BaseModel):
+    # GET /orders?since=<seq>: deltas from the log, or the changed orders
+    seq: int
+    deltas: List[OrderDelta]
+    orders: List[Order]
+
 class OrderCreate(BaseModel):
     restaurant_id: str
     items: List[OrderItem]
@@ -185,6 +288,14 @@ class OrderCreate(BaseModel):
     delivery_location: Dict[str, float]
     special_instructions: Optional[str] = None
 
+class OrderStatusBatch(BaseModel):
+    order_ids: List[str] = Field(min_length=1, max_length=MAX_BATCH)
+    status: OrderStatus
+
+class TokenClaims(BaseModel):
+    id: str
+    user_type: UserType
+
 class PaymentIntent(BaseModel):
     client_secret: str
     amount: int
@@ -207,35 +318,342 @@ def verify_jwt_token(token: str):
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+# Authenticated users, so the per-request lookup only hits Mongo on a miss.
+# Invalidate on every write to a user document.
+user_cache = TTLCache("users", maxsize=10000, ttl=60)
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     payload = verify_jwt_token(credentials.credentials)
-    user = await db.users.find_one({"id": payload["user_id"]})
+    user_id = payload["user_id"]
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        return cached
+    generation = user_cache.generation
+    user = await db.users.find_one({"id": user_id})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    return User(**user)
+    user_obj = User(**user)
+    user_cache.set(user_id, user_obj, generation)
+    return user_obj
+
+def invalidate_users(user_ids):
+    for user_id in user_ids:
+        user_cache.invalidate(user_id)
+
+async def load_active_orders(driver_id: str):
+    orders = await db.orders.find(
+        {"driver_id": driver_id, "status": {"$in": [OrderStatus.PICKED_UP]}},
+        {"id": 1, "customer_id": 1}
+    ).to_list(10)
+    return {order["id"]: order["customer_id"] for order in orders}
+
+# Live driver positions: served from memory, persisted in periodic batches
+location_pipeline = LocationPipeline(
+    db,
+    driver_index,
+    notify=manager.send_personal_message,
+    load_active_orders=load_active_orders,
+    replicate=lambda positions, removed: manager.publish("driver_locations", positions=positions, removed=removed),
+    on_flushed=invalidate_users,
+)
+manager.subscribe("driver_locations", lambda event: location_pipeline.apply_remote(event["positions"], event["removed"]))
+
+async def get_current_claims(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    # Trusts the signed token for id and type; use only where the rest of the
+    # user document is not needed.
+    payload = verify_jwt_token(credentials.credentials)
+    return TokenClaims(id=payload["user_id"], user_type=payload["user_type"])
+
+# Incrementally maintained order counters and revenue for the dashboards
+analytics = AnalyticsRollups(db)
+timeseries_cache = TTLCache("timeseries", maxsize=1000, ttl=5)
+
+# Versioned order deltas. Every order write stamps a new ``seq`` and bumps
+# ``version``; the changed fields are pushed to the people following the
+# order and kept in a short log so clients catch up after reconnecting
+order_clock = SeqClock()
+order_log = DeltaLog(order_clock)
+
+def log_order_delta(delta: dict):
+    order_clock.observe(delta["seq"])
+    order_log.append(delta)
+
+def record_order_delta(order: dict, changes: dict, version: int) -> dict:
+    """Log and replicate a delta; returns the fields to add to the message pushing it."""
+    changes = jsonable_encoder(changes)
+    delta = order_delta(order, changes["seq"], version, changes)
+    log_order_delta(delta)
+    manager.publish("order_delta", delta=delta)
+    return {"seq": delta["seq"], "version": version, "changes": changes}
+
+def versioned(update: dict) -> dict:
+    seq = order_clock.next()
+    return {"$set": {**update["$set"], "seq": seq}, "$inc": {"version": 1}}
+
+manager.subscribe("order_delta", lambda event: log_order_delta(event["delta"]))
 
-def calculate_order_total(items: List[OrderItem], restaurant: Restaurant):
-    subtotal = 0
-    for item in items:
-        # In real app, fetch menu item price from database
-        subtotal += item.quantity * 12.99  # placeholder price
+# Status changes as conditional atomic updates
+order_states = OrderStateMachine(db, clock=order_clock.next)
+
+# Acts on orders for the server itself, e.g. cancelling unpaid orders
+SYSTEM_ACTOR = Actor(id="system", user_type="admin")
+
+# Server-side cart pricing from cached per-restaurant menus
+pricing_engine = PricingEngine(db)
+
+# Rendered bodies of the public restaurant and menu listings, tagged
+# "restaurants" and "menu:<restaurant id>"
+response_cache = ResponseCache("responses", ttl=60)
+
+def drop_menu(restaurant_id: str):
+    pricing_engine.invalidate(restaurant_id)
+    response_cache.invalidate(f"menu:{restaurant_id}")
+
+def invalidate_menu(restaurant_id: str):
+    drop_menu(restaurant_id)
+    manager.publish("menu_changed", restaurant_id=restaurant_id)
+
+# Restaurant ids per owner, for ownership checks on orders
+owned_restaurants = TTLCache("owned_restaurants", maxsize=10000, ttl=300)
+
+async def owned_restaurant_ids(owner_id: str) -> List[str]:
+    restaurant_ids = owned_restaurants.get(owner_id)
+    if restaurant_ids is None:
+        generation = owned_restaurants.generation
+        restaurants = await db.restaurants.find({"owner_id": owner_id}, {"_id": 0, "id": 1}).to_list(None)
+        restaurant_ids = [r["id"] for r in restaurants]
+        owned_restaurants.set(owner_id, restaurant_ids, generation)
+    return restaurant_ids
+
+# Restaurant users' sockets join "owner:<user id>" once authenticated, and
+# through it the "restaurant:<id>" feed of every restaurant they own
+def restaurant_channel(restaurant_id: str) -> str:
+    return f"restaurant:{restaurant_id}"
+
+def join_restaurant_feeds(owner_id: str, restaurant_ids: List[str]):
+    for connection_id in list(manager.channels.get(f"owner:{owner_id}", ())):
+        for restaurant_id in restaurant_ids:
+            manager.join(connection_id, restaurant_channel(restaurant_id))
+
+# Active restaurants by location and by the words of their name, description
+# and cuisine, for the discovery search. Loaded at startup, then updated on
+# every change made here or announced by another worker.
+restaurant_search = RestaurantSearchIndex(cell_size_km=2.0)
+
+async def reindex_restaurant(restaurant_id: str):
+    restaurant = await db.restaurants.find_one({"id": restaurant_id}, {"_id": 0})
+    if restaurant:
+        restaurant_search.upsert(restaurant)
+    else:
+        restaurant_search.remove(restaurant_id)
+
+def drop_restaurants(owner_id: Optional[str] = None, restaurant_id: Optional[str] = None):
+    response_cache.invalidate("restaurants")
+    if owner_id:
+        owned_restaurants.invalidate(owner_id)
+        if restaurant_id:
+            join_restaurant_feeds(owner_id, [restaurant_id])
+
+def invalidate_restaurants(owner_id: Optional[str] = None, restaurant_id: Optional[str] = None):
+    drop_restaurants(owner_id, restaurant_id)
+    manager.publish("restaurants_changed", owner_id=owner_id, restaurant_id=restaurant_id)
+
+manager.subscribe("menu_changed", lambda event: drop_menu(event["restaurant_id"]))
+def on_restaurants_changed(event: dict):
+    drop_restaurants(event.get("owner_id"), event.get("restaurant_id"))
+    if event.get("restaurant_id"):
+        asyncio.create_task(reindex_restaurant(event["restaurant_id"]))
+
+manager.subscribe("restaurants_changed", on_restaurants_changed)
+
+# Delivery estimates from prep time, kitchen queue, live driver positions and
+# past lateness, refreshed for every active order and pushed to customers
+eta_engine = ETAEngine(
+    db,
+    locate_restaurant=restaurant_search.location,
+    driver_position=location_pipeline.position,
+    notify=manager.send_personal_message,
+    versioned=versioned,
+    record_delta=record_order_delta,
+    # With a backplane the saving worker's push reaches the customer's worker
+    is_local=None if manager.backplane is not None else manager.has_local,
+)
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    candidates = [candidate.strip() for candidate in header.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+def page_headers(request: Request, next_cursor: Optional[str]) -> Dict[str, str]:
+    if not next_cursor:
+        return {}
+    next_url = request.url.include_query_params(after=next_cursor)
+    return {"X-Next-Cursor": next_cursor, "Link": f'<{next_url}>; rel="next"'}
+
+async def load_page(collection, query: dict, limit: int, after: Optional[str], fields: Optional[str], model, hidden=(), **sort):
+    try:
+        projection = build_projection(fields, model.model_fields, sort.get("sort_field", "created_at"), hidden)
+        return await fetch_page(collection, query, limit=limit, after=after, projection=projection, **sort)
+    except CursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def cached_response(request: Request, tag: str, load) -> Response:
+    # ``load`` returns (documents, next cursor)
+    async def render():
+        documents, next_cursor = await load()
+        return dumps(documents), page_headers(request, next_cursor)
     
-    delivery_fee = restaurant.delivery_fee
-    tax = subtotal * 0.08  # 8% tax
-    total = subtotal + delivery_fee + tax
+    body, etag, page = await response_cache.get(tag, str(request.query_params), render)
+    headers = {"ETag": etag, "Cache-Control": "no-cache", **page}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+async def calculate_order_total(items: List[OrderItem], restaurant: Restaurant):
+    try:
+        return await pricing_engine.price(restaurant.id, restaurant.delivery_fee, items)
+    except PricingError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Order pipeline: create_order only prices and persists the order with its
+# queued work; outbox workers create the payment intent and dispatch drivers
+async def create_payment_intent(order: dict) -> dict:
+    payment_intent = await payment_gateway.create_intent(
+        order["id"],
+        int(to_money(order["total"]) * 100),
+        currency='usd',
+        metadata={'customer_id': order["customer_id"], 'restaurant_id': order["restaurant_id"]}
+    )
+    update = versioned({"$set": {
+        "payment_intent_id": payment_intent.id,
+        "payment_status": PaymentStatus.CREATED.value
+    }})
+    current = await db.orders.find_one_and_update(
+        {"id": order["id"]}, update, projection={"_id": 0, "version": 1}, return_document=ReturnDocument.AFTER
+    )
+    await manager.send_personal_message({
+        "type": "payment_ready",
+        "order_id": order["id"],
+        "client_secret": payment_intent.client_secret,
+        **record_order_delta(order, update["$set"], current["version"])
+    }, order["customer_id"])
+    return {"client_secret": payment_intent.client_secret}
+
+async def dispatch_order(order: dict):
+    # Retried tasks may run after a driver already took the order
+    if order.get("driver_id") or status_name(order["status"]) not in ASSIGNABLE_STATUSES:
+        return
+    restaurant = await db.restaurants.find_one({"id": order["restaurant_id"]}, {"_id": 0, "location": 1})
+    if not restaurant:
+        return
+    # Offered to the nearest drivers in widening rings, or matched in the next batch
+    dispatcher.dispatch(order["id"], restaurant["location"], {
+        "type": "new_order",
+        "order": jsonable_encoder(Order(**order))
+    })
+
+async def order_task_failed(kind: str, order: dict, error: str):
+    if kind != "payment":
+        return
+    update = versioned({"$set": {"payment_status": PaymentStatus.FAILED.value}})
+    current = await db.orders.find_one_and_update(
+        {"id": order["id"]}, update, projection={"_id": 0, "version": 1}, return_document=ReturnDocument.AFTER
+    )
+    await manager.send_personal_message({
+        "type": "payment_failed",
+        "order_id": order["id"],
+        **record_order_delta(order, update["$set"], current["version"])
+    }, order["customer_id"])
     
-    return subtotal, delivery_fee, tax, total
+    # An order that cannot be paid for must not be prepared or delivered
+    try:
+        before, changes = await order_states.transition(order["id"], OrderStatus.CANCELLED.value, SYSTEM_ACTOR)
+    except TransitionError as e:
+        logger.warning("Could not cancel order %s after its payment failed: %s", order["id"], e)
+        return
+    await order_status_changed(before, OrderStatus.CANCELLED, changes["updated_at"], changes)
+
+order_outbox = Outbox(
+    db, "orders",
+    handlers={"payment": create_payment_intent, "dispatch": dispatch_order},
+    on_failed=order_task_failed,
+    workers=int(os.environ.get("ORDER_WORKERS", "4")),
+    max_backlog=int(os.environ.get("ORDER_MAX_BACKLOG", "1000")),
+)
 
 # WebSocket endpoint
+ws_frames = REGISTRY.counter("ws_frames_received_total", "Inbound WebSocket frames by type")
+
+def authenticate_socket(token: str, connection_id: str) -> TokenClaims:
+    payload = verify_jwt_token(token)
+    claims = TokenClaims(id=payload["user_id"], user_type=payload["user_type"])
+    if connection_id not in (claims.id, f"{claims.user_type.value}_{claims.id}"):
+        raise HTTPException(status_code=403, detail="Token does not match this connection")
+    return claims
+
+async def socket_authenticated(connection, claims: TokenClaims):
+    if claims.user_type == UserType.RESTAURANT:
+        manager.join(connection.connection_id, f"owner:{claims.id}")
+        join_restaurant_feeds(claims.id, await owned_restaurant_ids(claims.id))
+
+async def handle_ws_frame(data: Union[str, bytes], connection, claims: Optional[TokenClaims]) -> Optional[TokenClaims]:
+    try:
+        frame = connection.codec.decode(data)
+    except (ValidationError, FrameError):
+        ws_frames.inc(type="invalid")
+        connection.enqueue({"type": "error", "detail": "Invalid frame"})
+        return claims
+    ws_frames.inc(type=frame.type)
+    
+    if isinstance(frame, PingFrame):
+        connection.enqueue({"type": "pong", "ts": datetime.utcnow().isoformat()})
+    elif isinstance(frame, AuthFrame):
+        try:
+            claims = authenticate_socket(frame.token, connection.connection_id)
+        except HTTPException as e:
+            connection.enqueue({"type": "error", "detail": e.detail})
+            return claims
+        await socket_authenticated(connection, claims)
+        connection.enqueue({"type": "auth_ok"})
+    elif isinstance(frame, LocationFrame):
+        if claims is None or claims.user_type != UserType.DRIVER:
+            connection.enqueue({"type": "error", "detail": "Only authenticated drivers can send location"})
+            return claims
+        point = frame.latest()
+        # A buffered batch may arrive after newer points; the pipeline keeps the newest.
+        # Timestamps ahead of the server clock are capped so they cannot block later points.
+        recorded_at = min(point.ts, datetime.utcnow()) if point.ts else None
+        await location_pipeline.ingest(claims.id, {"lat": point.lat, "lng": point.lng}, recorded_at=recorded_at)
+    elif isinstance(frame, AckFrame):
+        # Delivery confirmations are only counted for now
+        pass
+    return claims
+
 @app.websocket("/ws/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: str):
-    await manager.connect(websocket, user_id)
+async def websocket_endpoint(websocket: WebSocket, user_id: str, token: Optional[str] = None):
+    connection = await manager.connect(websocket, user_id)
+    claims = None
+    if token:
+        try:
+            claims = authenticate_socket(token, user_id)
+            await socket_authenticated(connection, claims)
+        except HTTPException as e:
+            connection.enqueue({"type": "error", "detail": e.detail})
     try:
         while True:
-            data = await websocket.receive_text()
-            # Handle incoming WebSocket messages if needed
+            # Text or binary, depending on the negotiated encoding
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            data = message.get("text") if message.get("text") is not None else message.get("bytes")
+            claims = await handle_ws_frame(data, connection, claims)
     except WebSocketDisconnect:
-        manager.disconnect(user_id)
+        manager.disconnect(user_id, connection)
+        if user_id.startswith("driver_") and not manager.is_connected(user_id):
+            # Stops serving the last position and drops the driver from dispatch
+            location_pipeline.remove(user_id[len("driver_"):])
 
 # Authentication endpoints
 @api_router.post("/auth/register")
@@ -246,7 +664,10 @@ async def register_user(user: UserCreate):
         raise HTTPException(status_code=400, detail="User already exists")
     
     user_obj = User(**user.dict())
-    await db.users.insert_one(user_obj.dict())
+    try:
+        await db.users.insert_one(user_obj.dict())
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="User already exists")
     
     token = create_jwt_token(user_obj.dict())
     return {"user": user_obj, "token": token}
@@ -269,12 +690,62 @@ async def create_restaurant(restaurant: RestaurantCreate, current_user: User = D
     
     restaurant_obj = Restaurant(**restaurant.dict(), owner_id=current_user.id)
     await db.restaurants.insert_one(restaurant_obj.dict())
+    restaurant_search.upsert(restaurant_obj.dict())
+    invalidate_restaurants(current_user.id, restaurant_obj.id)
     return restaurant_obj
 
 @api_router.get("/restaurants", response_model=List[Restaurant])
-async def get_restaurants():
-    restaurants = await db.restaurants.find({"is_active": True}).to_list(100)
-    return [Restaurant(**restaurant) for restaurant in restaurants]
+async def get_restaurants(
+    request: Request,
+    limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+    after: Optional[str] = None,
+    cuisine: Optional[str] = None,
+    fields: Optional[str] = None,
+):
+    query = {"is_active": True}
+    if cuisine:
+        query["cuisine_type"] = cuisine
+    return await cached_response(
+        request, "restaurants",
+        lambda: load_page(db.restaurants, query, limit, after, fields, Restaurant)
+    )
+
+@api_router.get("/restaurants/search", response_model=List[RestaurantSearchResult])
+async def search_restaurants(
+    request: Request,
+    lat: float = Query(..., ge=-90, le=90),
+    lng: float = Query(..., ge=-180, le=180),
+    radius_km: float = Query(DEFAULT_RADIUS_KM, gt=0, le=MAX_RADIUS_KM),
+    cuisine: Optional[str] = None,
+    q: Optional[str] = Query(None, max_length=100),
+    limit: int = Query(20, ge=1, le=MAX_LIMIT),
+    after: Optional[str] = None,
+):
+    # Ranked by ETA and rating from the in-memory index; the cursor holds
+    # the (score, id) of the last result, so it only fits the same search
+    last = None
+    if after:
+        try:
+            last = decode_cursor(after)
+        except CursorError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if not isinstance(last[0], (int, float)):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    
+    hits = restaurant_search.search(lat, lng, radius_km, cuisine=cuisine, query=q, limit=limit + 1, after=last)
+    next_cursor = None
+    if len(hits) > limit:
+        hits = hits[:limit]
+        next_cursor = encode_cursor({"score": hits[-1].score, "id": hits[-1].id}, "score")
+    results = [
+        {
+            **hit.document,
+            "distance_km": round(hit.distance_km, 2),
+            "eta_minutes": round(hit.eta_minutes),
+        }
+        for hit in hits
+    ]
+    return Response(content=dumps(results), media_type="application/json", headers=page_headers(request, next_cursor))
 
 @api_router.get("/restaurants/{restaurant_id}")
 async def get_restaurant(restaurant_id: str):
@@ -295,12 +766,25 @@ async def add_menu_item(restaurant_id: str, item: MenuItemCreate, current_user:
     
     item_obj = MenuItem(**item.dict(), restaurant_id=restaurant_id)
     await db.menu_items.insert_one(item_obj.dict())
+    invalidate_menu(restaurant_id)
     return item_obj
 
 @api_router.get("/restaurants/{restaurant_id}/menu", response_model=List[MenuItem])
-async def get_menu(restaurant_id: str):
-    menu_items = await db.menu_items.find({"restaurant_id": restaurant_id, "is_available": True}).to_list(100)
-    return [MenuItem(**item) for item in menu_items]
+async def get_menu(
+    restaurant_id: str,
+    request: Request,
+    limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+    after: Optional[str] = None,
+    category: Optional[str] = None,
+    fields: Optional[str] = None,
+):
+    query = {"restaurant_id": restaurant_id, "is_available": True}
+    if category:
+        query["category"] = category
+    return await cached_response(
+        request, f"menu:{restaurant_id}",
+        lambda: load_page(db.menu_items, query, limit, after, fields, MenuItem)
+    )
 
 # Order endpoints
 @api_router.post("/orders")
@@ -312,162 +796,347 @@ async def create_order(order: OrderCreate, current_user: User = Depends(get_curr
     if not restaurant:
         raise HTTPException(status_code=404, detail="Restaurant not found")
     
+    if order_outbox.overloaded:
+        raise HTTPException(status_code=503, detail="Too many orders in progress, try again shortly", headers={"Retry-After": "5"})
+    
     restaurant_obj = Restaurant(**restaurant)
-    subtotal, delivery_fee, tax, total = calculate_order_total(order.items, restaurant_obj)
+    quote = await calculate_order_total(order.items, restaurant_obj)
     
-    # Create Stripe Payment Intent
-    payment_intent = stripe.PaymentIntent.create(
-        amount=int(total * 100),  # Convert to cents
-        currency='usd',
-        metadata={'customer_id': current_user.id, 'restaurant_id': order.restaurant_id}
+    now = datetime.utcnow()
+    estimated_delivery_time, baseline = eta_engine.quote(
+        restaurant_obj.id, restaurant_obj.location, order.delivery_location, quote.max_preparation_time, now
     )
     
-    estimated_delivery_time = datetime.utcnow() + timedelta(minutes=restaurant_obj.estimated_delivery_time)
-    
     order_obj = Order(
         **order.dict(),
         customer_id=current_user.id,
-        subtotal=subtotal,
-        delivery_fee=delivery_fee,
-        tax=tax,
-        total=total,
-        payment_intent_id=payment_intent.id,
+        subtotal=float(quote.subtotal),
+        delivery_fee=float(quote.delivery_fee),
+        tax=float(quote.tax),
+        total=float(quote.total),
+        seq=order_clock.next(),
         estimated_delivery_time=estimated_delivery_time
     )
     
-    await db.orders.insert_one(order_obj.dict())
-    
-    # Broadcast to available drivers
-    await manager.broadcast_to_drivers({
+    # The order and its payment and dispatch tasks are written together
+    # ``eta`` keeps what later estimates and the lateness history need
+    eta = {"preparation_minutes": quote.max_preparation_time, "baseline": baseline}
+    await db.orders.insert_one({**order_obj.dict(), "eta": eta, **order_outbox.tasks("payment", "dispatch")})
+    order_outbox.notify("payment", "dispatch")
+    analytics.order_created(order_obj.dict())
+    record_order_delta(order_obj.dict(), order_obj.dict(), order_obj.version)
+    await manager.send_to_channel({
         "type": "new_order",
-        "order": order_obj.dict()
-    })
+        "order": jsonable_encoder(order_obj),
+        "seq": order_obj.seq,
+        "version": order_obj.version
+    }, restaurant_channel(order_obj.restaurant_id))
     
+    # The client secret arrives as a "payment_ready" message or from
+    # GET /orders/{id}/payment
     return {
         "order": order_obj,
-        "client_secret": payment_intent.client_secret
+        "client_secret": None
+    }
+
+@api_router.get("/orders/{order_id}/payment")
+async def get_order_payment(order_id: str, current_user: TokenClaims = Depends(get_current_claims)):
+    order = await db.orders.find_one(
+        {"id": order_id},
+        {"_id": 0, "customer_id": 1, "payment_status": 1, "payment_intent_id": 1, "outbox.payment": 1}
+    )
+    if not order or order["customer_id"] != current_user.id:
+        raise HTTPException(status_code=404, detail="Order not found")
+    
+    task = order.get("outbox", {}).get("payment", {})
+    return {
+        "order_id": order_id,
+        "payment_status": order.get("payment_status", PaymentStatus.PENDING.value),
+        "payment_intent_id": order.get("payment_intent_id"),
+        "client_secret": task.get("result", {}).get("client_secret")
     }
 
-@api_router.get("/orders", response_model=List[Order])
-async def get_orders(current_user: User = Depends(get_current_user)):
+@api_router.get("/orders", response_model=Union[List[Order], OrderChanges])
+async def get_orders(
+    request: Request,
+    limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+    after: Optional[str] = None,
+    status: Optional[List[OrderStatus]] = Query(None),
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    fields: Optional[str] = None,
+    since: Optional[int] = Query(None, ge=0),
+    current_user: TokenClaims = Depends(get_current_claims),
+):
     if current_user.user_type == UserType.CUSTOMER:
-        orders = await db.orders.find({"customer_id": current_user.id}).to_list(100)
+        query = {"customer_id": current_user.id}
     elif current_user.user_type == UserType.DRIVER:
-        orders = await db.orders.find({"driver_id": current_user.id}).to_list(100)
+        query = {"driver_id": current_user.id}
     elif current_user.user_type == UserType.RESTAURANT:
-        restaurants = await db.restaurants.find({"owner_id": current_user.id}).to_list(10)
-        restaurant_ids = [r["id"] for r in restaurants]
-        orders = await db.orders.find({"restaurant_id": {"$in": restaurant_ids}}).to_list(100)
+        query = {"restaurant_id": {"$in": await owned_restaurant_ids(current_user.id)}}
     else:
-        orders = await db.orders.find().to_list(100)
+        query = {}
     
-    return [Order(**order) for order in orders]
-
-@api_router.put("/orders/{order_id}/status")
-async def update_order_status(order_id: str, status: OrderStatus, current_user: User = Depends(get_current_user)):
-    order = await db.orders.find_one({"id": order_id})
-    if not order:
-        raise HTTPException(status_code=404, detail="Order not found")
+    if since is not None:
+        return await get_order_changes(request, query, since, limit, after, fields)
     
-    # Check permissions based on user type and status
-    if current_user.user_type == UserType.RESTAURANT and status in [OrderStatus.CONFIRMED, OrderStatus.PREPARING, OrderStatus.READY]:
-        pass
-    elif current_user.user_type == UserType.DRIVER and status in [OrderStatus.PICKED_UP, OrderStatus.DELIVERED]:
-        pass
-    else:
-        raise HTTPException(status_code=403, detail="Not authorized to update this status")
+    if status:
+        query["status"] = {"$in": [s.value for s in status]}
+    if created_from or created_to:
+        query["created_at"] = {}
+        if created_from:
+            query["created_at"]["$gte"] = created_from
+        if created_to:
+            query["created_at"]["$lt"] = created_to
     
-    update_data = {"status": status, "updated_at": datetime.utcnow()}
-    if status == OrderStatus.DELIVERED:
-        update_data["actual_delivery_time"] = datetime.utcnow()
+    # Newest first
+    orders, next_cursor = await load_page(db.orders, query, limit, after, fields, Order, hidden=("outbox", "eta"), direction=DESCENDING)
+    return FastJSONResponse(orders, headers=page_headers(request, next_cursor))
+
+async def get_order_changes(request: Request, query: dict, since: int, limit: int, after: Optional[str], fields: Optional[str]):
+    # Catch-up after a reconnect: recent changes come from the delta log;
+    # older ones are answered with just the orders changed since then
+    seq = order_clock.next()
+    if not after:
+        def visible(delta: dict) -> bool:
+            return all(
+                delta.get(name) in value["$in"] if isinstance(value, dict) else delta.get(name) == value
+                for name, value in query.items()
+            )
+        deltas = order_log.since(since, visible)
+        if deltas is not None:
+            deltas_served.inc(source="log")
+            return FastJSONResponse({
+                "seq": seq,
+                "deltas": [{name: delta[name] for name in ("order_id", "seq", "version", "changes")} for delta in deltas],
+                "orders": []
+            })
     
-    await db.orders.update_one({"id": order_id}, {"$set": update_data})
+    deltas_served.inc(source="database")
+    query = {**query, "seq": {"$gt": since - OVERLAP_US}}
+    orders, next_cursor = await load_page(db.orders, query, limit, after, fields, Order, hidden=("outbox", "eta"), sort_field="seq")
+    return FastJSONResponse({"seq": seq, "deltas": [], "orders": orders}, headers=page_headers(request, next_cursor))
+
+async def order_actor(current_user: TokenClaims) -> Actor:
+    restaurant_ids = []
+    if current_user.user_type == UserType.RESTAURANT:
+        restaurant_ids = await owned_restaurant_ids(current_user.id)
+    return Actor(id=current_user.id, user_type=current_user.user_type.value, restaurant_ids=restaurant_ids)
+
+async def order_status_changed(order: dict, status: OrderStatus, now: datetime, changes: dict):
+    # Side effects of a transition; ``order`` is the order before it
+    analytics.order_status_changed(order, order["status"], status.value, now)
+    order_id = order["id"]
+    if status == OrderStatus.CANCELLED:
+        await withdraw_order(order_id)
+        manager.publish("order_withdrawn", order_id=order_id)
+    if order.get("driver_id"):
+        if status == OrderStatus.PICKED_UP:
+            location_pipeline.order_started(order["driver_id"], order_id, order["customer_id"])
+        elif status in [OrderStatus.DELIVERED, OrderStatus.CANCELLED]:
+            location_pipeline.order_finished(order["driver_id"], order_id)
     
     # Send real-time updates
-    await manager.send_personal_message({
+    message = {
         "type": "order_status_update",
         "order_id": order_id,
-        "status": status
-    }, order["customer_id"])
-    
+        "status": status,
+        **record_order_delta(order, changes, order.get("version", 0) + 1)
+    }
+    await manager.send_personal_message(message, order["customer_id"])
     if order.get("driver_id"):
-        await manager.send_personal_message({
-            "type": "order_status_update",
-            "order_id": order_id,
-            "status": status
-        }, order["driver_id"])
+        await manager.send_personal_message(message, order["driver_id"])
+    await manager.send_to_channel(message, restaurant_channel(order["restaurant_id"]))
+
+TRANSITION_ERRORS = {OrderNotFound: 404, TransitionForbidden: 403}
+
+def transition_http_error(error: TransitionError) -> HTTPException:
+    return HTTPException(status_code=TRANSITION_ERRORS.get(type(error), 409), detail=str(error))
+
+@api_router.put("/orders/{order_id}/status")
+async def update_order_status(order_id: str, status: OrderStatus, current_user: TokenClaims = Depends(get_current_claims)):
+    now = datetime.utcnow()
+    try:
+        order, changes = await order_states.transition(order_id, status.value, await order_actor(current_user), now)
+    except TransitionError as e:
+        raise transition_http_error(e)
     
+    await order_status_changed(order, status, now, changes)
     return {"message": "Order status updated"}
 
+@api_router.post("/orders/status")
+async def update_order_statuses(batch: OrderStatusBatch, current_user: TokenClaims = Depends(get_current_claims)):
+    now = datetime.utcnow()
+    try:
+        applied, failed = await order_states.transition_many(batch.order_ids, batch.status.value, await order_actor(current_user), now)
+    except TransitionError as e:
+        raise transition_http_error(e)
+    
+    for order, changes in applied:
+        await order_status_changed(order, batch.status, now, changes)
+    return {"updated": [order["id"] for order, _ in applied], "failed": failed}
+
 @api_router.post("/orders/{order_id}/assign-driver")
 async def assign_driver(order_id: str, current_user: User = Depends(get_current_user)):
     if current_user.user_type != UserType.DRIVER:
         raise HTTPException(status_code=403, detail="Only drivers can accept orders")
     
-    order = await db.orders.find_one({"id": order_id, "driver_id": None})
-    if not order:
-        raise HTTPException(status_code=404, detail="Order not found or already assigned")
+    if taken_orders.get(order_id):
+        assignments.inc(result="lost")
+        raise HTTPException(status_code=409, detail="Order already taken")
     
-    await db.orders.update_one(
-        {"id": order_id},
-        {"$set": {"driver_id": current_user.id, "status": OrderStatus.CONFIRMED, "updated_at": datetime.utcnow()}}
+    # Compare-and-set: only one driver can take an unassigned order. A
+    # pending order is confirmed by the assignment; one the restaurant has
+    # already moved on keeps its status.
+    now = datetime.utcnow()
+    changes = {"driver_id": current_user.id, "updated_at": now, "seq": order_clock.next()}
+    order = await db.orders.find_one_and_update(
+        {"id": order_id, "driver_id": None, "status": {"$in": ASSIGNABLE_STATUSES}},
+        [{"$set": {
+            **{name: {"$literal": value} for name, value in changes.items()},
+            "status": {"$cond": [{"$eq": ["$status", OrderStatus.PENDING.value]}, OrderStatus.CONFIRMED.value, "$status"]},
+            "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]},
+        }}],
+        projection={"_id": 0, "outbox": 0},
+        return_document=ReturnDocument.BEFORE
     )
+    if not order:
+        existing = await db.orders.find_one({"id": order_id}, {"_id": 0, "driver_id": 1, "status": 1})
+        if not existing:
+            assignments.inc(result="not_found")
+            raise HTTPException(status_code=404, detail="Order not found")
+        if not existing.get("driver_id"):
+            assignments.inc(result="not_assignable")
+            raise HTTPException(status_code=409, detail=f"Order cannot be assigned once {existing['status']}")
+        assignments.inc(result="lost")
+        taken_orders.set(order_id, existing["driver_id"])
+        raise HTTPException(status_code=409, detail="Order already taken")
     
-    # Notify customer
-    await manager.send_personal_message({
+    assignments.inc(result="won")
+    if status_name(order["status"]) == OrderStatus.PENDING.value:
+        changes["status"] = OrderStatus.CONFIRMED.value
+        analytics.order_status_changed(order, order["status"], OrderStatus.CONFIRMED.value, now)
+    await release_order(order_id, current_user.id)
+    manager.publish("order_taken", order_id=order_id, driver_id=current_user.id)
+    
+    # Notify customer and restaurant
+    message = {
         "type": "driver_assigned",
         "order_id": order_id,
-        "driver": current_user.dict()
-    }, order["customer_id"])
+        "driver": jsonable_encoder(current_user),
+        **record_order_delta(order, changes, order.get("version", 0) + 1)
+    }
+    await manager.send_personal_message(message, order["customer_id"])
+    await manager.send_to_channel(message, restaurant_channel(order["restaurant_id"]))
     
     return {"message": "Driver assigned to order"}
 
 # Driver location update
 @api_router.post("/drivers/location")
-async def update_driver_location(location: Dict[str, float], current_user: User = Depends(get_current_user)):
+async def update_driver_location(location: Dict[str, float], current_user: TokenClaims = Depends(get_current_claims)):
     if current_user.user_type != UserType.DRIVER:
         raise HTTPException(status_code=403, detail="Only drivers can update location")
+    if "lat" not in location or "lng" not in location:
+        raise HTTPException(status_code=422, detail="Location requires lat and lng")
     
-    await db.users.update_one(
-        {"id": current_user.id},
-        {"$set": {"location": location}}
-    )
-    
-    # Get active orders for this driver
-    orders = await db.orders.find({"driver_id": current_user.id, "status": {"$in": [OrderStatus.PICKED_UP]}}).to_list(10)
-    
-    # Send location updates to customers with active orders
-    for order in orders:
-        await manager.send_personal_message({
-            "type": "driver_location_update",
-            "order_id": order["id"],
-            "location": location
-        }, order["customer_id"])
+    await location_pipeline.ingest(current_user.id, location)
     
     return {"message": "Location updated"}
 
+@api_router.get("/orders/{order_id}/driver-location")
+async def get_driver_location(order_id: str, current_user: TokenClaims = Depends(get_current_claims)):
+    route = location_pipeline.order_route(order_id)
+    if route is None:
+        order = await db.orders.find_one({"id": order_id}, {"driver_id": 1, "customer_id": 1})
+        if not order:
+            raise HTTPException(status_code=404, detail="Order not found")
+        route = (order.get("driver_id"), order["customer_id"])
+    driver_id, customer_id = route
+    if current_user.id not in (customer_id, driver_id) and current_user.user_type != UserType.ADMIN:
+        raise HTTPException(status_code=403, detail="Not authorized to track this order")
+    if not driver_id:
+        raise HTTPException(status_code=404, detail="No driver assigned yet")
+    
+    location = location_pipeline.position(driver_id)
+    if location is None:
+        driver = await db.users.find_one({"id": driver_id}, {"location": 1})
+        location = driver.get("location") if driver else None
+    return {"order_id": order_id, "driver_id": driver_id, "location": location}
+
 # Analytics endpoint
 @api_router.get("/analytics")
-async def get_analytics(current_user: User = Depends(get_current_user)):
+async def get_analytics(current_user: TokenClaims = Depends(get_current_claims)):
     if current_user.user_type != UserType.ADMIN:
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    total_orders = await db.orders.count_documents({})
-    total_users = await db.users.count_documents({})
-    total_restaurants = await db.restaurants.count_documents({})
-    
-    # Revenue calculation
-    completed_orders = await db.orders.find({"status": OrderStatus.DELIVERED}).to_list(1000)
-    total_revenue = sum(order.get("total", 0) for order in completed_orders)
+    totals = await analytics.totals()
+    total_users = await db.users.estimated_document_count()
+    total_restaurants = await db.restaurants.estimated_document_count()
     
     return {
-        "total_orders": total_orders,
+        "total_orders": int(totals["orders"]),
         "total_users": total_users,
         "total_restaurants": total_restaurants,
-        "total_revenue": total_revenue,
-        "completed_orders": len(completed_orders)
+        "total_revenue": totals["revenue_cents"] / 100,
+        "completed_orders": int(totals["delivered"]),
+        "orders_by_status": {status: int(count) for status, count in totals["status"].items() if count}
     }
 
+@api_router.get("/analytics/timeseries")
+async def get_analytics_timeseries(
+    granularity: str = Query("hour", pattern="^(minute|hour|day)$"),
+    restaurant_id: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    current_user: TokenClaims = Depends(get_current_claims),
+):
+    if current_user.user_type == UserType.RESTAURANT:
+        if not restaurant_id or not await db.restaurants.find_one({"id": restaurant_id, "owner_id": current_user.id}, {"_id": 1}):
+            raise HTTPException(status_code=403, detail="Restaurant users can only view their own restaurants")
+    elif current_user.user_type != UserType.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    # Rollups are bucketed in naive UTC; aware bounds would never match them
+    step = BUCKET_SIZES[granularity]
+    end = naive_utc(end) if end else datetime.utcnow() + step
+    start = naive_utc(start) if start else end - step * 60
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    if (end - start) / step > MAX_SERIES_POINTS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_SERIES_POINTS} buckets per request")
+    
+    # Dashboards poll every few seconds; serve repeats from a short-lived cache
+    key = (granularity, restaurant_id, start.replace(second=0, microsecond=0), end.replace(second=0, microsecond=0))
+    points = timeseries_cache.get(key)
+    if points is None:
+        points = await analytics.series(granularity, start, end, restaurant_id)
+        timeseries_cache.set(key, points)
+    return {"granularity": granularity, "restaurant_id": restaurant_id, "start": start, "end": end, "points": points}
+
+@api_router.post("/analytics/rebuild")
+async def rebuild_analytics(current_user: TokenClaims = Depends(get_current_claims)):
+    if current_user.user_type != UserType.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    if not await analytics.rebuild():
+        raise HTTPException(status_code=409, detail="Analytics rebuild already running")
+    return {"message": "Analytics rebuilt"}
+
+@api_router.get("/admin/metrics")
+async def get_metrics(current_user: TokenClaims = Depends(get_current_claims)):
+    if current_user.user_type != UserType.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return REGISTRY.snapshot()
+
+# Prometheus scrape endpoint. It lives outside /api so the public proxy does
+# not expose it; set METRICS_TOKEN to also require "Authorization: Bearer <token>".
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics(request: Request):
+    if METRICS_TOKEN and request.headers.get("authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return Response(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # Include the router in the main app
 app.include_router(api_router)
 
@@ -477,8 +1146,12 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Link", "X-Next-Cursor"],
 )
 
+# Outermost, so the recorded latency includes every other middleware
+app.add_middleware(MetricsMiddleware)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -486,6 +1159,31 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def start_services():
+    await ensure_indexes(db)
+    await restaurant_search.load(db.restaurants)
+    loop_lag.start()
+    await manager.start()
+    location_pipeline.start()
+    analytics.start()
+    order_outbox.start()
+    eta_engine.start()
+    if BATCH_DISPATCH:
+        dispatcher.start()
+    if not await analytics.collection.find_one({"_id": "all:*"}, {"_id": 1}):
+        # First run with rollups: backfill from existing orders. Workers
+        # starting together race for the rebuild lock; only one rebuilds.
+        asyncio.create_task(analytics.rebuild(only_if_missing=True))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await order_outbox.close()
+    await eta_engine.close()
+    await dispatcher.close()
+    await location_pipeline.close()
+    await analytics.close()
+    await manager.close()
+    await payment_gateway.close()
+    await loop_lag.close()
     client.close()
@@ -0,0 +1,207 @@
+import struct
+import uuid
+from datetime import datetime, timezone
+from typing import Annotated, Any, Dict, List, Literal, Optional, Sequence, Tuple, Union
+
+import msgpack
+from pydantic import AfterValidator, BaseModel, Field, TypeAdapter, model_validator
+
+from serialization import dumps_text, packb
+
+# Inbound WebSocket frames. Every frame is a JSON object with a "type":
+#   {"type": "auth", "token": "<jwt>"}
+#   {"type": "location", "lat": 40.7, "lng": -74.0, "ts": 1718000000}
+#   {"type": "location", "points": [{"lat": ..., "lng": ..., "ts": ...}, ...]}
+#   {"type": "ack", "id": "<message or order id>"}
+#   {"type": "ping"}
+# A socket authenticates once (``auth`` frame or ``?token=`` on connect), so
+# location frames carry no credentials of their own.
+#
+# Clients pick the encoding with the WebSocket subprotocol. JSON text frames
+# are the default; ``v1.msgpack`` switches both directions to binary frames:
+# MessagePack maps with the same fields as the JSON objects, except that
+# location frames use fixed little-endian layouts told apart by their first
+# byte (a MessagePack map never starts below 0x80). Coordinates are integers
+# in 1e-7 degrees, ``ts`` is epoch seconds with 0 meaning "not given":
+#   0x01 location                <B i i I>   lat, lng, ts
+#   0x02 location batch          <B B>       count, then count x <i i I>
+#   0x11 driver_location_update  <B 16s i i> order id (UUID bytes), lat, lng
+
+MAX_POINTS_PER_FRAME = 100
+
+JSON_SUBPROTOCOL = "v1.json"
+MSGPACK_SUBPROTOCOL = "v1.msgpack"
+
+LOCATION_TAG = 0x01
+LOCATION_BATCH_TAG = 0x02
+LOCATION_UPDATE_TAG = 0x11
+COORDINATE_SCALE = 10_000_000
+
+_point = struct.Struct("<iiI")
+_location = struct.Struct("<BiiI")
+_batch_header = struct.Struct("<BB")
+_location_update = struct.Struct("<B16sii")
+
+
+class FrameError(ValueError):
+    """A binary frame that does not match any known layout."""
+
+
+def _naive_utc(ts: Optional[datetime]) -> Optional[datetime]:
+    # Positions are stored and compared as naive UTC, like every other timestamp
+    if ts is None or ts.tzinfo is None:
+        return ts
+    return ts.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+Timestamp = Annotated[Optional[datetime], AfterValidator(_naive_utc)]
+
+
+class LocationPoint(BaseModel):
+    lat: float = Field(ge=-90, le=90)
+    lng: float = Field(ge=-180, le=180)
+    ts: Timestamp = None
+
+
+class AuthFrame(BaseModel):
+    type: Literal["auth"]
+    token: str
+
+
+class LocationFrame(BaseModel):
+    type: Literal["location"]
+    lat: Optional[float] = Field(default=None, ge=-90, le=90)
+    lng: Optional[float] = Field(default=None, ge=-180, le=180)
+    ts: Timestamp = None
+    points: Optional[List[LocationPoint]] = Field(default=None, min_length=1, max_length=MAX_POINTS_PER_FRAME)
+
+    @model_validator(mode="after")
+    def check_point_or_batch(self):
+        if self.points is None and (self.lat is None or self.lng is None):
+            raise ValueError("location frame needs lat/lng or points")
+        return self
+
+    def latest(self) -> LocationPoint:
+        """The newest point in the frame; buffered batches may arrive unsorted."""
+        if self.points is None:
+            return LocationPoint(lat=self.lat, lng=self.lng, ts=self.ts)
+        if all(point.ts is not None for point in self.points):
+            return max(self.points, key=lambda point: point.ts)
+        return self.points[-1]
+
+
+class AckFrame(BaseModel):
+    type: Literal["ack"]
+    id: str
+
+
+class PingFrame(BaseModel):
+    type: Literal["ping"]
+
+
+InboundFrame = Annotated[Union[AuthFrame, LocationFrame, AckFrame, PingFrame], Field(discriminator="type")]
+
+_frame_adapter = TypeAdapter(InboundFrame)
+
+
+def parse_frame(data: Union[str, bytes]):
+    """Validate a raw frame; raises ``pydantic.ValidationError`` if malformed."""
+    return _frame_adapter.validate_json(data)
+
+
+# Fixed location layouts
+
+def _scaled(degrees: float) -> int:
+    return round(degrees * COORDINATE_SCALE)
+
+
+def _point_fields(lat: int, lng: int, ts: int) -> Dict[str, Any]:
+    return {"lat": lat / COORDINATE_SCALE, "lng": lng / COORDINATE_SCALE, "ts": ts or None}
+
+
+def pack_location(lat: float, lng: float, ts: Optional[int] = None) -> bytes:
+    return _location.pack(LOCATION_TAG, _scaled(lat), _scaled(lng), ts or 0)
+
+
+def pack_location_batch(points: Sequence[Tuple[float, float, Optional[int]]]) -> bytes:
+    return _batch_header.pack(LOCATION_BATCH_TAG, len(points)) + b"".join(
+        _point.pack(_scaled(lat), _scaled(lng), ts or 0) for lat, lng, ts in points
+    )
+
+
+def unpack_location(data: bytes) -> LocationFrame:
+    try:
+        if data[0] == LOCATION_TAG:
+            _, lat, lng, ts = _location.unpack(data)
+            return LocationFrame(type="location", **_point_fields(lat, lng, ts))
+        _, count = _batch_header.unpack_from(data)
+        if len(data) != _batch_header.size + count * _point.size:
+            raise FrameError("Location batch length does not match its count")
+        points = [_point_fields(*point) for point in _point.iter_unpack(data[_batch_header.size:])]
+        return LocationFrame(type="location", points=points)
+    except struct.error as e:
+        raise FrameError(str(e)) from e
+
+
+def pack_location_update(message: Dict[str, Any]) -> Optional[bytes]:
+    """The fixed layout of a ``driver_location_update``, or None if it does not fit one."""
+    try:
+        order_id = uuid.UUID(message["order_id"]).bytes
+        location = message["location"]
+        return _location_update.pack(LOCATION_UPDATE_TAG, order_id, _scaled(location["lat"]), _scaled(location["lng"]))
+    except (KeyError, TypeError, ValueError, struct.error):
+        return None
+
+
+# Codecs, one per subprotocol
+
+class JsonCodec:
+    name = "json"
+
+    def encode(self, message: Dict[str, Any]) -> str:
+        return dumps_text(message)
+
+    def decode(self, data: Union[str, bytes]):
+        return parse_frame(data)
+
+
+class MsgpackCodec:
+    name = "msgpack"
+
+    def encode(self, message: Dict[str, Any]) -> bytes:
+        if message.get("type") == "driver_location_update":
+            packed = pack_location_update(message)
+            if packed is not None:
+                return packed
+        return packb(message)
+
+    def decode(self, data: Union[str, bytes]):
+        if isinstance(data, str):
+            # Text frames are still read as JSON, which helps when debugging
+            return parse_frame(data)
+        if not data:
+            raise FrameError("Empty frame")
+        if data[0] in (LOCATION_TAG, LOCATION_BATCH_TAG):
+            return unpack_location(data)
+        try:
+            frame = msgpack.unpackb(data)
+        except (ValueError, msgpack.UnpackException) as e:
+            raise FrameError(str(e)) from e
+        return _frame_adapter.validate_python(frame)
+
+
+Codec = Union[JsonCodec, MsgpackCodec]
+
+JSON = JsonCodec()
+MSGPACK = MsgpackCodec()
+
+CODECS: Dict[str, Codec] = {JSON_SUBPROTOCOL: JSON, MSGPACK_SUBPROTOCOL: MSGPACK}
+
+
+def negotiate(offered: Sequence[str]) -> Tuple[Codec, Optional[str]]:
+    """The codec for the first offered subprotocol we support and the
+    subprotocol to accept; plain JSON (and no subprotocol) otherwise."""
+    for subprotocol in offered:
+        if subprotocol in CODECS:
+            return CODECS[subprotocol], subprotocol
+    return JSON, None
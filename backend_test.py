@@ -242,7 +242,18 @@ class FoodDeliveryAPITest(unittest.TestCase):
         data = response.json()
         self.order_id = data["order"]["id"]
         print(f"✅ Order created successfully with ID: {self.order_id}")
-        print(f"✅ Payment intent created with client_secret: {data['client_secret'][:20]}...")
+        
+        # The payment intent is created in the background
+        payment = {}
+        for _ in range(20):
+            response = requests.get(f"{BASE_URL}/orders/{self.order_id}/payment", headers=headers)
+            self.assertEqual(response.status_code, 200, f"Get order payment failed: {response.text}")
+            payment = response.json()
+            if payment["client_secret"]:
+                break
+            time.sleep(0.5)
+        self.assertEqual(payment["payment_status"], "created", "Payment intent should be created")
+        print(f"✅ Payment intent created with client_secret: {payment['client_secret'][:20]}...")
 
     def test_09_get_orders(self):
         """Test getting orders for different user types"""
@@ -353,6 +364,20 @@ class FoodDeliveryAPITest(unittest.TestCase):
         self.assertIn("total_revenue", analytics, "Analytics should include total_revenue")
         print("✅ Admin analytics retrieved successfully")
 
+    def test_15_admin_analytics_timeseries(self):
+        """Test bucketed analytics time series"""
+        print("\n🔍 Testing admin analytics time series...")
+        
+        headers = {"Authorization": f"Bearer {self.tokens['admin']}"}
+        response = requests.get(f"{BASE_URL}/analytics/timeseries", params={"granularity": "minute"}, headers=headers)
+        self.assertEqual(response.status_code, 200, f"Get analytics time series failed: {response.text}")
+        series = response.json()
+        self.assertEqual(series["granularity"], "minute", "Granularity mismatch")
+        self.assertTrue(series["points"], "Time series should include points")
+        for field in ("bucket", "orders", "revenue", "avg_delivery_minutes", "cancellation_rate"):
+            self.assertIn(field, series["points"][0], f"Time series points should include {field}")
+        print(f"✅ Retrieved {len(series['points'])} time series buckets successfully")
+
 if __name__ == "__main__":
     # Create a test suite
     test_suite = unittest.TestSuite()
@@ -372,6 +397,7 @@ if __name__ == "__main__":
     test_suite.addTest(FoodDeliveryAPITest('test_12_driver_update_order_status'))
     test_suite.addTest(FoodDeliveryAPITest('test_13_update_driver_location'))
     test_suite.addTest(FoodDeliveryAPITest('test_14_admin_analytics'))
+    test_suite.addTest(FoodDeliveryAPITest('test_15_admin_analytics_timeseries'))
     
     # Run the tests
     runner = unittest.TextTestRunner(verbosity=2)
@@ -1,10 +1,36 @@
-import React, { useState, useEffect } from "react";
+import React, { useState, useEffect, useRef } from "react";
 import "./App.css";
 import axios from "axios";
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
 
+// Merge a pushed order delta into a list of orders. Deltas carry a per-order
+// version, so stale or repeated ones are ignored.
+const applyOrderDelta = (orders, delta) => {
+  const index = orders.findIndex(order => order.id === delta.order_id);
+  if (index === -1) {
+    return delta.version === 1 ? [delta.changes, ...orders] : orders;
+  }
+  if ((orders[index].version || 0) >= delta.version) {
+    return orders;
+  }
+  const next = [...orders];
+  next[index] = { ...orders[index], ...delta.changes, version: delta.version };
+  return next;
+};
+
+// Replace orders by id with fresher copies from a catch-up response
+const mergeOrders = (orders, changed) => {
+  const byId = new Map(changed.map(order => [order.id, order]));
+  const merged = orders.map(order => {
+    const fresh = byId.get(order.id);
+    byId.delete(order.id);
+    return fresh && (fresh.version || 0) >= (order.version || 0) ? fresh : order;
+  });
+  return [...byId.values(), ...merged];
+};
+
 // User Context
 const UserContext = React.createContext();
 
@@ -196,6 +222,7 @@ const CustomerDashboard = () => {
   const [cart, setCart] = useState([]);
   const [orders, setOrders] = useState([]);
   const [ws, setWs] = useState(null);
+  const lastSeqRef = useRef(null);
   const { user } = React.useContext(UserContext);
 
   useEffect(() => {
@@ -204,20 +231,56 @@ const CustomerDashboard = () => {
     setupWebSocket();
   }, []);
 
+  const trackSeq = (seq) => {
+    if (seq && (lastSeqRef.current === null || seq > lastSeqRef.current)) {
+      lastSeqRef.current = seq;
+    }
+  };
+
+  const applyDelta = (data) => {
+    if (data.version) {
+      setOrders(prev => applyOrderDelta(prev, data));
+      trackSeq(data.seq);
+    }
+  };
+
+  // After (re)connecting, fetch only what changed while disconnected
+  const catchUp = async () => {
+    if (lastSeqRef.current === null) {
+      return;
+    }
+    try {
+      const response = await axios.get(`${API}/orders`, { params: { since: lastSeqRef.current } });
+      setOrders(prev => mergeOrders(response.data.deltas.reduce(applyOrderDelta, prev), response.data.orders));
+      trackSeq(response.data.seq);
+    } catch (error) {
+      console.error('Error catching up on orders:', error);
+    }
+  };
+
   const setupWebSocket = () => {
     const wsUrl = `${BACKEND_URL.replace('https://', 'wss://').replace('http://', 'ws://')}/ws/customer_${user.id}`;
     const websocket = new WebSocket(wsUrl);
     
+    websocket.onopen = () => {
+      catchUp();
+    };
+    
     websocket.onmessage = (event) => {
       const data = JSON.parse(event.data);
       if (data.type === 'order_status_update') {
-        fetchOrders(); // Refresh orders when status updates
+        applyDelta(data);
         alert(`Order ${data.order_id} status updated to: ${data.status}`);
       } else if (data.type === 'driver_assigned') {
         alert(`Driver assigned to your order: ${data.driver.name}`);
-        fetchOrders();
+        applyDelta(data);
       } else if (data.type === 'driver_location_update') {
         console.log('Driver location updated:', data.location);
+      } else if (data.type === 'payment_ready') {
+        applyDelta(data);
+      } else if (data.type === 'payment_failed') {
+        alert(`Payment could not be set up for order ${data.order_id}`);
+        applyDelta(data);
       }
     };
     
@@ -248,6 +311,7 @@ const CustomerDashboard = () => {
     try {
       const response = await axios.get(`${API}/orders`);
       setOrders(response.data);
+      response.data.forEach(order => trackSeq(order.seq));
     } catch (error) {
       console.error('Error fetching orders:', error);
     }
@@ -286,7 +350,8 @@ const CustomerDashboard = () => {
       const response = await axios.post(`${API}/orders`, orderData);
       alert('Order placed successfully!');
       setCart([]);
-      fetchOrders();
+      setOrders(prev => mergeOrders(prev, [response.data.order]));
+      trackSeq(response.data.order.seq);
     } catch (error) {
       alert(error.response?.data?.detail || 'Error placing order');
     }
@@ -404,7 +469,8 @@ const DriverDashboard = () => {
   const [orders, setOrders] = useState([]);
   const [availableOrders, setAvailableOrders] = useState([]);
   const [ws, setWs] = useState(null);
-  const { user } = React.useContext(UserContext);
+  const wsRef = useRef(null);
+  const { user, token } = React.useContext(UserContext);
 
   useEffect(() => {
     fetchOrders();
@@ -420,14 +486,21 @@ const DriverDashboard = () => {
     const wsUrl = `${BACKEND_URL.replace('https://', 'wss://').replace('http://', 'ws://')}/ws/driver_${user.id}`;
     const websocket = new WebSocket(wsUrl);
     
+    websocket.onopen = () => {
+      websocket.send(JSON.stringify({ type: 'auth', token }));
+    };
+    
     websocket.onmessage = (event) => {
       const data = JSON.parse(event.data);
       if (data.type === 'new_order') {
         setAvailableOrders(prev => [...prev, data.order]);
         alert('New order available!');
+      } else if (data.type === 'order_taken') {
+        setAvailableOrders(prev => prev.filter(order => order.id !== data.order_id));
       }
     };
     
+    wsRef.current = websocket;
     setWs(websocket);
     return () => websocket.close();
   };
@@ -438,6 +511,13 @@ const DriverDashboard = () => {
       lng: position.coords.longitude
     };
 
+    // Prefer the open socket; fall back to HTTP while it is (re)connecting
+    const websocket = wsRef.current;
+    if (websocket && websocket.readyState === WebSocket.OPEN) {
+      websocket.send(JSON.stringify({ type: 'location', ...location, ts: position.timestamp / 1000 }));
+      return;
+    }
+
     try {
       await axios.post(`${API}/drivers/location`, location);
     } catch (error) {
@@ -548,12 +628,34 @@ const RestaurantDashboard = () => {
     category: '',
     preparation_time: 15
   });
-  const { user } = React.useContext(UserContext);
+  const { user, token } = React.useContext(UserContext);
 
   useEffect(() => {
     fetchOrders();
+    return setupWebSocket();
   }, []);
 
+  // New orders and status changes for our restaurants are pushed; no polling
+  const setupWebSocket = () => {
+    const wsUrl = `${BACKEND_URL.replace('https://', 'wss://').replace('http://', 'ws://')}/ws/restaurant_${user.id}`;
+    const websocket = new WebSocket(wsUrl);
+    
+    websocket.onopen = () => {
+      websocket.send(JSON.stringify({ type: 'auth', token }));
+    };
+    
+    websocket.onmessage = (event) => {
+      const data = JSON.parse(event.data);
+      if (data.type === 'new_order') {
+        setOrders(prev => prev.some(order => order.id === data.order.id) ? prev : [data.order, ...prev]);
+      } else if (data.type === 'order_status_update' || data.type === 'driver_assigned') {
+        setOrders(prev => applyOrderDelta(prev, data));
+      }
+    };
+    
+    return () => websocket.close();
+  };
+
   const createRestaurant = async (e) => {
     e.preventDefault();
     const restaurantData = {
@@ -612,7 +714,6 @@ const RestaurantDashboard = () => {
   const updateOrderStatus = async (orderId, status) => {
     try {
       await axios.put(`${API}/orders/${orderId}/status?status=${status}`);
-      fetchOrders();
       alert(`Order marked as ${status}`);
     } catch (error) {
       alert(error.response?.data?.detail || 'Error updating order status');
@@ -0,0 +1,41 @@
+import random
+import unittest
+
+import numpy as np
+
+from batch_dispatch import assignment_value, auction, dual_bound
+from benchmarks.bench_dispatch import exhaustive
+
+
+class AuctionTest(unittest.TestCase):
+    def test_within_epsilon_of_the_exhaustive_optimum(self):
+        rng = random.Random(7)
+        np_rng = np.random.default_rng(7)
+        epsilon = 0.1
+        for _ in range(200):
+            n, m = rng.randint(1, 6), rng.randint(1, 6)
+            candidates = np.array([np_rng.permutation(m)[:min(m, 3)] for _ in range(n)])
+            candidates[np_rng.random(candidates.shape) < 0.2] = -1
+            benefit = np.where(candidates >= 0, np_rng.uniform(-5, 30, candidates.shape), -np.inf)
+            reserve = np.where(np_rng.random(n) < 0.3, np_rng.uniform(0, 10, n), 0.0)
+
+            assigned, prices = auction(benefit, candidates, reserve, epsilon)
+
+            taken = assigned[assigned >= 0]
+            self.assertEqual(len(set(taken)), len(taken))
+            for row, column in enumerate(assigned):
+                if column >= 0:
+                    self.assertIn(column, candidates[row])
+            value = assignment_value(benefit, candidates, reserve, assigned)
+            optimum = exhaustive(benefit, candidates, reserve)
+            self.assertGreaterEqual(value, optimum - n * epsilon - 1e-9)
+            self.assertLessEqual(value, optimum + 1e-9)
+            self.assertGreaterEqual(dual_bound(benefit, candidates, reserve, prices), optimum - 1e-9)
+
+    def test_no_candidates(self):
+        assigned, _ = auction(np.full((2, 1), -np.inf), np.full((2, 1), -1), np.zeros(2))
+        self.assertEqual(assigned.tolist(), [-1, -1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+
+from order_deltas import OVERLAP_US, DeltaLog, SeqClock
+
+
+class FakeTime:
+    def __init__(self, us):
+        self.us = us
+
+    def __call__(self):
+        return self.us * 1000
+
+
+class SeqClockTest(unittest.TestCase):
+    def test_strictly_increasing_when_time_stalls_or_goes_back(self):
+        now = FakeTime(1_000_000)
+        clock = SeqClock(now)
+        first, second = clock.next(), clock.next()
+        now.us = 500_000
+        third = clock.next()
+        self.assertEqual([first, second, third], [1_000_000, 1_000_001, 1_000_002])
+
+    def test_observe_keeps_ahead_of_other_workers(self):
+        clock = SeqClock(FakeTime(1_000_000))
+        clock.observe(2_000_000)
+        self.assertEqual(clock.next(), 2_000_001)
+
+
+class DeltaLogTest(unittest.TestCase):
+    def setUp(self):
+        self.now = FakeTime(10 * OVERLAP_US)
+        self.clock = SeqClock(self.now)
+        self.log = DeltaLog(self.clock, maxlen=3)
+        self.now.us += OVERLAP_US
+
+    def append(self, customer_id):
+        self.now.us += 1_000_000
+        delta = {"seq": self.clock.next(), "customer_id": customer_id}
+        self.log.append(delta)
+        return delta
+
+    def test_since_returns_visible_deltas_after_the_overlap(self):
+        first = self.append("a")
+        self.append("b")
+        third = self.append("a")
+        mine = lambda delta: delta["customer_id"] == "a"
+        self.assertEqual(self.log.since(third["seq"] + OVERLAP_US, mine), [])
+        self.assertEqual(self.log.since(third["seq"] - 1 + OVERLAP_US, mine), [third])
+        # Anything within the overlap is served again; clients drop known versions
+        self.assertEqual(self.log.since(third["seq"], mine), [first, third])
+
+    def test_since_is_none_once_the_log_no_longer_reaches_back(self):
+        first = self.append("a")
+        for _ in range(3):
+            self.append("a")
+        self.assertEqual(self.log.floor, first["seq"])
+        self.assertIsNone(self.log.since(first["seq"] - 1 + OVERLAP_US, lambda delta: True))
+        self.assertEqual(len(self.log.since(first["seq"] + OVERLAP_US, lambda delta: True)), 3)
+
+    def test_since_is_none_before_the_log_started(self):
+        self.assertIsNone(self.log.since(self.log.floor - 1 + OVERLAP_US, lambda delta: True))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+
+from order_state import TRANSITIONS, Actor, OrderNotFound, TransitionError, TransitionForbidden, rejection, sources
+
+STATUSES = ["pending", "confirmed", "preparing", "ready", "picked_up", "delivered", "cancelled"]
+USER_TYPES = ["customer", "restaurant", "driver", "admin"]
+
+
+def actor(user_type):
+    return Actor(id="u1", user_type=user_type, restaurant_ids=("r1",))
+
+
+def order(status):
+    return {"id": "o1", "status": status, "customer_id": "u1", "restaurant_id": "r1", "driver_id": "u1"}
+
+
+class TransitionsTableTest(unittest.TestCase):
+    def test_lifecycle_edges(self):
+        expected = {
+            ("pending", "confirmed"): {"restaurant"},
+            ("pending", "cancelled"): {"customer", "restaurant", "admin"},
+            ("confirmed", "preparing"): {"restaurant"},
+            ("confirmed", "cancelled"): {"restaurant", "admin"},
+            ("preparing", "ready"): {"restaurant"},
+            ("preparing", "cancelled"): {"restaurant", "admin"},
+            ("ready", "picked_up"): {"driver"},
+            ("picked_up", "delivered"): {"driver"},
+        }
+        actual = {(status, target): roles for status, edges in TRANSITIONS.items() for target, roles in edges.items()}
+        self.assertEqual(actual, expected)
+
+    def test_terminal_statuses_have_no_way_out(self):
+        for status in ("delivered", "cancelled"):
+            for target in STATUSES:
+                for user_type in USER_TYPES:
+                    self.assertIsInstance(rejection(order(status), target, actor(user_type)), TransitionError)
+
+    def test_sources(self):
+        self.assertEqual(sources("cancelled", "customer"), ["pending"])
+        self.assertEqual(sources("cancelled", "admin"), ["pending", "confirmed", "preparing"])
+        self.assertEqual(sources("picked_up", "driver"), ["ready"])
+        self.assertEqual(sources("delivered", "restaurant"), [])
+
+    def test_rejection_agrees_with_the_table(self):
+        for status in STATUSES:
+            for target in STATUSES:
+                for user_type in USER_TYPES:
+                    allowed = user_type in TRANSITIONS.get(status, {}).get(target, ())
+                    error = rejection(order(status), target, actor(user_type))
+                    self.assertEqual(error is None, allowed, (status, target, user_type))
+
+    def test_rejection_checks_ownership_and_existence(self):
+        self.assertIsInstance(rejection(None, "confirmed", actor("restaurant")), OrderNotFound)
+        other = Actor(id="u2", user_type="restaurant", restaurant_ids=("r2",))
+        self.assertIsInstance(rejection(order("pending"), "confirmed", other), TransitionForbidden)
+        stranger = Actor(id="u2", user_type="customer")
+        self.assertIsInstance(rejection(order("pending"), "cancelled", stranger), TransitionForbidden)
+
+
+if __name__ == "__main__":
+    unittest.main()
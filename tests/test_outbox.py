@@ -0,0 +1,80 @@
+import unittest
+from datetime import datetime, timedelta
+
+from mongomock_motor import AsyncMongoMockClient
+
+from outbox import Outbox
+
+
+class OutboxLeaseTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.db = AsyncMongoMockClient()["test"]
+        self.calls = []
+        self.failures = []
+
+        async def pay(document):
+            self.calls.append(document["id"])
+            return {"charge": f"ch_{len(self.calls)}"}
+
+        async def on_failed(kind, document, error):
+            self.failures.append((kind, document["id"], error))
+
+        self.outbox = Outbox(self.db, "orders", {"payment": pay}, on_failed=on_failed, lease=30, max_attempts=2)
+        await self.db.orders.insert_one({"id": "o1", **self.outbox.tasks("payment")})
+
+    async def task(self):
+        document = await self.db.orders.find_one({"id": "o1"})
+        return document["outbox"]["payment"]
+
+    async def expire_lease(self):
+        await self.db.orders.update_one({"id": "o1"}, {"$set": {"outbox.payment.due_at": datetime.utcnow() - timedelta(seconds=1)}})
+
+    async def test_a_claimed_task_is_not_claimed_again_until_its_lease_expires(self):
+        first = await self.outbox._claim("payment")
+        self.assertEqual(first["outbox"]["payment"]["status"], "running")
+        self.assertIsNone(await self.outbox._claim("payment"))
+
+        await self.expire_lease()
+        second = await self.outbox._claim("payment")
+        self.assertEqual(second["outbox"]["payment"]["attempts"], 2)
+        self.assertNotEqual(second["outbox"]["payment"]["claim"], first["outbox"]["payment"]["claim"])
+
+    async def test_completion_is_fenced_on_the_claim(self):
+        stale = await self.outbox._claim("payment")
+        await self.expire_lease()
+        current = await self.outbox._claim("payment")
+
+        # The worker whose lease expired finishes late and must not record anything
+        await self.outbox._run("payment", stale)
+        task = await self.task()
+        self.assertEqual(task["status"], "running")
+        self.assertEqual(task["claim"], current["outbox"]["payment"]["claim"])
+
+        await self.outbox._run("payment", current)
+        task = await self.task()
+        self.assertEqual(task["status"], "done")
+        self.assertEqual(task["result"], {"charge": "ch_2"})
+        self.assertNotIn("claim", task)
+        self.assertNotIn("due_at", task)
+        self.assertIsNone(await self.outbox._claim("payment"))
+
+    async def test_failures_back_off_then_give_up(self):
+        async def decline(document):
+            raise RuntimeError("card declined")
+
+        self.outbox.handlers["payment"] = decline
+        await self.outbox._run("payment", await self.outbox._claim("payment"))
+        task = await self.task()
+        self.assertEqual((task["status"], task["error"]), ("pending", "card declined"))
+        self.assertGreater(task["due_at"], datetime.utcnow())
+
+        await self.expire_lease()
+        await self.outbox._run("payment", await self.outbox._claim("payment"))
+        task = await self.task()
+        self.assertEqual(task["status"], "failed")
+        self.assertNotIn("due_at", task)
+        self.assertEqual(self.failures, [("payment", "o1", "card declined")])
+
+
+if __name__ == "__main__":
+    unittest.main()
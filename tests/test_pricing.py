@@ -0,0 +1,51 @@
+import unittest
+from dataclasses import dataclass
+from decimal import Decimal
+
+from pricing import PricingEngine, PricingError, to_money
+
+
+@dataclass
+class Item:
+    menu_item_id: str
+    quantity: int
+
+
+MENU = {
+    "burger": {"id": "burger", "name": "Burger", "unit_price": to_money(12.99), "preparation_time": 15},
+    "fries": {"id": "fries", "name": "Fries", "unit_price": to_money(3.5), "preparation_time": 5},
+    "soup": {"id": "soup", "name": "Soup", "unit_price": to_money(6), "is_available": False},
+}
+
+
+class PricingTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = PricingEngine(db=None)
+
+    def test_quote(self):
+        quote = self.engine.quote(MENU, 2.99, [Item("burger", 2), Item("fries", 1)])
+        self.assertEqual(quote.subtotal, Decimal("29.48"))
+        self.assertEqual(quote.delivery_fee, Decimal("2.99"))
+        self.assertEqual(quote.tax, Decimal("2.36"))
+        self.assertEqual(quote.total, Decimal("34.83"))
+        self.assertEqual(quote.max_preparation_time, 15)
+
+    def test_to_money_rounds_half_up_from_the_decimal_text(self):
+        self.assertEqual(to_money(12.99), Decimal("12.99"))
+        self.assertEqual(to_money(0.125), Decimal("0.13"))
+        self.assertEqual(to_money(2.675), Decimal("2.68"))
+
+    def test_rejected_carts(self):
+        carts = {
+            "Order has no items": [],
+            "Invalid quantity for item burger": [Item("burger", 0)],
+            "Menu item pizza not found": [Item("pizza", 1)],
+            "Soup is not available": [Item("burger", 1), Item("soup", 1)],
+        }
+        for message, items in carts.items():
+            with self.assertRaisesRegex(PricingError, f"^{message}$"):
+                self.engine.quote(MENU, 2.99, items)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import struct
+import unittest
+import uuid
+from datetime import datetime
+
+import msgpack
+
+from ws_protocol import (
+    LOCATION_UPDATE_TAG, MSGPACK, AckFrame, FrameError, LocationFrame, PingFrame, pack_location,
+    pack_location_batch,
+)
+
+
+class MsgpackCodecTest(unittest.TestCase):
+    def test_location_round_trip(self):
+        frame = MSGPACK.decode(pack_location(40.7127753, -74.0059728, 1718000000))
+        self.assertIsInstance(frame, LocationFrame)
+        self.assertEqual((frame.lat, frame.lng), (40.7127753, -74.0059728))
+        self.assertEqual(frame.ts, datetime(2024, 6, 10, 6, 13, 20))
+
+    def test_location_without_timestamp(self):
+        frame = MSGPACK.decode(pack_location(-33.8688, 151.2093))
+        self.assertEqual((frame.lat, frame.lng, frame.ts), (-33.8688, 151.2093, None))
+
+    def test_location_batch_round_trip(self):
+        points = [(48.8566, 2.3522, 1718000000), (48.857, 2.353, 1718000005), (48.8575, 2.354, None)]
+        frame = MSGPACK.decode(pack_location_batch(points))
+        self.assertEqual([(p.lat, p.lng) for p in frame.points], [(lat, lng) for lat, lng, _ in points])
+        self.assertEqual(frame.latest().lat, 48.8575)
+
+    def test_truncated_frames_are_rejected(self):
+        for data in (b"", pack_location(1.0, 2.0)[:-1], pack_location_batch([(1.0, 2.0, None)] * 2)[:-3]):
+            with self.assertRaises(FrameError):
+                MSGPACK.decode(data)
+
+    def test_msgpack_maps_decode_to_frames(self):
+        self.assertEqual(MSGPACK.decode(msgpack.packb({"type": "ack", "id": "o1"})), AckFrame(type="ack", id="o1"))
+        self.assertEqual(MSGPACK.decode(msgpack.packb({"type": "ping"})), PingFrame(type="ping"))
+        self.assertEqual(MSGPACK.decode('{"type": "ping"}'), PingFrame(type="ping"))
+
+    def test_outbound_messages_round_trip(self):
+        message = {"type": "order_status_update", "order_id": "o1", "status": "ready", "seq": 2 ** 52, "version": 4}
+        self.assertEqual(msgpack.unpackb(MSGPACK.encode(message)), message)
+
+    def test_driver_location_update_uses_the_fixed_layout(self):
+        order_id = str(uuid.uuid4())
+        data = MSGPACK.encode({"type": "driver_location_update", "order_id": order_id, "location": {"lat": 1.5, "lng": -2.25}})
+        tag, raw_id, lat, lng = struct.unpack("<B16sii", data)
+        self.assertEqual((tag, str(uuid.UUID(bytes=raw_id)), lat, lng), (LOCATION_UPDATE_TAG, order_id, 15_000_000, -22_500_000))
+        # Order ids that are not UUIDs fall back to a MessagePack map
+        message = {"type": "driver_location_update", "order_id": "o1", "location": {"lat": 1.5, "lng": -2.25}}
+        self.assertEqual(msgpack.unpackb(MSGPACK.encode(message)), message)
+
+
+if __name__ == "__main__":
+    unittest.main()